@@ -0,0 +1,91 @@
+import os
+import stat
+import tarfile
+import GitCommands
+
+# Same default as git's tar.umask
+TAR_UMASK = 0o002
+
+GITLINK_MODE = 0o160000
+
+class ChunkReader(object):
+    """A file-like object whose read() serves the bytes of an iterator of
+    chunks, holding no more than one chunk at a time."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = b''
+        self.pos = 0
+
+    def read(self, size=-1):
+        out = list()
+        while size:
+            if self.pos == len(self.chunk):
+                self.chunk = next(self.chunks, None)
+                self.pos = 0
+                if self.chunk is None:
+                    self.chunk = b''
+                    break
+            n = len(self.chunk) - self.pos if size < 0 else min(size, len(self.chunk) - self.pos)
+            out.append(self.chunk[self.pos:self.pos+n])
+            self.pos += n
+            if size > 0:
+                size -= n
+        return b''.join(out)
+
+def tar_info(path, mode, mtime):
+    """A tar header for a tree entry, with the permissions, owner and
+    times git archive gives it."""
+    info = tarfile.TarInfo(os.fsdecode(path))
+    info.mtime = mtime
+    info.uid = info.gid = 0
+    info.uname = info.gname = "root"
+    if stat.S_ISDIR(mode) or mode == GITLINK_MODE:
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o777 & ~TAR_UMASK
+    elif stat.S_ISLNK(mode):
+        info.type = tarfile.SYMTYPE
+        info.mode = 0o777
+    else:
+        info.mode = (0o777 if mode & 0o100 else 0o666) & ~TAR_UMASK
+    return info
+
+def archive_tar(repo, tree, f, compress=False, prefix=b'', mtime=0, comment=None):
+    """Write tree as a tar stream to the binary file f, gzipped if compress
+    is set.  Every path gets prefix, every entry mtime; comment goes in a
+    pax global header, as git does with the commit's sha.
+
+    The tree is walked in order and blobs are copied from the object
+    store as they are inflated, so nothing touches the disk and memory
+    use doesn't depend on the size of the blobs."""
+    pax_headers = { "comment": comment } if comment else {}
+    with tarfile.open(fileobj=f, mode="w|gz" if compress else "w|",
+                      format=tarfile.PAX_FORMAT, pax_headers=pax_headers) as tar:
+        if prefix.endswith(b'/'):
+            tar.addfile(tar_info(prefix, stat.S_IFDIR, mtime))
+
+        # A stack of (path prefix, entry iterator), like ls-tree's
+        stack = [ (prefix, iter(GitCommands.object_read(repo, tree))) ]
+        while stack:
+            path, entries = stack[-1]
+            item = next(entries, None)
+            if item is None:
+                stack.pop()
+                continue
+
+            mode = int(item.mode, 8)
+            name = path + item.path
+            info = tar_info(name, mode, mtime)
+            if item.is_tree():
+                tar.addfile(info)
+                stack.append((name + b'/', iter(GitCommands.object_read(repo, item.sha))))
+            elif mode == GITLINK_MODE:
+                tar.addfile(info)
+            else:
+                fmt, size, chunks = GitCommands.object_stream(repo, item.sha)
+                if stat.S_ISLNK(mode):
+                    info.linkname = os.fsdecode(b''.join(chunks))
+                    tar.addfile(info)
+                else:
+                    info.size = size
+                    tar.addfile(info, ChunkReader(chunks))
@@ -0,0 +1,223 @@
+import os
+import sys
+import array
+import struct
+import hashlib
+import GitPack
+
+# See Documentation/technical/bitmap-format.txt in git.git
+SIGNATURE = b'BITM'
+VERSION = 1
+OPT_FULL_DAG = 0x1
+OPT_HASH_CACHE = 0x4
+OPT_LOOKUP_TABLE = 0x10
+
+MAX_XOR_OFFSET = 160
+
+# Type bitmaps come in this order after the header
+TYPE_ORDER = ( b'commit', b'tree', b'blob', b'tag' )
+
+# EWAH running length words: the low bit is the running bit, then 32 bits
+# of running length, then 31 bits of literal word count.
+RLW_RUNNING_LEN_MAX = 0xFFFFFFFF
+RLW_LITERAL_MAX = 0x7FFFFFFF
+WORD_ONES = 0xFFFFFFFFFFFFFFFF
+
+HEADER = struct.Struct(">4sHHL20s")
+
+def words_from_be(data):
+    """Turn big-endian 64-bit words into an array of their values."""
+    words = array.array("Q", data)
+    if sys.byteorder == "little":
+        words.byteswap()
+    return words
+
+def words_to_int(words):
+    """Bitmap words (bit 0 of word 0 first) to a Python int."""
+    if sys.byteorder != "little":
+        words = array.array("Q", words)
+        words.byteswap()
+    return int.from_bytes(words.tobytes(), "little")
+
+def int_to_words(bits, count):
+    words = array.array("Q", bits.to_bytes(8 * count, "little"))
+    if sys.byteorder != "little":
+        words.byteswap()
+    return words
+
+def ewah_decode(buf, pos):
+    """Read an EWAH bitmap at buf[pos].  Return (bits, pos after it), bits
+    being a Python int whose bit n is the bitmap's bit n."""
+    bit_size, buffer_size = struct.unpack_from(">LL", buf, pos)
+    pos += 8
+    compressed = words_from_be(buf[pos:pos + 8 * buffer_size])
+    pos += 8 * buffer_size + 4  # and the position of the last RLW
+
+    words = array.array("Q")
+    i = 0
+    while i < buffer_size:
+        rlw = compressed[i]
+        running_len = (rlw >> 1) & RLW_RUNNING_LEN_MAX
+        literals = rlw >> 33
+        if rlw & 1:
+            words.extend(array.array("Q", [ WORD_ONES ]) * running_len)
+        else:
+            words.frombytes(bytes(8 * running_len))
+        words.extend(compressed[i+1:i+1+literals])
+        i += 1 + literals
+
+    return words_to_int(words), pos
+
+def ewah_encode(bits):
+    """Serialize a Python int as an EWAH bitmap."""
+    bit_size = bits.bit_length()
+    count = (bit_size + 63) // 64
+    words = int_to_words(bits, count)
+
+    out = array.array("Q")
+    rlw = 0
+    i = 0
+    while i < count or not out:
+        rlw = len(out)
+        out.append(0)
+
+        # A run of all-0 or all-1 words...
+        run = 0
+        running_bit = 0
+        if i < count and words[i] in (0, WORD_ONES):
+            clean = words[i]
+            running_bit = 1 if clean else 0
+            while i < count and words[i] == clean and run < RLW_RUNNING_LEN_MAX:
+                run += 1
+                i += 1
+
+        # ...followed by literal words
+        start = i
+        while i < count and words[i] not in (0, WORD_ONES) and i - start < RLW_LITERAL_MAX:
+            i += 1
+        out[rlw] = running_bit | (run << 1) | ((i - start) << 33)
+        out.extend(words[start:i])
+
+    if sys.byteorder == "little":
+        out.byteswap()
+    return struct.pack(">LL", bit_size, len(out)) + out.tobytes() + struct.pack(">L", rlw)
+
+def bits_positions(bits):
+    """Yield the positions of the set bits of bits, in order."""
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    for i, byte in enumerate(data):
+        while byte:
+            low = byte & -byte
+            yield 8 * i + low.bit_length() - 1
+            byte ^= low
+
+def bits_count(bits):
+    return bin(bits).count("1")
+
+class GitBitmap(object):
+    """A pack's reachability bitmap file (.bitmap).
+
+It holds, for a selection of commits, the set of objects reachable from
+each as a bitmap over the objects of the pack in pack order, plus one
+bitmap per object type.  Bitmaps are decoded into Python ints on
+demand, so that set operations are single bitwise operations."""
+
+    def __init__(self, pack, path):
+        self.pack = pack
+        self.path = path
+        self.map = m = GitPack.map_file(path)
+
+        signature, version, options, count, checksum = HEADER.unpack_from(m, 0)
+        if signature != SIGNATURE or version != VERSION:
+            raise Exception("Unsupported bitmap {0}".format(path))
+        if not options & OPT_FULL_DAG:
+            raise Exception("Bitmap {0} doesn't cover the full DAG".format(path))
+        if checksum != pack.map[-20:]:
+            raise Exception("Bitmap {0} doesn't match its pack".format(path))
+
+        pos = HEADER.size
+        self.types = dict()
+        for fmt in TYPE_ORDER:
+            self.types[fmt], pos = ewah_decode(m, pos)
+
+        # Entries are only located now; their bitmaps are decoded when
+        # first asked for.
+        self.entries = list()
+        self.commits = dict()
+        for n in range(count):
+            index_pos, xor_offset, flags = struct.unpack_from(">LBB", m, pos)
+            if xor_offset > MAX_XOR_OFFSET or xor_offset > n:
+                raise Exception("Bad XOR offset in bitmap {0}".format(path))
+            bit_size, buffer_size = struct.unpack_from(">LL", m, pos + 6)
+            self.entries.append((pos + 6, xor_offset))
+            self.commits[pack.index.sha(index_pos)] = n
+            pos += 6 + 8 + 8 * buffer_size + 4
+        self.decoded = dict()
+
+        self.name_hashes = None
+        if options & OPT_HASH_CACHE:
+            self.name_hashes = pos
+
+    def __len__(self):
+        return len(self.entries)
+
+    def entry(self, n):
+        """The bitmap of the n-th entry.  An entry may be stored XORed with
+        an earlier one, which may itself be XORed, and so on."""
+        chain = list()
+        while n not in self.decoded:
+            chain.append(n)
+            xor_offset = self.entries[n][1]
+            if not xor_offset:
+                break
+            n -= xor_offset
+
+        bits = self.decoded.get(n, 0)
+        for n in reversed(chain):
+            bits ^= ewah_decode(self.map, self.entries[n][0])[0]
+            self.decoded[n] = bits
+        return bits
+
+    def commit(self, binsha):
+        """Return the bitmap of objects reachable from commit binsha, or
+        None if that commit has no bitmap."""
+        n = self.commits.get(binsha)
+        return None if n is None else self.entry(n)
+
+    def name_hash(self, pos):
+        """The name hash of the object at pack order position pos, or 0."""
+        if self.name_hashes is None:
+            return 0
+        i = self.pack.order()[pos]
+        return struct.unpack_from(">L", self.map, self.name_hashes + 4 * i)[0]
+
+def bitmap_serialize(pack, types, commits, name_hashes=None):
+    """Serialize a bitmap for pack.  types maps each type (b'commit'...) to
+    the bitmap of the objects of that type; commits maps binary commit shas
+    to the bitmap of the objects they reach.  name_hashes, if given, holds
+    each object's name hash in index order."""
+    options = OPT_FULL_DAG | (OPT_HASH_CACHE if name_hashes is not None else 0)
+    out = [ HEADER.pack(SIGNATURE, VERSION, options, len(commits), pack.map[-20:]) ]
+    out.extend(ewah_encode(types[fmt]) for fmt in TYPE_ORDER)
+    for binsha in sorted(commits, key=pack.index.find):
+        out.append(struct.pack(">LBB", pack.index.find(binsha), 0, 0))
+        out.append(ewah_encode(commits[binsha]))
+    if name_hashes is not None:
+        out.append(struct.pack(">{0}L".format(len(name_hashes)), *name_hashes))
+
+    data = b''.join(out)
+    return data + hashlib.sha1(data).digest()
+
+def bitmap_path(pack):
+    return pack.path[:-5] + ".bitmap"
+
+def pack_bitmap(repo):
+    """Return the GitBitmap of the first pack of repo that has one, or None.
+    Like git, we only ever use one."""
+    for pack in GitPack.pack_list(repo):
+        if pack.bitmap is False:
+            path = bitmap_path(pack)
+            pack.bitmap = GitBitmap(pack, path) if os.path.exists(path) else None
+        if pack.bitmap is not None:
+            return pack.bitmap
+    return None
@@ -1,67 +1,126 @@
 import os
-import configparser
 import GitRepository
-import zlib
-import hashlib
-import GitObject
+import array
 import collections
+import itertools
 import re
+import stat
 
-def repo_create(path):
+# Size of the pieces large objects are hashed, deflated and inflated in.
+STREAM_CHUNK = 1024 * 1024
+
+def repo_create(path, object_store=None):
     """Create a new repository at path."""
 
-    return GitRepository.GitRepository(path)
+    repo = GitRepository.GitRepository(path, create=True, object_store=object_store)
+
+    # Directories under path now belong to the new repository.
+    root = os.path.realpath(path)
+    for d in [ d for d in repo_cache if d == root or d.startswith(root + os.sep) ]:
+        del repo_cache[d]
+
+    return repo
+
+# Repositories already found, by the real path of every directory we
+# looked them up from.  A process only ever sees a handful, and handing back
+# the same GitRepository keeps its caches warm.
+repo_cache = dict()
 
 def repo_find(path=".", required=True):
-    # @FIXME: memoize this (except for ".")
     realPath = os.path.realpath(path)
 
-    if os.path.isdir(os.path.join(realPath, ".git")):
-        return GitRepository.GitRepository(realPath)
+    # Walk up to the first directory holding a .git, remembering the
+    # directories on the way so they hit the cache next time.
+    seen = list()
+    cur = realPath
+    while True:
+        repo = repo_cache.get(cur)
+        if repo is not None:
+            break
 
-    # If we haven't returned, recurse to parent
-    parent = os.path.realpath(os.path.join(realPath, ".."))
+        seen.append(cur)
+        if os.path.isdir(os.path.join(cur, ".git")):
+            repo = GitRepository.GitRepository(cur)
+            break
 
-    if parent == realPath:
-        # Bottom case
-        # os.path.join("/", "..") == "/":
-        # If parent==path, then path is root.
-        if required:
-            raise Exception("No git directory found in %s hierarchy" % path)
-        else:
-            return None
+        parent = os.path.dirname(cur)
+        if parent == cur:
+            # Bottom case: cur is the root.  We don't remember failures,
+            # a repository may be created there later.
+            if required:
+                raise Exception("No git directory found in %s hierarchy" % path)
+            else:
+                return None
+        cur = parent
 
-    return repo_find(parent, required)
+    for d in seen:
+        repo_cache[d] = repo
+    return repo
 
 def object_read(repo, sha):
     """Read object object_id from Git repository repo.  Return a
-    GitObject whose exact type depends on the object."""
+    GitObject whose exact type depends on the object.
 
-    path = repo.repo_file("objects", sha[0:2], sha[2:])
+    Parsed objects are cached per repository, so callers must not
+    modify the returned object in place."""
+    import GitObject
 
-    with open (path, "rb") as f:
-        raw = zlib.decompress(f.read())
+    obj = repo.object_cache.get(sha)
+    if obj is not None:
+        return obj
 
-        # Read object type
-        x = raw.find(b' ')
-        fmt = raw[0:x]
+    fmt, data = object_read_raw(repo, sha)
 
-        # Read and validate object size
-        y = raw.find(b'\x00', x)
-        size = int(raw[x:y].decode("ascii"))
-        if size != len(raw)-y-1:
-            raise Exception("Malformed object {0}: bad length".format(sha))
+    # Pick constructor
+    if   fmt==b'commit' : c=GitObject.GitCommit
+    elif fmt==b'tree'   : c=GitObject.GitTree
+    elif fmt==b'tag'    : c=GitObject.GitTag
+    elif fmt==b'blob'   : c=GitObject.GitBlob
+    else:
+        raise Exception("Unknown type {0} for object {1}".format(fmt.decode("ascii"), sha))
 
-        # Pick constructor
-        if   fmt==b'commit' : c=GitObject.GitCommit
-        elif fmt==b'tree'   : c=GitObject.GitTree
-        elif fmt==b'tag'    : c=GitObject.GitTag
-        elif fmt==b'blob'   : c=GitObject.GitBlob
-        else:
-            raise Exception("Unknown type {0} for object {1}".format(fmt.decode("ascii"), sha))
+    # Call constructor, cache and return object
+    obj = c(repo, data)
+    repo.object_cache.put(sha, obj, len(data))
+    return obj
+
+def object_read_raw(repo, sha):
+    """Read object sha from repo's object database.  Return a (fmt, data)
+    tuple."""
+
+    ret = repo.raw_cache.get(sha)
+    if ret is not None:
+        return ret
 
-        # Call constructor and return object
-        return c(repo, raw[y+1:])
+    ret = repo.odb.read(sha)
+
+    if ret is None:
+        # Someone may have repacked behind our back
+        repo.odb.refresh()
+        ret = repo.odb.read(sha)
+
+    if ret is None:
+        raise Exception("No such object {0}".format(sha))
+
+    repo.raw_cache.put(sha, ret, len(ret[1]))
+    return ret
+
+def object_info(repo, sha):
+    """Return (fmt, size) of object sha, reading only the pack entry
+    header or the first inflated bytes of the loose object."""
+
+    ret = repo.raw_cache.get(sha)
+    if ret is not None:
+        return ret[0], len(ret[1])
+
+    ret = repo.odb.info(sha)
+    if ret is None:
+        repo.odb.refresh()
+        ret = repo.odb.info(sha)
+
+    if ret is None:
+        raise Exception("No such object {0}".format(sha))
+    return ret
 
 def object_find(repo, name, fmt=None, follow=True):
     sha = object_resolve(repo, name)
@@ -77,23 +136,49 @@ def object_find(repo, name, fmt=None, follow=True):
     if not fmt:
         return sha
 
+    import GitCommitGraph
+    import GitRefStore
+    graph = GitCommitGraph.commit_graph(repo)
+
     while True:
-        obj = object_read(repo, sha)
-        if obj.fmt == fmt:
+        # Commits in the commit-graph can be told apart, and their tree
+        # found, without reading them.
+        pos = graph.find(sha) if graph else None
+        if pos is not None:
+            if fmt == b'commit':
+                return sha
+            elif fmt == b'tree' and follow:
+                return graph.entry(pos)[0]
+            return None
+
+        # Check the type from the header only, we don't want to inflate a
+        # whole blob to learn it's a blob.
+        obj_fmt = object_info(repo, sha)[0]
+        if obj_fmt == fmt:
             return sha
+
+        # packed-refs may tell us what a tag peels to
+        if obj_fmt == b'tag' and follow:
+            peeled = GitRefStore.ref_store(repo).peeled(sha)
+            if peeled:
+                sha = peeled
+                continue
+
+        obj = object_read(repo, sha)
         
         if not follow:
             return None
         
         # Follow tags
         if obj.fmt == b'tag':
-            sha = obj.kvlm[b'object'].decode("ascii")
+            sha = obj.header(b'object')[0].decode("ascii")
         elif obj.fmt == b'commit' and fmt == b'tree':
-            sha = obj.kvlm[b'tree'].decode("ascii")
+            sha = obj.header(b'tree')[0].decode("ascii")
         else:
             return None
 
 def object_write(obj, actually_write=True):
+    import hashlib
     # Serialize object data
     data = obj.serialize()
     # Add header
@@ -101,17 +186,25 @@ def object_write(obj, actually_write=True):
     # Compute hash
     sha = hashlib.sha1(result).hexdigest()
 
-    if actually_write:
-        # Compute path
-        path = obj.repo.repo_file("objects", sha[0:2], sha[2:], mkdir=actually_write)
-
-        with open(path, 'wb') as f:
-            # Compress and write
-            f.write(zlib.compress(result))
+    if actually_write and not object_exists(obj.repo, sha):
+        obj.repo.odb.write(sha, obj.fmt, data)
 
     return sha
-    
+
+def object_exists(repo, sha):
+    """Whether object sha is in repo's object database."""
+    return repo.odb.contains(sha)
+
 def object_hash(fd, fmt, repo=None):
+    import GitObject
+    # Large blobs don't need parsing, so we can hash (and write) them
+    # without ever holding the whole file in memory.  Smaller ones are
+    # hashed first so that we don't compress those we already have.
+    if fmt == b'blob':
+        st = os.fstat(fd.fileno())
+        if stat.S_ISREG(st.st_mode) and st.st_size > STREAM_CHUNK:
+            return object_hash_stream(fd, fmt, st.st_size, repo)
+
     data = fd.read()
 
     # Choose constructor depending on
@@ -125,29 +218,958 @@ def object_hash(fd, fmt, repo=None):
 
     return object_write(obj, repo)
 
-def ref_resolve(repo, ref):
-    with open(repo.repo_file(ref), 'r') as fp:
-        data = fp.read()[:-1]
-        # Drop final \n ^^^^^
-    if data.startswith("ref: "):
-        return ref_resolve(repo, data[5:])
+def object_hash_bytes(data, fmt):
+    """Compute the sha of data as an object of type fmt, without parsing
+    or writing it."""
+    import hashlib
+    return hashlib.sha1(fmt + b' ' + str(len(data)).encode() + b'\x00' + data).hexdigest()
+
+def object_hash_stream(fd, fmt, size, repo=None):
+    """Hash size bytes read from fd as an object of type fmt, reading and
+    hashing STREAM_CHUNK bytes at a time.  If repo is given, the object is
+    written to it, deflated as it's read if the object store can.  Return
+    the object's sha."""
+    import GitObjectDatabase
+    import hashlib
+
+    def chunks():
+        count = 0
+        for chunk in iter(lambda: fd.read(STREAM_CHUNK), b''):
+            count += len(chunk)
+            yield chunk
+        if count != size:
+            raise Exception("File changed size while being hashed: expected {0} bytes, read {1}".format(size, count))
+
+    if repo:
+        return repo.odb.write_stream(fmt, size, chunks())
+
+    h = hashlib.sha1(GitObjectDatabase.object_header(fmt, size))
+    for chunk in chunks():
+        h.update(chunk)
+    return h.hexdigest()
+
+def object_stream(repo, sha):
+    """Open object sha for streaming.  Return (fmt, size, chunks), chunks
+    being an iterator over the object's data.
+
+    Loose objects and objects stored whole in a pack are inflated
+    incrementally, so memory use is bounded whatever their size.  Others
+    are read whole."""
+
+    ret = repo.odb.stream(sha)
+    if ret is not None:
+        return ret
+
+    fmt, data = object_read_raw(repo, sha)
+    return fmt, len(data), iter([data])
+
+def tree_walk(repo, sha, prefix=b''):
+    """Yield (path, mode, sha) for every non-tree entry reachable from
+    tree sha, path being relative to the tree (and prefixed with prefix).
+    mode is an integer."""
+    stack = [ (sha, prefix) ]
+    while stack:
+        sha, prefix = stack.pop()
+        for item in object_read(repo, sha):
+            path = prefix + item.path
+            mode = int(item.mode, 8)
+            if stat.S_ISDIR(mode):
+                stack.append((item.sha, path + b'/'))
+            else:
+                yield path, mode, item.sha
+
+def tree_lookup(repo, sha, path):
+    """Find path (a / separated str or bytes) in tree sha.  Return the
+    GitTreeLeaf, or None if there's no such path.  Only the trees along
+    the path are read, and each is searched without parsing its other
+    entries."""
+    if type(path) == str:
+        path = path.encode("utf8")
+
+    names = [ n for n in path.split(b'/') if n ]
+    if not names:
+        return None
+
+    leaf = None
+    for name in names:
+        if leaf is not None:
+            if not leaf.is_tree():
+                return None
+            sha = leaf.sha
+        leaf = object_read(repo, sha).entry(name)
+        if leaf is None:
+            return None
+    return leaf
+
+def tree_diff_level(repo, a, b):
+    """Merge-walk the entries of trees a and b (hex shas, or None for no
+    tree) in git's order, yielding (old, new) GitTreeLeaf pairs that
+    differ, old or new being None when the entry is only on one side."""
+    ia = iter(object_read(repo, a)) if a else iter(())
+    ib = iter(object_read(repo, b)) if b else iter(())
+    x = next(ia, None)
+    y = next(ib, None)
+    while x is not None or y is not None:
+        kx = x.sort_key() if x is not None else None
+        ky = y.sort_key() if y is not None else None
+        if y is None or (x is not None and kx < ky):
+            yield x, None
+            x = next(ia, None)
+        elif x is None or ky < kx:
+            yield None, y
+            y = next(ib, None)
+        else:
+            if x.binsha != y.binsha or x.mode != y.mode:
+                yield x, y
+            x = next(ia, None)
+            y = next(ib, None)
+
+def tree_diff(repo, a, b, recursive=True):
+    """Compare trees a and b (hex shas, either may be None).  Yield
+    (path, old_mode, new_mode, old_sha, new_sha, status) for every entry
+    that differs, in git's order.  Modes are ints, 0 (and the sha None)
+    on the side an entry is missing from; status is A, D, M or T (type
+    change), like git diff-tree's.
+
+    Entries with the same sha on both sides, subtrees included, are
+    skipped without being read, so the cost depends on how deep the
+    changes are, not on the size of the trees.  With recursive, changed
+    subtrees are descended into rather than reported."""
+    # A stack of (path prefix, changes iterator), like ls-tree's
+    stack = [ (b'', tree_diff_level(repo, a, b)) ]
+    while stack:
+        prefix, changes = stack[-1]
+        change = next(changes, None)
+        if change is None:
+            stack.pop()
+            continue
+
+        old, new = change
+        path = prefix + (old or new).path
+        if recursive and (old or new).is_tree():
+            # Both sides are trees if both are there: a file and a tree
+            # of the same name don't sort the same.
+            stack.append((path + b'/', tree_diff_level(repo, old and old.sha, new and new.sha)))
+            continue
+
+        old_mode = int(old.mode, 8) if old else 0
+        new_mode = int(new.mode, 8) if new else 0
+        if not old:
+            status = "A"
+        elif not new:
+            status = "D"
+        elif stat.S_IFMT(old_mode) != stat.S_IFMT(new_mode):
+            status = "T"
+        else:
+            status = "M"
+        yield path, old_mode, new_mode, old and old.sha, new and new.sha, status
+
+def commit_parents(commit):
+    """Return the list of commit's parents, as hex strings."""
+    return [ p.decode("ascii") for p in commit.header(b'parent') ]
+
+def commit_date(commit):
+    """Return commit's committer date, as a unix timestamp."""
+    # b'Name <email> 1262307723 +0100'
+    return int(commit.header(b'committer')[0].rsplit(b' ', 2)[1])
+
+def commit_info(repo, sha):
+    """Return (date, parents, generation) for commit sha, parents being
+    hex shas.  Taken from the commit-graph when sha is in it, read from
+    the commit otherwise, in which case generation is infinite."""
+    import GitCommitGraph
+    graph = GitCommitGraph.commit_graph(repo)
+    pos = graph.find(sha) if graph else None
+    if pos is not None:
+        tree, parents, generation, date = graph.entry(pos)
+        return date, [ graph.sha(p) for p in parents ], generation
+
+    commit = object_read(repo, sha)
+    if commit.fmt != b'commit':
+        raise Exception("Not a commit {0}".format(sha))
+    return commit_date(commit), commit_parents(commit), GitCommitGraph.GENERATION_INFINITY
+
+def rev_walk(repo, starts, max_count=None, since=None, sort=None, paths=None):
+    """Walk history from the commits in starts (hex shas), newest
+    committer date first.  Yield (sha, parents) lazily.  Parents come
+    from the commit-graph when there is one, so callers that need more
+    than that have to read the commit themselves.
+
+    max_count stops after that many commits, since (a unix timestamp)
+    stops at the first commit older than it.  sort can be "topo" or
+    "date", like git's --topo-order and --date-order: no commit is shown
+    before all of its children, and lines of history are either kept
+    together or interleaved by date.  Both need the whole history to be
+    read before the first commit comes out.  paths limits history to the
+    commits that change them, see rev_walk_paths."""
+
+    if paths:
+        if sort:
+            raise Exception("Paths can't be combined with --topo-order or --date-order")
+        walk = rev_walk_paths(repo, starts, paths, since)
+    elif sort:
+        walk = rev_walk_sorted(repo, starts, since, sort)
     else:
-        return data
+        walk = rev_walk_date(repo, starts, since)
 
-def ref_list(repo, path=None):
-    if not path:
-        path = repo.repo_dir("refs")
-    ret = collections.OrderedDict()
-    # Git shows refs sorted. To do the same, we use an OrderedDict and sort the output of listdir
-    for f in sorted(os.listdir(path)):
-        can = os.path.join(path, f)
-        if os.path.isdir(can):
-            ret[f] = ref_list(repo, can)
+    if max_count is None:
+        yield from walk
+        return
+
+    for n, ret in enumerate(walk):
+        if n >= max_count:
+            return
+        yield ret
+
+def rev_walk_date(repo, starts, since=None):
+    import heapq
+    # Priority queue ordered on (-date, insertion order), so that the
+    # newest commit is always popped first and ties keep a stable order.
+    queue = list()
+    seen = set()
+    counter = itertools.count()
+
+    def push(sha):
+        if sha in seen:
+            return
+        seen.add(sha)
+        date, parents, _ = commit_info(repo, sha)
+        heapq.heappush(queue, (-date, next(counter), sha, parents))
+
+    for sha in starts:
+        push(sha)
+
+    while queue:
+        date, _, sha, parents = heapq.heappop(queue)
+        if since is not None and -date < since:
+            # Everything left in the queue is older still.
+            return
+        yield sha, parents
+        for p in parents:
+            push(p)
+
+def rev_walk_paths(repo, starts, paths, since=None):
+    """Walk history like rev_walk_date, but only yield the commits that
+    change something under paths (a list of / separated bytes), with
+    git's default history simplification: a commit that is the same as
+    one of its parents under paths isn't shown, and only that parent is
+    followed.
+
+    Comparing a commit with its first parent starts with its Bloom filter
+    from the commit-graph, if it has one: when the filter says none of
+    paths changed, no tree needs to be read."""
+    import GitCommitGraph
+    import heapq
+    paths = [ p.strip(b'/') for p in paths ]
+    graph = GitCommitGraph.commit_graph(repo)
+    keys = None
+    if graph and graph.bloom_version is not None and all(paths):
+        # A path may have changed only if it and all its leading
+        # directories are in the filter.
+        keys = [ [ GitCommitGraph.bloom_key(p, graph.bloom_version) for p in GitCommitGraph.bloom_paths([ path ]) ]
+                 for path in paths ]
+
+    def entries(tree):
+        ret = list()
+        for path in paths:
+            leaf = tree_lookup(repo, tree, path) if path else None
+            ret.append((leaf.mode, leaf.binsha) if leaf else (tree if not path else None))
+        return ret
+
+    def same(sha, tree, n, parent):
+        if n == 0 and keys is not None:
+            pos = graph.find(sha)
+            data = graph.bloom(pos) if pos is not None else None
+            if data is not None and not any(GitCommitGraph.bloom_maybe(data, k) for k in keys):
+                return True
+        parent_tree = commit_tree(repo, parent)
+        return tree == parent_tree or entries(tree) == entries(parent_tree)
+
+    queue = list()
+    seen = set()
+    counter = itertools.count()
+
+    def push(sha):
+        if sha in seen:
+            return
+        seen.add(sha)
+        date, parents, _ = commit_info(repo, sha)
+        heapq.heappush(queue, (-date, next(counter), sha, parents))
+
+    for sha in starts:
+        push(sha)
+
+    while queue:
+        date, _, sha, parents = heapq.heappop(queue)
+        if since is not None and -date < since:
+            return
+        tree = commit_tree(repo, sha)
+
+        if not parents:
+            # A root commit adds whatever is there
+            if any(e is not None for e in entries(tree)):
+                yield sha, parents
+            continue
+
+        for n, p in enumerate(parents):
+            if same(sha, tree, n, p):
+                push(p)
+                break
+        else:
+            yield sha, parents
+            for p in parents:
+                push(p)
+
+def rev_walk_sorted(repo, starts, since=None, sort="topo"):
+    import heapq
+    # Read the whole graph first, counting how many children each commit
+    # has, then emit commits whose children have all been shown (Kahn's
+    # algorithm).  Like git, "topo" picks the next one from a stack so
+    # that we follow one line of history as long as we can, "date" picks
+    # the newest.
+    commits = collections.OrderedDict()
+    children = collections.Counter()
+    for sha, parents in rev_walk_date(repo, starts, since):
+        commits[sha] = parents
+        for p in parents:
+            children[p] += 1
+
+    counter = itertools.count()
+    ready = list()
+
+    def push(sha):
+        if sort == "date":
+            heapq.heappush(ready, (-commit_info(repo, sha)[0], next(counter), sha))
+        else:
+            ready.append(sha)
+
+    def pop():
+        if sort == "date":
+            return heapq.heappop(ready)[2]
+        return ready.pop()
+
+    # commits is in date order; tips go on the stack newest last so that
+    # they come out newest first.
+    for sha in reversed(commits) if sort != "date" else commits:
+        if children[sha] == 0:
+            push(sha)
+
+    while ready:
+        sha = pop()
+        parents = commits.pop(sha)
+        yield sha, parents
+        for p in parents:
+            children[p] -= 1
+            if children[p] == 0 and p in commits:
+                push(p)
+
+def is_ancestor(repo, ancestor, sha):
+    """Whether commit ancestor is reachable from commit sha.  Generation
+    numbers from the commit-graph let us skip every commit that is too
+    old to lead to ancestor."""
+    import GitCommitGraph
+    _, _, min_generation = commit_info(repo, ancestor)
+    if min_generation == GitCommitGraph.GENERATION_INFINITY:
+        min_generation = 0
+
+    seen = set()
+    stack = [ sha ]
+    while stack:
+        cur = stack.pop()
+        if cur == ancestor:
+            return True
+        if cur in seen:
+            continue
+        seen.add(cur)
+        _, parents, generation = commit_info(repo, cur)
+        if generation <= min_generation:
+            # ancestor isn't cur, and everything below cur has a lower
+            # generation than ancestor.
+            continue
+        stack.extend(parents)
+    return False
+
+def merge_bases(repo, a, b):
+    """Return the best common ancestors of commits a and b.
+
+    We walk down from both commits, highest generation (then newest date)
+    first, painting commits with the side(s) they are reachable from.  A
+    commit reachable from both sides is a candidate; the walk stops as
+    soon as only commits below a candidate remain."""
+    import heapq
+    if a == b:
+        return [ a ]
+
+    PARENT1, PARENT2, STALE = 1, 2, 4
+    flags = collections.defaultdict(int)
+    queue = list()
+    counter = itertools.count()
+    candidates = list()
+
+    def push(sha, f):
+        date, parents, generation = commit_info(repo, sha)
+        heapq.heappush(queue, (-generation, -date, next(counter), sha, parents))
+        flags[sha] |= f
+
+    push(a, PARENT1)
+    push(b, PARENT2)
+
+    while any(not flags[entry[3]] & STALE for entry in queue):
+        _, _, _, sha, parents = heapq.heappop(queue)
+        f = flags[sha] & (PARENT1 | PARENT2 | STALE)
+        if f == PARENT1 | PARENT2:
+            if sha not in candidates:
+                candidates.append(sha)
+            f |= STALE
+            flags[sha] |= STALE
+        for p in parents:
+            if flags[p] & f == f:
+                continue
+            push(p, f)
+
+    # A candidate that is an ancestor of another isn't a best one.
+    return [ c for c in candidates
+             if not any(o != c and is_ancestor(repo, c, o) for o in candidates) ]
+
+def ref_list_flat(refs, prefix="refs"):
+    """Flatten the nested dict returned by ref_list into a list of
+    (name, sha)."""
+    ret = list()
+    for k, v in refs.items():
+        name = prefix + "/" + k
+        if type(v) == str:
+            ret.append((name, v))
         else:
-            ret[f] = ref_resolve(repo, can)
-    
+            ret.extend(ref_list_flat(v, name))
+    return ret
+
+def reachable_commits(repo):
+    """Return every commit sha reachable from HEAD and refs."""
+    starts = list()
+    for name in ref_tips(repo):
+        sha = object_find(repo, name, fmt=b'commit')
+        if sha:
+            starts.append(sha)
+    return [ sha for sha, _ in rev_walk_date(repo, starts) ]
+
+def ref_tips(repo):
+    """Return the shas HEAD and every ref point to, HEAD first."""
+    import GitRefStore
+    refs = GitRefStore.ref_store(repo)
+    # HEAD is None if unborn
+    tips = [ refs.resolve("HEAD") ] + [ sha for _, sha in refs.list() ]
+    return [ sha for sha in tips if sha is not None ]
+
+def reachable_objects(repo, starts):
+    """Yield (sha, fmt, path) for every object reachable from starts (shas
+    of any type): commits first, newest first, then tags, then trees and
+    blobs as found walking each commit's tree.  path is where a tree or
+    blob was first seen (bytes), None for other objects."""
+    seen = set()
+    commits = list()
+    tags = list()
+    # (sha, path) of trees and blobs pointed to directly
+    pending = list()
+
+    for sha in starts:
+        while sha not in seen:
+            fmt = object_info(repo, sha)[0]
+            if fmt == b'tag':
+                seen.add(sha)
+                tags.append(sha)
+                sha = object_read(repo, sha).header(b'object')[0].decode("ascii")
+            else:
+                if fmt == b'commit':
+                    commits.append(sha)
+                else:
+                    pending.append((sha, fmt))
+                break
+
+    walked = list()
+    for sha, _ in rev_walk_date(repo, commits):
+        seen.add(sha)
+        walked.append(sha)
+        yield sha, b'commit', None
+    for sha in tags:
+        yield sha, b'tag', None
+
+    roots = [ (commit_tree(repo, sha), b'tree') for sha in walked ] + pending
+    for root, fmt in roots:
+        if root in seen:
+            continue
+        seen.add(root)
+        yield root, fmt, b''
+        if fmt != b'tree':
+            continue
+
+        stack = [ (root, b'') ]
+        while stack:
+            tree, prefix = stack.pop()
+            for item in object_read(repo, tree):
+                if item.sha in seen or item.mode == b'160000':
+                    continue
+                seen.add(item.sha)
+                path = prefix + item.path
+                if item.is_tree():
+                    yield item.sha, b'tree', path
+                    stack.append((item.sha, path + b'/'))
+                else:
+                    yield item.sha, b'blob', path
+
+def commit_tree(repo, sha):
+    """Return the root tree of commit sha, from the commit-graph if
+    possible."""
+    import GitCommitGraph
+    graph = GitCommitGraph.commit_graph(repo)
+    pos = graph.find(sha) if graph else None
+    if pos is not None:
+        return graph.entry(pos)[0]
+    return object_read(repo, sha).header(b'tree')[0].decode("ascii")
+
+def objects_pack(repo, objects, path_base, window=None, depth=None):
+    """Write objects, an iterable of (sha, path) (path may be None, or
+    already a name hash), to a new pack path_base-<checksum>.pack and its
+    index.  Return the checksum."""
+    import GitPackWriter
+    writer = GitPackWriter.GitPackWriter(lambda sha: object_read_raw(repo, sha),
+                                         window=GitPackWriter.DEFAULT_WINDOW if window is None else window,
+                                         depth=GitPackWriter.DEFAULT_DEPTH if depth is None else depth)
+    for sha, path in objects:
+        if sha not in writer:
+            fmt, size = object_info(repo, sha)
+            writer.add(sha, fmt, size, path)
+    writer.find_deltas()
+    return writer.write(path_base)
+
+def reflog_shas(repo):
+    """Return the set of shas recorded in the reflogs."""
+    ret = set()
+    root = repo.repo_path("logs")
+    for dirpath, _, files in os.walk(root):
+        for f in files:
+            with open(os.path.join(dirpath, f), "rb") as fd:
+                for line in fd:
+                    for sha in line.split(b' ', 2)[:2]:
+                        if len(sha) == 40 and sha != b'0' * 40:
+                            ret.add(sha.decode("ascii"))
     return ret
 
+def repo_gc(repo, window=None, depth=None):
+    """Pack refs, then repack every object into a single pack and delete
+    the loose objects and old packs it replaces.  Return the new pack's
+    checksum, or None if there was nothing to pack.
+
+    Objects reachable from refs, reflogs and the index are packed first,
+    with their paths to guide delta selection.  Objects in the old packs
+    that nothing reaches are carried over rather than dropped, and
+    unreachable loose objects are left alone: gc never loses data.  Packs
+    with a .keep file are left as they are."""
+    import GitPack
+    import GitIndex
+    import GitBitmap
+    refs_pack(repo, all=True)
+
+    old = [ p for p in GitPack.pack_list(repo, refresh=True) if not os.path.exists(p.path[:-5] + ".keep") ]
+    kept = [ p for p in GitPack.pack_list(repo) if p not in old ]
+
+    def objects():
+        starts = ref_tips(repo) + [ sha for sha in sorted(reflog_shas(repo)) if object_exists(repo, sha) ]
+        bitmap = GitBitmap.pack_bitmap(repo)
+        if bitmap is None:
+            for sha, _, path in reachable_objects(repo, starts):
+                yield sha, path
+        else:
+            # Most of it is in the bitmapped pack already, in a good
+            # order, and its name hashes stand in for paths.
+            bits, extra = bitmap_reachable(repo, bitmap, starts)
+            for pos in GitBitmap.bits_positions(bits):
+                yield bitmap.pack.sha_at(pos).hex(), bitmap.name_hash(pos)
+            for sha in extra:
+                yield sha, None
+        for e in GitIndex.index_read(repo).entries:
+            if e.mode != 0o160000 and not e.flag_intent_to_add:
+                yield e.obj, e.name
+        for pack in old:
+            for i in range(pack.index.count):
+                yield pack.index.sha(i).hex(), None
+
+    def wanted():
+        for sha, path in objects():
+            binsha = bytes.fromhex(sha)
+            if not any(binsha in p for p in kept):
+                yield sha, path
+
+    pack_dir = repo.repo_dir("objects", "pack", mkdir=True)
+    objs = list(wanted())
+    if not objs:
+        return None
+    name = objects_pack(repo, objs, os.path.join(pack_dir, "pack"), window, depth)
+    new = os.path.join(pack_dir, "pack-{0}.pack".format(name))
+    # Nothing got dropped, so with no kept packs the new one is closed
+    if not kept:
+        pack = [ p for p in GitPack.pack_list(repo, refresh=True) if p.path == new ][0]
+        bitmap_write(repo, pack)
+
+    # Old packs are fully contained in the new one now
+    for pack in old:
+        if pack.path != new:
+            for ext in (".pack", ".idx", ".rev", ".bitmap"):
+                path = pack.path[:-5] + ext
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    # And so are the loose objects it holds
+    packs = GitPack.pack_list(repo, refresh=True)
+    for fanout in os.listdir(repo.repo_path("objects")):
+        if len(fanout) != 2:
+            continue
+        path = repo.repo_path("objects", fanout)
+        for f in os.listdir(path):
+            binsha = bytes.fromhex(fanout + f) if len(f) == 38 else None
+            if binsha and any(binsha in p for p in packs):
+                os.unlink(os.path.join(path, f))
+        if not os.listdir(path):
+            os.rmdir(path)
+    repo.odb.refresh()
+
+    return name
+
+# Like git's pack.bitmap selection, bitmaps are kept for every ref tip and,
+# along history, for about one commit in this many.
+BITMAP_STRIDE = 100
+
+def bitmap_build(repo, pack, tips):
+    """Compute the reachability bitmaps of pack for the commits in tips
+    (hex shas).  Return (types, commits, name_hashes) as
+    GitBitmap.bitmap_serialize takes them, or None if pack doesn't hold
+    everything those commits reach.
+
+    Commits are visited parents first, so that each one's bitmap starts
+    out as the union of its parents' and only the trees that aren't in
+    it yet need to be read.  A bitmap is dropped as soon as all children
+    of its commit are done, unless it's one we keep."""
+    import GitBitmap
+    import GitPackWriter
+    index = pack.index
+    positions = pack.positions()
+    count = index.count
+    nbytes = (count + 7) // 8
+
+    types = { fmt: bytearray(nbytes) for fmt in GitBitmap.TYPE_ORDER }
+    base_info = lambda sha: object_info(repo, sha)
+    for i in range(count):
+        pos = positions[i]
+        types[pack.info(index.sha(i), base_info)[0]][pos >> 3] |= 1 << (pos & 7)
+    types = { fmt: int.from_bytes(bits, "little") for fmt, bits in types.items() }
+
+    name_hashes = array.array("L", bytes(array.array("L").itemsize * count))
+
+    walk = list(rev_walk_sorted(repo, tips))
+    children = collections.Counter(p for _, parents in walk for p in parents)
+    keep = set(tips)
+    keep.update(sha for n, (sha, _) in enumerate(walk) if n % BITMAP_STRIDE == BITMAP_STRIDE - 1)
+
+    buf = None
+
+    def mark(sha, path):
+        """Set sha's bit in buf, return False if it already was."""
+        i = index.find(bytes.fromhex(sha))
+        if i is None:
+            raise KeyError(sha)
+        pos = positions[i]
+        if buf[pos >> 3] & (1 << (pos & 7)):
+            return False
+        buf[pos >> 3] |= 1 << (pos & 7)
+        if path is not None:
+            name_hashes[i] = GitPackWriter.pack_name_hash(path)
+        return True
+
+    bitmaps = dict()
+    for sha, parents in reversed(walk):
+        bits = 0
+        for p in parents:
+            bits |= bitmaps[p]
+        buf = bytearray(bits.to_bytes(nbytes, "little"))
+
+        try:
+            mark(sha, None)
+            stack = [ (commit_tree(repo, sha), b'') ]
+            while stack:
+                tree, prefix = stack.pop()
+                if not mark(tree, prefix.rstrip(b'/')):
+                    continue
+                for item in object_read(repo, tree):
+                    if item.mode == b'160000':
+                        continue
+                    path = prefix + item.path
+                    if item.is_tree():
+                        stack.append((item.sha, path + b'/'))
+                    else:
+                        mark(item.sha, path)
+        except KeyError:
+            return None
+
+        bitmaps[sha] = int.from_bytes(buf, "little")
+        for p in parents:
+            children[p] -= 1
+            if not children[p] and p not in keep:
+                del bitmaps[p]
+
+    commits = { bytes.fromhex(sha): bits for sha, bits in bitmaps.items() if sha in keep }
+    return types, commits, name_hashes
+
+def bitmap_write(repo, pack):
+    """Write the .bitmap of pack, for the commits our refs point to.
+    Return whether we could: pack must hold everything they reach."""
+    import GitBitmap
+    tips = list()
+    for sha in ref_tips(repo):
+        sha = object_find(repo, sha, fmt=b'commit')
+        if sha and sha not in tips:
+            tips.append(sha)
+
+    ret = bitmap_build(repo, pack, tips)
+    if ret is None:
+        return False
+
+    path = GitBitmap.bitmap_path(pack)
+    tmp = os.path.join(os.path.dirname(path), "tmp_bitmap_{0}".format(os.getpid()))
+    try:
+        with open(tmp, "wb") as f:
+            f.write(GitBitmap.bitmap_serialize(pack, *ret))
+        os.chmod(tmp, 0o444)
+        os.replace(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    pack.bitmap = False
+    return True
+
+def bitmap_reachable(repo, bitmap, starts):
+    """Find every object reachable from starts (hex shas of any type)
+    with the help of bitmap.  Return (bits, extra): bits has a bit set
+    for each such object in bitmap's pack, extra maps the hex shas of
+    those outside of it to their type.
+
+    Commits with a bitmap aren't walked at all.  The others are walked
+    down to a commit with a bitmap, or one whose bit is already set;
+    then their trees are walked, skipping whatever is already set."""
+    pack = bitmap.pack
+    index = pack.index
+    positions = pack.positions()
+    nbytes = (index.count + 7) // 8
+
+    bits = 0
+    seen = set()
+    commits = list()
+    others = list()
+    stack = list(starts)
+    while stack:
+        sha = stack.pop()
+        if sha in seen:
+            continue
+        seen.add(sha)
+        binsha = bytes.fromhex(sha)
+        commit_bits = bitmap.commit(binsha)
+        if commit_bits is not None:
+            bits |= commit_bits
+            continue
+        i = index.find(binsha)
+        if i is not None and bits >> positions[i] & 1:
+            continue
+
+        fmt = object_info(repo, sha)[0]
+        if fmt == b'commit':
+            commits.append(sha)
+            stack.extend(commit_info(repo, sha)[1])
+        elif fmt == b'tag':
+            others.append((sha, fmt))
+            stack.append(object_read(repo, sha).header(b'object')[0].decode("ascii"))
+        else:
+            others.append((sha, fmt))
+
+    buf = bytearray(bits.to_bytes(nbytes, "little"))
+    extra = dict()
+
+    def mark(sha, fmt):
+        """Set sha's bit, return False if it already was."""
+        i = index.find(bytes.fromhex(sha))
+        if i is None:
+            if sha in extra:
+                return False
+            extra[sha] = fmt
+            return True
+        pos = positions[i]
+        if buf[pos >> 3] & (1 << (pos & 7)):
+            return False
+        buf[pos >> 3] |= 1 << (pos & 7)
+        return True
+
+    roots = list()
+    for sha in commits:
+        mark(sha, b'commit')
+        roots.append(commit_tree(repo, sha))
+    for sha, fmt in others:
+        if fmt == b'tree':
+            roots.append(sha)
+        else:
+            mark(sha, fmt)
+
+    for root in roots:
+        stack = [ root ]
+        while stack:
+            tree = stack.pop()
+            if not mark(tree, b'tree'):
+                continue
+            for item in object_read(repo, tree):
+                if item.mode == b'160000':
+                    continue
+                if item.is_tree():
+                    stack.append(item.sha)
+                else:
+                    mark(item.sha, b'blob')
+
+    return int.from_bytes(buf, "little"), extra
+
+def objects_reachable(repo, include, exclude=(), use_bitmap=True):
+    """Find the objects reachable from include but not from exclude (hex
+    shas of any type).  Return (bitmap, bits, extra): when repo has a
+    bitmap (and use_bitmap is set), bits has a bit set for each of them
+    in the bitmap's pack and extra maps the others to their type.
+    Otherwise bitmap and bits are None and extra holds them all."""
+    import GitBitmap
+    bitmap = GitBitmap.pack_bitmap(repo) if use_bitmap else None
+    if bitmap is not None:
+        bits, extra = bitmap_reachable(repo, bitmap, include)
+        if exclude:
+            not_bits, not_extra = bitmap_reachable(repo, bitmap, exclude)
+            bits &= ~not_bits
+            extra = { sha: fmt for sha, fmt in extra.items() if sha not in not_extra }
+        return bitmap, bits, extra
+
+    extra = { sha: fmt for sha, fmt, _ in reachable_objects(repo, include) }
+    if exclude:
+        for sha, _, _ in reachable_objects(repo, exclude):
+            extra.pop(sha, None)
+    return None, None, extra
+
+def commit_graph_write(repo, changed_paths=None):
+    """Write a commit-graph with every reachable commit, reading them
+    from the object database.
+
+    With changed_paths, commits get changed-path Bloom filters too; if
+    None, only when the commit-graph we replace has them.  Filters found
+    there are reused, so that each is only computed once."""
+    import GitCommitGraph
+    old = GitCommitGraph.commit_graph(repo)
+    if changed_paths is None:
+        changed_paths = old is not None and old.bloom_version is not None
+
+    commits = dict()
+    # Ignore the commit-graph we're replacing
+    repo.commit_graph = False
+    for sha in reachable_commits(repo):
+        commit = object_read(repo, sha)
+        commits[sha] = (commit.header(b'tree')[0].decode("ascii"), commit_parents(commit), commit_date(commit))
+
+    blooms = None
+    if changed_paths:
+        reuse = old if old is not None and old.bloom_version == GitCommitGraph.BLOOM_HASH_VERSION else None
+        blooms = dict()
+        for sha, (tree, parents, _) in commits.items():
+            pos = reuse.find(sha) if reuse else None
+            data = reuse.bloom(pos) if pos is not None else None
+            if data is None:
+                data = commit_bloom(repo, tree, commits[parents[0]][0] if parents else None)
+            blooms[sha] = bytes(data)
+
+    GitCommitGraph.commit_graph_write(repo, commits, blooms)
+    return len(commits)
+
+def commit_bloom(repo, tree, parent_tree):
+    """Compute the changed-path Bloom filter of a commit, from its tree and
+    its first parent's (None for a root commit)."""
+    import GitCommitGraph
+    limit = GitCommitGraph.BLOOM_MAX_CHANGED_PATHS
+    changes = list(itertools.islice(tree_diff(repo, parent_tree, tree), limit + 1))
+    if len(changes) > limit:
+        return GitCommitGraph.bloom_filter(None)
+    return GitCommitGraph.bloom_filter([ c[0] for c in changes ])
+
+def ref_resolve(repo, ref):
+    """Return the sha ref (eg HEAD or refs/heads/master) points to, following
+    symbolic refs, or None if it doesn't exist."""
+    import GitRefStore
+    return GitRefStore.ref_store(repo).resolve(ref)
+
+def ref_list(repo):
+    """Return the refs under refs/ as nested OrderedDicts, one level per path
+    component, eg ret["heads"]["master"] = sha.  Git shows refs sorted, and
+    so are these."""
+    import GitRefStore
+    ret = collections.OrderedDict()
+    for name, sha in GitRefStore.ref_store(repo).list():
+        parts = name.split("/")[1:]
+        d = ret
+        for p in parts[:-1]:
+            d = d.setdefault(p, collections.OrderedDict())
+        d[parts[-1]] = sha
+    return ret
+
+def ref_peel(repo, sha):
+    """If sha is a tag, return the first object down its chain of tags that
+    isn't one.  Otherwise return None."""
+    import GitRefStore
+    peeled = GitRefStore.ref_store(repo).peeled(sha)
+    if peeled:
+        return peeled
+
+    target = sha
+    while object_info(repo, target)[0] == b'tag':
+        target = object_read(repo, target).header(b'object')[0].decode("ascii")
+    return target if target != sha else None
+
+def refs_pack(repo, all=False, prune=True):
+    """Move loose refs into packed-refs, like git pack-refs.  Only tags are
+    packed unless all is set; symbolic refs never are.  With prune, the
+    packed loose refs are deleted.  Return the number of refs packed."""
+    import GitRefStore
+    store = GitRefStore.ref_store(repo)
+    packed, peeled = store.packed_refs()
+    refs = dict(packed)
+    peeled = dict(peeled)
+
+    loose = dict()
+    for name in store.loose_names():
+        value = store.read_loose(name)
+        if value is None or value.startswith("ref: "):
+            continue
+        if all or name.startswith("refs/tags/"):
+            loose[name] = value
+
+    for name, sha in loose.items():
+        refs[name] = sha
+        peeled.pop(name, None)
+
+    # Record what tags peel to, so readers don't have to open them.
+    for name, sha in refs.items():
+        if name not in peeled:
+            target = ref_peel(repo, sha)
+            if target:
+                peeled[name] = target
+
+    store.write_packed(refs, peeled)
+
+    if prune:
+        for name, sha in loose.items():
+            store.delete_loose(name, sha)
+
+    return len(loose)
+
+HASH_RE = re.compile(r"^[0-9A-Fa-f]{40}$")
+SMALL_HASH_RE = re.compile(r"^[0-9A-Fa-f]{4,39}$")
+
 def object_resolve(repo, name):
     """Resolve name to an object hash in repo.
 
@@ -158,29 +1180,80 @@ def object_resolve(repo, name):
     - tags
     - branches
     - remote branches"""
+    import GitRefStore
 
     if not name.strip():
         return None
 
-    if name == "HEAD":
-        return [ ref_resolve(repo, "HEAD")]
+    if ":" in name:
+        # <tree-ish>:<path>
+        rev, path = name.split(":", 1)
+        if not rev:
+            # :<path> means a path in the index, which we don't do.
+            return []
+        tree = object_find(repo, rev, fmt=b'tree')
+        if not tree:
+            return []
+        if not path.strip("/"):
+            return [ tree ]
+        leaf = tree_lookup(repo, tree, path)
+        return [ leaf.sha ] if leaf else []
 
     candidates = list()
-    hashRE = re.compile(r"^[0-9A-Fa-f]{40}$")
-    smallHashRE = re.compile(r"^[0-9A-Fa-f]{4,39}$")
 
-    if hashRE.match(name):
+    if HASH_RE.match(name):
         # complete hash
         return [ name.lower() ]
-    elif smallHashRE.match(name):
+
+    # HEAD, branches, tags, remote branches: like git, a ref wins over a
+    # short hash.
+    refs = GitRefStore.ref_store(repo)
+    ref = refs.dwim(name)
+    if ref is not None:
+        sha = refs.resolve(ref)
+        return [ sha ] if sha else []
+
+    if SMALL_HASH_RE.match(name):
         # small hash, minimum length is 4 as documented in git-rev-parse
-        smallHash = name.lower()
-        prefix = smallHash[0:2]
-        path = repo.repo_dir("objects", prefix, mkdir=False)
-        if path:
-            rem = smallHash[2:]
-            for f in os.listdir(path):
-                if f.startswith(rem):
-                    candidates.append(prefix + f)
-    
-    return candidates
\ No newline at end of file
+        candidates = object_prefix_find(repo, name.lower())
+
+    return candidates
+
+# Shortest abbreviation git ever uses, and its default when the repository
+# is small.  See core.abbrev in git-config(1).
+MINIMUM_ABBREV = 4
+DEFAULT_ABBREV = 7
+
+def object_prefix_find(repo, prefix):
+    """Return the sorted hex names of every object in repo's object
+    database that starts with prefix (lowercase hex, at least 2
+    characters)."""
+    ret = repo.odb.find_prefix(prefix)
+    if not ret:
+        # Maybe a new pack appeared
+        repo.odb.refresh()
+        ret = repo.odb.find_prefix(prefix)
+    return sorted(ret)
+
+def abbrev_default(repo):
+    """The abbreviation length to start from: core.abbrev if it's a number,
+    otherwise scaled to the number of packed objects like git does (two
+    hex digits per eight bits of object count, because of the birthday
+    paradox), but no less than DEFAULT_ABBREV."""
+    import GitPack
+    conf = repo.conf.get("core", "abbrev", fallback="auto")
+    if conf.isdigit():
+        return max(MINIMUM_ABBREV, min(40, int(conf)))
+    bits = GitPack.pack_object_count(repo).bit_length()
+    return max(DEFAULT_ABBREV, (bits + 1) // 2)
+
+def object_abbrev(repo, sha, length=None):
+    """Return the shortest prefix of sha, at least length characters long
+    (default: abbrev_default), that no other object in repo starts with."""
+    length = max(MINIMUM_ABBREV, length or abbrev_default(repo))
+    while length < 40:
+        candidates = object_prefix_find(repo, sha[:length])
+        if len(candidates) <= 1:
+            break
+        length += 1
+    return sha[:length]
\ No newline at end of file
@@ -0,0 +1,320 @@
+import os
+import struct
+import hashlib
+import itertools
+import GitPack
+
+# See gitformat-commit-graph(5)
+SIGNATURE = b'CGPH'
+CHUNK_OID_FANOUT = b'OIDF'
+CHUNK_OID_LOOKUP = b'OIDL'
+CHUNK_COMMIT_DATA = b'CDAT'
+CHUNK_EXTRA_EDGES = b'EDGE'
+CHUNK_BLOOM_INDEXES = b'BIDX'
+CHUNK_BLOOM_DATA = b'BDAT'
+
+PARENT_NONE = 0x70000000
+PARENT_OCTOPUS = 0x80000000
+EDGE_LAST = 0x80000000
+
+GENERATION_MAX = 0x3FFFFFFF
+GENERATION_INFINITY = 0xFFFFFFFF
+"""Generation of commits that aren't in the commit-graph."""
+
+CDAT_ENTRY = struct.Struct(">20sLLLL")
+
+# Changed-path Bloom filters, with git's settings.  A commit's filter holds
+# every path that changed since its first parent, and their leading
+# directories; if there are more than BLOOM_MAX_CHANGED_PATHS changes, it
+# is a single byte with every bit set, and matches everything.
+BLOOM_HASH_VERSION = 1
+BLOOM_NUM_HASHES = 7
+BLOOM_BITS_PER_ENTRY = 10
+BLOOM_MAX_CHANGED_PATHS = 512
+BLOOM_SEEDS = (0x293ae76f, 0x7e646e2c)
+BLOOM_DATA_HEADER = struct.Struct(">LLL")
+
+def murmur3_32(seed, data, signed=False):
+    """MurmurHash3 (x86, 32 bits) of data.  Version 1 of git's Bloom
+    filters hashes paths with a bug we have to reproduce: bytes are read
+    as (signed) chars, so those above 0x7f get sign-extended.  That's what
+    signed does."""
+    def byte(b):
+        return (b | 0xFFFFFF00) if signed and b & 0x80 else b
+
+    h = seed
+    n = len(data) & ~3
+    for i in range(0, n, 4):
+        k = byte(data[i]) | (byte(data[i+1]) << 8) | (byte(data[i+2]) << 16) | (byte(data[i+3]) << 24)
+        k &= 0xFFFFFFFF
+        k = (k * 0xcc9e2d51) & 0xFFFFFFFF
+        k = ((k << 15) | (k >> 17)) & 0xFFFFFFFF
+        k = (k * 0x1b873593) & 0xFFFFFFFF
+        h ^= k
+        h = ((h << 13) | (h >> 19)) & 0xFFFFFFFF
+        h = (h * 5 + 0xe6546b64) & 0xFFFFFFFF
+
+    k = 0
+    tail = len(data) & 3
+    if tail:
+        for i in range(tail - 1, -1, -1):
+            k ^= byte(data[n+i]) << (8 * i)
+        k &= 0xFFFFFFFF
+        k = (k * 0xcc9e2d51) & 0xFFFFFFFF
+        k = ((k << 15) | (k >> 17)) & 0xFFFFFFFF
+        k = (k * 0x1b873593) & 0xFFFFFFFF
+        h ^= k
+
+    h ^= len(data)
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xFFFFFFFF
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xFFFFFFFF
+    h ^= h >> 16
+    return h
+
+def bloom_key(path, version=BLOOM_HASH_VERSION):
+    """The BLOOM_NUM_HASHES hashes of path (bytes) in a Bloom filter."""
+    h0 = murmur3_32(BLOOM_SEEDS[0], path, signed=version == 1)
+    h1 = murmur3_32(BLOOM_SEEDS[1], path, signed=version == 1)
+    return [ (h0 + i * h1) & 0xFFFFFFFF for i in range(BLOOM_NUM_HASHES) ]
+
+def bloom_paths(changed):
+    """The paths that go into a filter: the changed paths, and all of
+    their leading directories."""
+    ret = set()
+    for path in changed:
+        while path and path not in ret:
+            ret.add(path)
+            path = path.rpartition(b'/')[0]
+    return ret
+
+def bloom_filter(changed):
+    """Build the filter of a commit whose changes (as paths) are changed,
+    or None if there were too many of them."""
+    if changed is None:
+        return b'\xff'
+    paths = bloom_paths(changed)
+    size = max(1, (len(paths) * BLOOM_BITS_PER_ENTRY + 7) // 8)
+    data = bytearray(size)
+    for path in paths:
+        for h in bloom_key(path):
+            pos = h % (size * 8)
+            data[pos >> 3] |= 1 << (pos & 7)
+    return bytes(data)
+
+def bloom_maybe(data, keys):
+    """Whether a filter may contain all of keys.  False is definite."""
+    bits = len(data) * 8
+    for key in keys:
+        for h in key:
+            pos = h % bits
+            if not data[pos >> 3] & (1 << (pos & 7)):
+                return False
+    return True
+
+class GitCommitGraph(object):
+    """A commit-graph file, memory-mapped.
+
+Commits are designated by their position in the sorted OID table; parents
+are positions too.  This lets history walks get parents, root trees,
+dates and generation numbers without inflating any commit."""
+
+    def __init__(self, path):
+        self.path = path
+        self.map = map = GitPack.map_file(path)
+
+        signature, version, hash_version, num_chunks, num_bases = struct.unpack_from(">4sBBBB", map, 0)
+        if signature != SIGNATURE or version != 1 or hash_version != 1:
+            raise Exception("Unsupported commit-graph {0}".format(path))
+        if num_bases:
+            raise Exception("Split commit-graphs aren't supported: {0}".format(path))
+
+        self.chunks = dict()
+        for i in range(num_chunks):
+            chunk_id, offset = struct.unpack_from(">4sQ", map, 8 + 12 * i)
+            next_offset = struct.unpack_from(">Q", map, 8 + 12 * (i + 1) + 4)[0]
+            self.chunks[chunk_id] = (offset, next_offset - offset)
+
+        for required in (CHUNK_OID_FANOUT, CHUNK_OID_LOOKUP, CHUNK_COMMIT_DATA):
+            if required not in self.chunks:
+                raise Exception("commit-graph {0} lacks a {1} chunk".format(path, required.decode("ascii")))
+
+        self.fanout = struct.unpack_from(">256L", map, self.chunks[CHUNK_OID_FANOUT][0])
+        self.count = self.fanout[255]
+        self.oid_table = self.chunks[CHUNK_OID_LOOKUP][0]
+        self.data_table = self.chunks[CHUNK_COMMIT_DATA][0]
+        self.edges = self.chunks.get(CHUNK_EXTRA_EDGES, (None, 0))[0]
+
+        # Bloom filters are only used if they have git's settings, as git
+        # does.
+        self.bloom_index = self.bloom_data = self.bloom_version = None
+        if CHUNK_BLOOM_INDEXES in self.chunks and CHUNK_BLOOM_DATA in self.chunks:
+            offset = self.chunks[CHUNK_BLOOM_DATA][0]
+            version, hashes, bits = BLOOM_DATA_HEADER.unpack_from(map, offset)
+            if version in (1, 2) and hashes == BLOOM_NUM_HASHES and bits == BLOOM_BITS_PER_ENTRY:
+                self.bloom_index = self.chunks[CHUNK_BLOOM_INDEXES][0]
+                self.bloom_data = offset + BLOOM_DATA_HEADER.size
+                self.bloom_version = version
+
+    def binsha(self, pos):
+        start = self.oid_table + 20 * pos
+        return self.map[start:start+20]
+
+    def sha(self, pos):
+        return self.binsha(pos).hex()
+
+    def find(self, sha):
+        """Return the position of commit sha (hex), or None."""
+        binsha = bytes.fromhex(sha)
+        first = binsha[0]
+        lo = self.fanout[first-1] if first else 0
+        hi = self.fanout[first]
+        m = self.map
+        base = self.oid_table
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = base + 20 * mid
+            cur = m[start:start+20]
+            if cur < binsha:
+                lo = mid + 1
+            elif cur > binsha:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def entry(self, pos):
+        """Return (tree, parents, generation, date) for the commit at pos.
+        tree is a hex sha, parents a list of positions."""
+        tree, p1, p2, gen_hi, date_lo = CDAT_ENTRY.unpack_from(self.map, self.data_table + 36 * pos)
+
+        parents = list()
+        if p1 != PARENT_NONE:
+            parents.append(p1)
+        if p2 & PARENT_OCTOPUS:
+            # p2 points into the extra edges list, which holds the second and
+            # following parents.
+            i = self.edges + 4 * (p2 & ~PARENT_OCTOPUS)
+            while True:
+                edge = struct.unpack_from(">L", self.map, i)[0]
+                parents.append(edge & ~EDGE_LAST)
+                if edge & EDGE_LAST:
+                    break
+                i += 4
+        elif p2 != PARENT_NONE:
+            parents.append(p2)
+
+        return tree.hex(), parents, gen_hi >> 2, ((gen_hi & 3) << 32) | date_lo
+
+    def bloom(self, pos):
+        """The changed-path Bloom filter of the commit at pos, or None if it
+        has none."""
+        if self.bloom_index is None:
+            return None
+        start = struct.unpack_from(">L", self.map, self.bloom_index + 4 * (pos - 1))[0] if pos else 0
+        end = struct.unpack_from(">L", self.map, self.bloom_index + 4 * pos)[0]
+        if start == end:
+            return None
+        return self.map[self.bloom_data + start:self.bloom_data + end]
+
+    def parents(self, pos):
+        """Return the parents of the commit at pos, as hex shas."""
+        return [ self.sha(p) for p in self.entry(pos)[1] ]
+
+def commit_graph_path(repo):
+    return repo.repo_path("objects", "info", "commit-graph")
+
+def commit_graph(repo):
+    """Return repo's commit-graph, or None if it doesn't have one."""
+    if repo.commit_graph is None:
+        path = commit_graph_path(repo)
+        repo.commit_graph = GitCommitGraph(path) if os.path.exists(path) else False
+    return repo.commit_graph or None
+
+def commit_graph_serialize(commits, blooms=None):
+    """Serialize a commit-graph.  commits maps hex sha to (tree, parents,
+    date), tree and parents being hex shas too.  Every parent must be in
+    commits.  blooms, if given, maps each commit to its changed-path Bloom
+    filter.  Return the file contents."""
+
+    shas = sorted(commits)
+    pos = { sha: i for i, sha in enumerate(shas) }
+
+    # Generation numbers (topological levels), computed iteratively:
+    # a commit's level is one more than its highest parent's.
+    generation = dict()
+    for sha in shas:
+        stack = [ sha ]
+        while stack:
+            top = stack[-1]
+            if top in generation:
+                stack.pop()
+                continue
+            missing = [ p for p in commits[top][1] if p not in generation ]
+            if missing:
+                stack.extend(missing)
+            else:
+                stack.pop()
+                generation[top] = min(GENERATION_MAX, 1 + max((generation[p] for p in commits[top][1]), default=0))
+
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[int(sha[0:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i-1]
+
+    data = list()
+    edges = list()
+    for sha in shas:
+        tree, parents, date = commits[sha]
+        parents = [ pos[p] for p in parents ]
+
+        p1 = parents[0] if parents else PARENT_NONE
+        if len(parents) > 2:
+            p2 = PARENT_OCTOPUS | len(edges)
+            edges.extend(parents[1:])
+            edges[-1] |= EDGE_LAST
+        else:
+            p2 = parents[1] if len(parents) == 2 else PARENT_NONE
+
+        data.append(CDAT_ENTRY.pack(bytes.fromhex(tree), p1, p2,
+                                    (generation[sha] << 2) | ((date >> 32) & 3),
+                                    date & 0xFFFFFFFF))
+
+    chunks = [ (CHUNK_OID_FANOUT, struct.pack(">256L", *fanout)),
+               (CHUNK_OID_LOOKUP, b''.join(bytes.fromhex(sha) for sha in shas)),
+               (CHUNK_COMMIT_DATA, b''.join(data)) ]
+    if edges:
+        chunks.append((CHUNK_EXTRA_EDGES, struct.pack(">{0}L".format(len(edges)), *edges)))
+    if blooms is not None:
+        ends = list(itertools.accumulate(len(blooms[sha]) for sha in shas))
+        chunks.append((CHUNK_BLOOM_INDEXES, struct.pack(">{0}L".format(len(ends)), *ends)))
+        chunks.append((CHUNK_BLOOM_DATA, BLOOM_DATA_HEADER.pack(BLOOM_HASH_VERSION, BLOOM_NUM_HASHES, BLOOM_BITS_PER_ENTRY)
+                       + b''.join(blooms[sha] for sha in shas)))
+
+    out = [ struct.pack(">4sBBBB", SIGNATURE, 1, 1, len(chunks), 0) ]
+    offset = 8 + 12 * (len(chunks) + 1)
+    for chunk_id, chunk in chunks:
+        out.append(struct.pack(">4sQ", chunk_id, offset))
+        offset += len(chunk)
+    out.append(struct.pack(">4sQ", b'\x00' * 4, offset))
+    out.extend(chunk for _, chunk in chunks)
+
+    ret = b''.join(out)
+    return ret + hashlib.sha1(ret).digest()
+
+def commit_graph_write(repo, commits, blooms=None):
+    """Write the commit-graph for commits (see commit_graph_serialize)
+    atomically into repo."""
+    import tempfile
+    data = commit_graph_serialize(commits, blooms)
+
+    fd, tmp = tempfile.mkstemp(prefix="tmp_graph_", dir=repo.repo_dir("objects", "info", mkdir=True))
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, commit_graph_path(repo))
+
+    # Drop the one we may have open
+    repo.commit_graph = None
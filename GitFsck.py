@@ -0,0 +1,204 @@
+import os
+import re
+import zlib
+import hashlib
+import concurrent.futures
+import GitCommands
+import GitObject
+import GitPack
+import GitRepository
+
+# Packed objects are checked this many at a time, in offset order so that
+# delta bases get reused from the cache; loose ones by fanout directory.
+PACK_CHUNK = 4096
+
+HASH_RE = re.compile(b"^[0-9a-f]{40}$")
+FANOUT_RE = re.compile("^[0-9a-f]{2}$")
+
+# The repository of a worker process
+_repo = None
+
+def worker_init(worktree):
+    global _repo
+    _repo = GitRepository.GitRepository(worktree)
+
+def object_check(sha, fmt, data):
+    """Parse object sha.  Return (sha, fmt, refs, error), refs being the
+    (sha, fmt) of the objects it points to, error a message or None."""
+    actual = hashlib.sha1(fmt + b' ' + str(len(data)).encode("ascii") + b'\x00' + data).hexdigest()
+    if actual != sha:
+        return sha, fmt, None, "hash mismatch, the content hashes to {0}".format(actual)
+
+    refs = list()
+    try:
+        if fmt == b'tree':
+            last = None
+            for item in GitObject.GitTreeLeaf.tree_iter(data):
+                key = item.sort_key()
+                if last is not None and key <= last:
+                    raise Exception("tree entries not sorted, or duplicated: {0}".format(item.path.decode("utf8", "replace")))
+                last = key
+                if item.mode != b'160000':
+                    refs.append((item.sha, b'tree' if item.is_tree() else b'blob'))
+        elif fmt == b'commit':
+            commit = GitObject.GitCommit(None, data)
+            tree = commit.header(b'tree')
+            if len(tree) != 1 or not HASH_RE.match(tree[0]):
+                raise Exception("bad tree header")
+            refs.append((tree[0].decode("ascii"), b'tree'))
+            for parent in commit.header(b'parent'):
+                if not HASH_RE.match(parent):
+                    raise Exception("bad parent header")
+                refs.append((parent.decode("ascii"), b'commit'))
+            for key in (b'author', b'committer'):
+                if len(commit.header(key)) != 1:
+                    raise Exception("bad {0} header".format(key.decode("ascii")))
+        elif fmt == b'tag':
+            tag = GitObject.GitTag(None, data)
+            target = tag.header(b'object')
+            typ = tag.header(b'type')
+            if len(target) != 1 or not HASH_RE.match(target[0]) or len(typ) != 1:
+                raise Exception("bad object or type header")
+            refs.append((target[0].decode("ascii"), typ[0]))
+        elif fmt != b'blob':
+            raise Exception("unknown type {0}".format(fmt.decode("ascii", "replace")))
+    except Exception as e:
+        return sha, fmt, None, str(e) or "malformed {0}".format(fmt.decode("ascii", "replace"))
+
+    return sha, fmt, refs, None
+
+def loose_check(fanout):
+    """Check the loose objects of one fanout directory."""
+    ret = list()
+    path = _repo.repo_path("objects", fanout)
+    for name in sorted(os.listdir(path)):
+        if len(name) != 38:
+            continue
+        sha = fanout + name
+        try:
+            with open(os.path.join(path, name), "rb") as f:
+                raw = zlib.decompress(f.read())
+            x = raw.find(b' ')
+            y = raw.find(b'\x00', x)
+            if x < 0 or y < 0 or not raw[x+1:y].isdigit():
+                raise Exception("bad header")
+            if int(raw[x+1:y]) != len(raw) - y - 1:
+                raise Exception("bad length")
+        except Exception as e:
+            ret.append((sha, None, None, str(e)))
+            continue
+        ret.append(object_check(sha, raw[:x], raw[y+1:]))
+    return ret
+
+def pack_check(path, start, end):
+    """Check the objects of a pack at positions start to end, in pack
+    order."""
+    pack = GitPack.GitPack(path)
+    reader = lambda base: GitCommands.object_read_raw(_repo, base)
+    ret = list()
+    for i in pack.order()[start:end]:
+        binsha = pack.index.sha(i)
+        try:
+            fmt, data = pack.read(binsha, reader, _repo.raw_cache)
+        except Exception as e:
+            ret.append((binsha.hex(), None, None, str(e)))
+            continue
+        ret.append(object_check(binsha.hex(), fmt, data))
+    return ret
+
+def pack_checksum_check(path):
+    """Check the trailing checksums of a pack and its index."""
+    ret = list()
+    for f in (path, path[:-5] + ".idx"):
+        m = GitPack.map_file(f)
+        if hashlib.sha1(m[:-20]).digest() != m[-20:]:
+            ret.append((None, None, None, "{0}: bad checksum".format(os.path.basename(f))))
+    return ret
+
+def fsck(repo, jobs=None, progress=None):
+    """Check every loose and packed object of repo, and that everything
+    reachable from HEAD, refs, reflogs and the index is there.  Return (errors, missing,
+    dangling): errors is a list of (sha, message) for corrupt objects
+    (sha is None for pack checksum errors), missing and dangling lists of
+    (fmt, sha).  Dangling objects are the unreachable ones that no other
+    unreachable object points to.
+
+    Objects are rehashed and parsed by a pool of jobs processes, a fanout
+    directory or a slice of a pack at a time.  progress(done, total) is
+    called as objects get checked."""
+    import GitIndex
+
+    tasks = list()
+    total = 0
+    objects_dir = repo.repo_path("objects")
+    for fanout in sorted(os.listdir(objects_dir)):
+        if FANOUT_RE.match(fanout):
+            tasks.append((loose_check, fanout))
+            total += len(os.listdir(os.path.join(objects_dir, fanout)))
+    for pack in GitPack.pack_list(repo, refresh=True):
+        tasks.append((pack_checksum_check, pack.path))
+        for start in range(0, pack.index.count, PACK_CHUNK):
+            tasks.append((pack_check, pack.path, start, start + PACK_CHUNK))
+        total += pack.index.count
+
+    objects = dict()
+    refs = dict()
+    errors = list()
+    done = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs or os.cpu_count(),
+                                                initializer=worker_init, initargs=(repo.worktree,)) as pool:
+        futures = [ pool.submit(*task) for task in tasks ]
+        for future in concurrent.futures.as_completed(futures):
+            for sha, fmt, obj_refs, error in future.result():
+                if error is not None:
+                    errors.append((sha, error))
+                elif sha not in objects:
+                    objects[sha] = fmt
+                    refs[sha] = obj_refs
+                if sha is not None:
+                    done += 1
+            if progress:
+                progress(done, total)
+
+    corrupt = { sha for sha, _ in errors }
+    missing = dict()
+
+    # Everything reachable from refs, reflogs and the index.  Objects
+    # that aren't loose or packed here, but in another object store or
+    # an alternate, are checked as we reach them.
+    roots = GitCommands.ref_tips(repo) + sorted(GitCommands.reflog_shas(repo))
+    roots += [ e.obj for e in GitIndex.index_read(repo).entries if e.mode != 0o160000 and not e.flag_intent_to_add ]
+    reachable = set()
+    stack = list(roots)
+    while stack:
+        sha = stack.pop()
+        if sha in reachable:
+            continue
+        reachable.add(sha)
+        if sha not in objects:
+            ret = None if sha in corrupt else repo.odb.read(sha)
+            if ret is None:
+                if sha not in corrupt:
+                    missing[sha] = b'object'
+                continue
+            _, fmt, obj_refs, error = object_check(sha, *ret)
+            if error is not None:
+                errors.append((sha, error))
+                corrupt.add(sha)
+                continue
+            objects[sha] = fmt
+            refs[sha] = obj_refs
+        stack.extend(r for r, _ in refs[sha])
+
+    # Missing objects get the type their referrers expect
+    for obj_refs in refs.values():
+        for sha, fmt in obj_refs:
+            if sha not in objects and sha not in corrupt and (sha in missing or not repo.odb.contains(sha)):
+                missing[sha] = fmt
+
+    unreachable = [ sha for sha in objects if sha not in reachable ]
+    referenced = { r for sha in unreachable for r, _ in refs[sha] }
+    dangling = [ (objects[sha], sha) for sha in sorted(unreachable) if sha not in referenced ]
+
+    errors.sort(key=lambda e: (e[0] or "", e[1]))
+    return errors, [ (missing[sha], sha) for sha in sorted(missing) ], dangling
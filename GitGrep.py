@@ -0,0 +1,85 @@
+import os
+import re
+import concurrent.futures
+import GitCommands
+import GitRepository
+
+# Like git, a blob is binary if there's a NUL in its first few bytes.
+BINARY_SNIFF = 8000
+
+# Blobs are handed to workers this many at a time.
+BATCH = 64
+
+GITLINK_MODE = 0o160000
+
+# The repository and pattern of a worker process
+_repo = None
+_regex = None
+
+def worker_init(worktree, pattern, flags):
+    global _repo, _regex
+    _repo = GitRepository.GitRepository(worktree)
+    # Patterns match lines, ^ and $ are at their ends
+    _regex = re.compile(pattern, flags | re.MULTILINE)
+
+def blob_grep(sha):
+    """Return the (line number, line) pairs of blob sha that match, or
+    None if it's binary.  Binary blobs are told apart from their first
+    inflated chunk, without inflating the rest."""
+    _, _, chunks = GitCommands.object_stream(_repo, sha)
+    first = next(chunks, b'')
+    if b'\x00' in first[:BINARY_SNIFF]:
+        chunks.close()
+        return None
+    data = first + b''.join(chunks)
+
+    # Each line is searched on its own, so that nothing matches across
+    # lines: $ matches at endpos, and ^ after the previous newline.
+    ret = list()
+    start = 0
+    lineno = 1
+    while start < len(data):
+        end = data.find(b'\n', start)
+        if end < 0:
+            end = len(data)
+        if _regex.search(data, start, end):
+            ret.append((lineno, data[start:end]))
+        start = end + 1
+        lineno += 1
+    return ret
+
+def blobs_grep(shas):
+    return [ blob_grep(sha) for sha in shas ]
+
+def grep(repo, tree, pattern, flags=0, jobs=None):
+    """Search the blobs of tree for regex pattern (bytes).  Yield (path,
+    matches) in path order for every blob with matches, matches being a
+    list of (line number, line).
+
+    Each distinct blob is searched once, however many paths it has.
+    Blobs are inflated and searched by a pool of jobs processes, in
+    batches; results come out as soon as those of the paths before them
+    are in."""
+    files = sorted((path, sha) for path, mode, sha in GitCommands.tree_walk(repo, tree) if mode != GITLINK_MODE)
+
+    shas = list()
+    seen = set()
+    for _, sha in files:
+        if sha not in seen:
+            seen.add(sha)
+            shas.append(sha)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs or os.cpu_count(),
+                                                initializer=worker_init, initargs=(repo.worktree, pattern, flags)) as pool:
+        futures = dict()
+        for i in range(0, len(shas), BATCH):
+            batch = shas[i:i+BATCH]
+            future = pool.submit(blobs_grep, batch)
+            for n, sha in enumerate(batch):
+                futures[sha] = (future, n)
+
+        for path, sha in files:
+            future, n = futures[sha]
+            matches = future.result()[n]
+            if matches:
+                yield path, matches
@@ -0,0 +1,202 @@
+import os
+import mmap
+import struct
+import hashlib
+import gc
+from GitIndexEntry import *
+
+# ctime s/ns, mtime s/ns, dev, ino, mode, uid, gid, size, sha, flags
+ENTRY_HEADER = struct.Struct(">10L20sH")
+
+class GitIndex(object):
+    """The staging area, as stored in .git/index."""
+
+    version = None
+    entries = None
+    """List of GitIndexEntry, sorted by name then stage."""
+    extensions = None
+    """List of (signature, data) tuples for the extensions we don't
+    interpret.  They're written back as is, so callers that change entries
+    should drop the ones that would go stale (eg TREE)."""
+
+    def __init__(self, version=2, entries=None, extensions=None):
+        if version not in (2, 3, 4):
+            raise Exception("Unsupported index version {0}".format(version))
+        self.version = version
+        self.entries = entries if entries is not None else list()
+        self.extensions = extensions if extensions is not None else list()
+
+def varint_read(data, pos):
+    """Read an index v4 prefix length.  Same encoding as OFS_DELTA offsets."""
+    c = data[pos]
+    pos += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = data[pos]
+        pos += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return pos, value
+
+def varint_encode(value):
+    out = bytearray([value & 0x7f])
+    value >>= 7
+    while value:
+        value -= 1
+        out.append(0x80 | (value & 0x7f))
+        value >>= 7
+    out.reverse()
+    return bytes(out)
+
+def index_parse(data):
+    """Parse the contents of an index file (any bytes-like object) into a
+    GitIndex, verifying its checksum."""
+
+    # Entries can't form reference cycles, but allocating hundreds of
+    # thousands of them triggers the cyclic garbage collector over and over,
+    # which roughly doubles the load time.
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return index_parse_entries(data)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+def index_parse_entries(data):
+    if len(data) < 32:
+        raise Exception("Index file too short")
+
+    if hashlib.sha1(memoryview(data)[:-20]).digest() != data[-20:]:
+        raise Exception("Bad index file checksum")
+
+    signature, version, count = struct.unpack_from(">4sLL", data, 0)
+    if signature != b'DIRC':
+        raise Exception("Bad index file signature")
+    if version not in (2, 3, 4):
+        raise Exception("Unsupported index version {0}".format(version))
+
+    entries = list()
+    append = entries.append
+    unpack = ENTRY_HEADER.unpack_from
+    from_raw = GitIndexEntry.from_raw
+    find = data.find
+    pos = 12
+    previous = b''
+
+    for i in range(count):
+        start = pos
+        stat = unpack(data, pos)
+        flags = stat[FLAGS]
+        pos += 62
+
+        extended = 0
+        if flags & FLAG_EXTENDED:
+            if version < 3:
+                raise Exception("Extended flags in a version 2 index")
+            extended = (data[pos] << 8) | data[pos+1]
+            pos += 2
+
+        if version == 4:
+            # Name is stored as "strip N bytes off the previous name, then
+            # append this NUL-terminated suffix", with no padding.
+            strip = data[pos]
+            if strip < 0x80:
+                pos += 1
+            else:
+                pos, strip = varint_read(data, pos)
+            end = find(b'\x00', pos)
+            name = previous[:len(previous)-strip] + data[pos:end]
+            pos = end + 1
+            previous = name
+        else:
+            name_length = flags & FLAG_NAME_MASK
+            if name_length < 0xFFF:
+                end = pos + name_length
+            else:
+                end = find(b'\x00', pos)
+            name = data[pos:end]
+            # Entries are NUL-padded to a multiple of 8 bytes, with at least
+            # one NUL.
+            pos = start + ((end - start + 8) & ~7)
+
+        append(from_raw(stat, extended, name))
+
+    # Extensions run until the trailing checksum
+    extensions = list()
+    end = len(data) - 20
+    while pos < end:
+        sig, size = struct.unpack_from(">4sL", data, pos)
+        pos += 8
+        extensions.append((bytes(sig), bytes(data[pos:pos+size])))
+        pos += size
+
+    return GitIndex(version, entries, extensions)
+
+def index_serialize(index):
+    """Serialize a GitIndex.  Return the contents of the index file,
+    checksum included."""
+
+    version = index.version
+    if version < 4:
+        # Like git, use version 3 only when some entry needs extended flags
+        extended = any(e._extended for e in index.entries)
+        version = 3 if extended else 2
+
+    out = [ struct.pack(">4sLL", b'DIRC', version, len(index.entries)) ]
+    append = out.append
+    pack = ENTRY_HEADER.pack
+    previous = b''
+
+    for e in index.entries:
+        name = e.name
+        stat = e._stat
+        flags = (stat[FLAGS] & ~(FLAG_NAME_MASK | FLAG_EXTENDED)) | min(len(name), 0xFFF)
+        if e._extended:
+            flags |= FLAG_EXTENDED
+
+        header = pack(*stat[:FLAGS], flags)
+        if e._extended:
+            header += struct.pack(">H", e._extended)
+
+        if version == 4:
+            common = os.path.commonprefix([previous, name])
+            append(header + varint_encode(len(previous) - len(common)) + name[len(common):] + b'\x00')
+            previous = name
+        else:
+            length = len(header) + len(name)
+            append(header + name + b'\x00' * (8 - length % 8))
+
+    for sig, data in index.extensions:
+        append(struct.pack(">4sL", sig, len(data)) + data)
+
+    ret = b''.join(out)
+    return ret + hashlib.sha1(ret).digest()
+
+def index_read(repo):
+    """Read repo's index.  Return an empty GitIndex if there isn't one."""
+
+    path = repo.repo_path("index")
+    if not os.path.exists(path):
+        return GitIndex()
+
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return GitIndex()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return index_parse(m)
+
+def index_write(repo, index):
+    """Write index to repo.  Like git, we go through index.lock so that
+    readers never see a half-written index and concurrent writers fail."""
+
+    path = repo.repo_path("index")
+    lock = path + ".lock"
+
+    fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(index_serialize(index))
+        os.replace(lock, path)
+    except:
+        os.unlink(lock)
+        raise
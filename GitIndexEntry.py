@@ -1,38 +1,151 @@
+# Positions in GitIndexEntry._stat, which holds the fixed-size part of an
+# on-disk entry exactly as struct unpacks it: ctime s/ns, mtime s/ns, dev,
+# ino, mode, uid, gid, size, binary sha, flags.
+CTIME_S, CTIME_NS, MTIME_S, MTIME_NS, DEV, INO, MODE, UID, GID, SIZE, SHA, FLAGS = range(12)
+
+FLAG_ASSUME_VALID = 0x8000
+FLAG_EXTENDED     = 0x4000
+FLAG_STAGE_MASK   = 0x3000
+FLAG_STAGE_SHIFT  = 12
+FLAG_NAME_MASK    = 0x0FFF
+
+EXT_FLAG_SKIP_WORKTREE = 0x4000
+EXT_FLAG_INTENT_TO_ADD = 0x2000
+
+def _field(i, doc, get=None, set=None):
+    """Build a property reading (and writing) slot i of _stat, optionally
+    through conversion functions."""
+    def getter(self):
+        v = self._stat[i]
+        return get(v) if get else v
+    def setter(self, v):
+        self._replace(i, set(v) if set else v)
+    return property(getter, setter, doc=doc)
+
+def _flag(mask, doc):
+    def getter(self):
+        return bool(self._stat[FLAGS] & mask)
+    def setter(self, v):
+        flags = self._stat[FLAGS] & ~mask
+        self._replace(FLAGS, flags | mask if v else flags)
+    return property(getter, setter, doc=doc)
+
+def _ext_flag(mask, doc):
+    def getter(self):
+        return bool(self._extended & mask)
+    def setter(self, v):
+        self._extended = self._extended | mask if v else self._extended & ~mask
+    return property(getter, setter, doc=doc)
+
 class GitIndexEntry(object):
-    ctime = None
-    """The last time a file's metadata changed. This is a tuple (seconds, nanoseconds)"""
+    # A repository can have hundreds of thousands of index entries.  To
+    # keep them small and quick to load, an entry only holds the tuple
+    # struct.unpack returned for it, its extended flags and its name; the
+    # fields below are decoded on access.
+    __slots__ = ("_stat", "_extended", "name")
+
+    def __init__(self, ctime=(0, 0), mtime=(0, 0), dev=0, ino=0, mode_type=0b1000, mode_perms=0o644,
+                 uid=0, gid=0, size=0, obj=None, flag_assume_valid=False, flag_stage=0,
+                 flag_skip_worktree=False, flag_intent_to_add=False, name=None):
+        flags = (flag_stage << FLAG_STAGE_SHIFT) & FLAG_STAGE_MASK
+        if flag_assume_valid:
+            flags |= FLAG_ASSUME_VALID
+        self._stat = (ctime[0], ctime[1], mtime[0], mtime[1], dev, ino,
+                      (mode_type << 12) | mode_perms, uid, gid, size,
+                      bytes.fromhex(obj) if obj else b'\x00' * 20, flags)
+        self._extended = 0
+        self.flag_skip_worktree = flag_skip_worktree
+        self.flag_intent_to_add = flag_intent_to_add
+        self.name = name
+
+    @classmethod
+    def from_raw(cls, stat, extended, name):
+        """Build an entry from the unpacked fixed-size fields, the extended
+        flags (0 if none) and the name.  This is what the index parser
+        uses, it's much cheaper than __init__."""
+        e = cls.__new__(cls)
+        e._stat = stat
+        e._extended = extended
+        e.name = name
+        return e
+
+    def _replace(self, i, value):
+        s = self._stat
+        self._stat = s[:i] + (value,) + s[i+1:]
+
+    @property
+    def ctime(self):
+        """The last time a file's metadata changed. This is a tuple (seconds, nanoseconds)"""
+        return self._stat[CTIME_S], self._stat[CTIME_NS]
+
+    @ctime.setter
+    def ctime(self, v):
+        s = self._stat
+        self._stat = (v[0], v[1]) + s[MTIME_S:]
+
+    @property
+    def mtime(self):
+        """The last time a file's data changed. This is a tuple (seconds, nanoseconds)"""
+        return self._stat[MTIME_S], self._stat[MTIME_NS]
+
+    @mtime.setter
+    def mtime(self, v):
+        s = self._stat
+        self._stat = s[:MTIME_S] + (v[0], v[1]) + s[DEV:]
+
+    dev = _field(DEV, """The ID of device containing this file""")
+
+    ino = _field(INO, """The file's inode number""")
+
+    mode = _field(MODE, """The full mode, as found in trees (eg 0o100644).""")
+
+    @property
+    def mode_type(self):
+        """The object type, either b1000 (regular), b1010 (symlink), b1110 (gitlink)."""
+        return self._stat[MODE] >> 12
+
+    @mode_type.setter
+    def mode_type(self, v):
+        self._replace(MODE, (v << 12) | (self._stat[MODE] & 0o777))
+
+    @property
+    def mode_perms(self):
+        """The object permissions, an integer."""
+        return self._stat[MODE] & 0o777
+
+    @mode_perms.setter
+    def mode_perms(self, v):
+        self._replace(MODE, (self._stat[MODE] & ~0o777) | v)
+
+    uid = _field(UID, """User ID of owner""")
 
-    mtime = None
-    """The last time a file's data changed. This is a tuple (seconds, nanoseconds)"""
+    gid = _field(GID, """Group ID of owner""")
 
-    dev = None
-    """The ID of device containing this file"""
+    size = _field(SIZE, """Size of this object, in bytes""")
 
-    ino = None
-    """The file's inode number"""
+    obj = _field(SHA, """The object's hash as a hex string""", get=bytes.hex, set=bytes.fromhex)
 
-    mode_type = None
-    """The object type, either b1000 (regular), b1010 (symlink), b1110 (gitlink)."""
+    binsha = _field(SHA, """The object's hash as 20 raw bytes""")
 
-    mode_perms = None
-    """The object permissions, an integer."""
+    flag_assume_valid = _flag(FLAG_ASSUME_VALID, None)
 
-    uid = None
-    """User ID of owner"""
+    @property
+    def flag_extended(self):
+        return self._extended != 0
 
-    gid = None
-    """Group ID of owner"""
+    @property
+    def flag_stage(self):
+        return (self._stat[FLAGS] & FLAG_STAGE_MASK) >> FLAG_STAGE_SHIFT
 
-    size = None
-    """Size of this object, in bytes"""
+    @flag_stage.setter
+    def flag_stage(self, v):
+        self._replace(FLAGS, (self._stat[FLAGS] & ~FLAG_STAGE_MASK) | ((v << FLAG_STAGE_SHIFT) & FLAG_STAGE_MASK))
 
-    obj = None
-    """The object's hash as a hex string"""
+    @property
+    def flag_name_length(self):
+        """Length of the name if < 0xFFF (yes, three Fs), -1 otherwise"""
+        return len(self.name) if len(self.name) < 0xFFF else -1
 
-    flag_assume_valid = None
-    flag_extended = None
-    flag_stage = None
-    flag_name_length = None
-    """Length of the name if < 0xFFF (yes, three Fs), -1 otherwise"""
+    flag_skip_worktree = _ext_flag(EXT_FLAG_SKIP_WORKTREE, """Extended flag (index v3+): don't check this path out""")
 
-    name = None
+    flag_intent_to_add = _ext_flag(EXT_FLAG_INTENT_TO_ADD, """Extended flag (index v3+): the path was added with git add -N""")
@@ -1,3 +1,4 @@
+import array
 import collections
 
 class GitObject (object):
@@ -31,11 +32,63 @@ class GitBlob(GitObject):
 
 class GitKvlm(GitObject):
 
+    # We keep the raw bytes around and only build the kvlm dict when
+    # someone asks for it.  Until then serialize() returns the original
+    # bytes as is, and header() can pick single headers out of them.
+    raw = None
+    _kvlm = None
+
     def deserialize(self, data):
-        self.kvlm = self.kvlm_parse(data)
+        self.raw = bytes(data)
+        self._kvlm = None
 
     def serialize(self):
-        return self.kvlm_serialize(self.kvlm)
+        if self._kvlm is None:
+            return self.raw
+        return self.kvlm_serialize(self._kvlm)
+
+    @property
+    def kvlm(self):
+        if self._kvlm is None:
+            self._kvlm = self.kvlm_parse(self.raw)
+        return self._kvlm
+
+    @kvlm.setter
+    def kvlm(self, value):
+        self._kvlm = value
+
+    def header(self, key):
+        """Return the list of values of header key, without parsing the
+        other headers or the message."""
+        if self._kvlm is not None:
+            val = self._kvlm.get(key, [])
+            return val if type(val) == list else [val]
+        return self.kvlm_header(self.raw, key)
+
+    @staticmethod
+    def kvlm_header(raw, key):
+        ret = list()
+        prefix = key + b' '
+        start = 0
+        # Headers end at the first empty line.
+        while start < len(raw) and raw[start] != ord('\n'):
+            end = GitKvlm.kvlm_value_end(raw, start)
+            if raw.startswith(prefix, start):
+                ret.append(raw[start+len(prefix):end].replace(b'\n ', b'\n'))
+            start = end + 1
+        return ret
+
+    @staticmethod
+    def kvlm_value_end(raw, start):
+        """Return the index of the newline ending the header line at start.
+        Continuation lines begin with a space, so we look for a "\n" not
+        followed by one."""
+        end = raw.find(b'\n', start)
+        while end >= 0 and raw[end+1:end+2] == b' ':
+            end = raw.find(b'\n', end+1)
+        if end < 0:
+            raise Exception("Malformed object: unterminated header")
+        return end
 
     # KVLM = "Key-Value List with Message", made up by original author
     def kvlm_parse(self, raw, start=0, dct=None):
@@ -43,46 +96,37 @@ class GitKvlm(GitObject):
             # can't declare the argument as dct=OrderedDict() or all calls to the functions will endlessly grow the same dict
             dct = collections.OrderedDict()
 
-        spaceIndex = raw.find(b' ', start)
-        newlineIndex = raw.find(b'\n', start)
-
-        # if space appears before newline, we have a keyword
-
-        # base case
-        # ================
-        # If newline appears first (or there's no space at all, in which case find return -1), we assume a blank line.
-        # A blank line means the remainder of the data is the message.
-        if (spaceIndex < 0) or (newlineIndex < spaceIndex):
-            assert(newlineIndex == start)
-            dct[b''] = raw[start+1:]
-            return dct
-
-        # recursive case
-        # ==================
-        # we read a key-value pair and recurse for the next
-        key = raw[start:spaceIndex]
-
-        # find the end of the value, continuation lines begin with a space, so we loop uuntil we find a "\n" not followed by a space.
-        end = start
+        # We loop rather than recurse once per header: commits can have
+        # thousands of parent lines.
         while True:
-            end = raw.find(b'\n', end+1)
-            if raw[end + 1] != ord(' '):
-                break
-
-        value = raw[spaceIndex+1:end].replace(b'\n ', b'\n')
-
-        if key in dct:
-            if type(dct[key]) == list:
-                dct[key].append(value)
+            spaceIndex = raw.find(b' ', start)
+            newlineIndex = raw.find(b'\n', start)
+
+            # if space appears before newline, we have a keyword
+
+            # If newline appears first (or there's no space at all, in which case find return -1), we assume a blank line.
+            # A blank line means the remainder of the data is the message.
+            if (spaceIndex < 0) or (newlineIndex < spaceIndex):
+                assert(newlineIndex == start)
+                dct[b''] = raw[start+1:]
+                return dct
+
+            key = raw[start:spaceIndex]
+            end = self.kvlm_value_end(raw, start)
+            value = raw[spaceIndex+1:end].replace(b'\n ', b'\n')
+
+            if key in dct:
+                if type(dct[key]) == list:
+                    dct[key].append(value)
+                else:
+                    dct[key] = [ dct[key], value ]
             else:
-                dct[key] = [ dct[key], value ]
-        else:
-            dct[key] = value
+                dct[key] = value
 
-        return self.kvlm_parse(raw, end + 1, dct)
+            start = end + 1
 
     def kvlm_serialize(self, kvlm):
-        ret = b''
+        ret = list()
 
         for k in kvlm.keys():
             if k == b'':
@@ -90,22 +134,46 @@ class GitKvlm(GitObject):
             val = kvlm[k]
             if type(val) != list:
                 val = [val]
-            
+
             for v in val:
-                ret += k + b' ' + (v.replace(b'\n', b'\n ')) + b'\n'
+                ret.append(k + b' ' + (v.replace(b'\n', b'\n ')) + b'\n')
 
-        ret += b'\n' + kvlm[b'']
-        
-        return ret
+        ret.append(b'\n' + kvlm[b''])
+
+        return b''.join(ret)
 
 class GitCommit(GitKvlm):
     fmt = b'commit'
 
 class GitTreeLeaf(object):
-    def __init__(self, mode, path, sha):
+    # SHAs are kept as 20 raw bytes, hex is computed when asked for.
+    __slots__ = ("mode", "path", "binsha")
+
+    def __init__(self, mode, path, sha=None, binsha=None):
         self.mode = mode
         self.path = path
-        self.sha = sha
+        self.binsha = binsha if binsha is not None else bytes.fromhex(sha)
+
+    @property
+    def sha(self):
+        return self.binsha.hex()
+
+    @sha.setter
+    def sha(self, value):
+        self.binsha = bytes.fromhex(value)
+
+    def is_tree(self):
+        return self.mode == b'40000'
+
+    def sort_key(self):
+        """Git sorts tree entries as if directory names ended with a /."""
+        return GitTreeLeaf.tree_sort_key(self.path, self.is_tree())
+
+    @staticmethod
+    def tree_sort_key(path, is_tree):
+        # Names can't contain NULs, so comparing name + "\0" for files
+        # and name + "/" for trees is exactly git's base_name_compare().
+        return path + (b'/' if is_tree else b'\x00')
 
     @staticmethod
     def tree_parse_one(raw, start=0):
@@ -121,45 +189,112 @@ class GitTreeLeaf(object):
         # and read the path
         path = raw[x+1:y]
 
-        # Read the SHA and convert to a hex string
-        sha = hex(int.from_bytes(raw[y+1:y+21], "big"))[2:] # hex() adds 0x in front, we don't want that
-
-        return y+21, GitTreeLeaf(mode, path, sha)
+        # Keep the SHA as raw bytes
+        return y+21, GitTreeLeaf(mode, path, binsha=raw[y+1:y+21])
 
     @staticmethod
-    def tree_parse(raw):
+    def tree_iter(raw):
+        """Parse tree entries lazily, one at a time."""
         pos = 0
         max = len(raw)
-        ret = list()
         while pos < max:
             pos, data = GitTreeLeaf.tree_parse_one(raw, pos)
-            ret.append(data)
+            yield data
 
-        return ret
+    @staticmethod
+    def tree_parse(raw):
+        return list(GitTreeLeaf.tree_iter(raw))
 
     @staticmethod
     def tree_serialize(obj):
-        #@FIXME Add serializer!
-        ret = b''
-        for i in obj.items:
-            ret += i.mode
-            ret += b' '
-            ret += i.path
-            ret += b'\x00'
-            sha = int(i.sha, 16)
-            #@FIXME Does
-            ret += sha.to_bytes(20, byteorder="big")
-        return ret
+        ret = list()
+        for i in sorted(obj.items, key=GitTreeLeaf.sort_key):
+            ret.append(i.mode + b' ' + i.path + b'\x00' + i.binsha)
+        return b''.join(ret)
 
 class GitTree(GitObject):
+    """A tree.  Entries are parsed lazily from the raw bytes: iterating
+    over the tree yields them one by one, and entry() finds one by name
+    with a binary search, without building the others."""
     fmt = b'tree'
 
+    raw = None
+    _items = None
+    _offsets = None
+
     def deserialize(self, data):
-        self.items = GitTreeLeaf.tree_parse(data)
+        self.raw = bytes(data)
+        self._items = None
+        self._offsets = None
 
     def serialize(self):
+        if self._items is None:
+            return self.raw
         return GitTreeLeaf.tree_serialize(self)
 
+    @property
+    def items(self):
+        """The list of entries, built on first access.  Assigning a new list
+        changes what serialize() returns."""
+        if self._items is None:
+            self._items = GitTreeLeaf.tree_parse(self.raw)
+        return self._items
+
+    @items.setter
+    def items(self, value):
+        self._items = value
+
+    def __iter__(self):
+        if self._items is not None:
+            return iter(self._items)
+        return GitTreeLeaf.tree_iter(self.raw)
+
+    def __len__(self):
+        return len(self.offsets())
+
+    def offsets(self):
+        """Return the offsets of each entry in raw."""
+        if self._offsets is None:
+            offsets = array.array('L')
+            raw = self.raw
+            pos = 0
+            end = len(raw)
+            while pos < end:
+                offsets.append(pos)
+                pos = raw.find(b'\x00', pos) + 21
+            self._offsets = offsets
+        return self._offsets
+
+    def sort_key_at(self, pos):
+        raw = self.raw
+        x = raw.find(b' ', pos)
+        y = raw.find(b'\x00', x)
+        return GitTreeLeaf.tree_sort_key(raw[x+1:y], raw[pos:x] == b'40000')
+
+    def entry(self, name):
+        """Return the entry called name (bytes), or None."""
+        if self._items is not None:
+            for item in self._items:
+                if item.path == name:
+                    return item
+            return None
+
+        # name may be a file or a directory, which don't sort in the same
+        # place, so we try both.
+        offsets = self.offsets()
+        for key in (name + b'\x00', name + b'/'):
+            lo, hi = 0, len(offsets)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                cur = self.sort_key_at(offsets[mid])
+                if cur < key:
+                    lo = mid + 1
+                elif cur > key:
+                    hi = mid
+                else:
+                    return GitTreeLeaf.tree_parse_one(self.raw, offsets[mid])[1]
+        return None
+
 class GitTag(GitCommit):
     fmt = b'tag'
     
\ No newline at end of file
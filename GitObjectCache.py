@@ -0,0 +1,69 @@
+import collections
+import threading
+
+class GitObjectCache(object):
+    """A least-recently-used cache bounded by a byte budget.
+
+Callers tell put() how many bytes each value is worth; once the total
+goes over the budget, the least recently used entries are evicted.  A
+budget of 0 disables the cache.  The cache can be shared between
+threads."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        if size > self.budget:
+            # Would evict everything else and then itself, don't bother.
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+            self.entries[key] = (value, size)
+            self.size += size
+
+            while self.size > self.budget:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """Return the cache counters as a dict."""
+        return { "hits": self.hits,
+                 "misses": self.misses,
+                 "evictions": self.evictions,
+                 "entries": len(self.entries),
+                 "bytes": self.size,
+                 "budget": self.budget }
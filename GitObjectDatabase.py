@@ -0,0 +1,554 @@
+import os
+import zlib
+import hashlib
+import contextlib
+import threading
+import GitCommands
+import GitPack
+
+# Like git, we follow alternates of alternates, but only this deep.
+ALTERNATES_DEPTH = 5
+
+# Writes in a batch are committed to SQLite this many at a time.
+SQLITE_BATCH = 10000
+
+# How long, in seconds, a SQLite writer waits for another one to finish.
+SQLITE_TIMEOUT = 60
+
+def object_header(fmt, size):
+    return fmt + b' ' + str(size).encode() + b'\x00'
+
+class GitObjectDatabase(object):
+    """Where a repository's objects are stored.
+
+Lookups take a hex sha and return None when the object isn't there, so
+that backends can be chained.  Writes are given the sha, which the
+caller has computed anyway to know whether the object exists already.
+The defaults here fall back on read() and write(), a backend only needs
+to do better where it can."""
+
+    def contains(self, sha):
+        return self.read(sha) is not None
+
+    def read(self, sha):
+        """Return (fmt, data), or None."""
+        raise Exception("Unimplemented!")
+
+    def info(self, sha):
+        """Return (fmt, size), or None."""
+        ret = self.read(sha)
+        return None if ret is None else (ret[0], len(ret[1]))
+
+    def stream(self, sha):
+        """Return (fmt, size, chunks), chunks being an iterator over the
+        object's data, or None."""
+        ret = self.read(sha)
+        return None if ret is None else (ret[0], len(ret[1]), iter([ret[1]]))
+
+    def find_prefix(self, prefix):
+        """Return the set of hex shas starting with prefix (lowercase, at
+        least 2 characters)."""
+        return set()
+
+    def write(self, sha, fmt, data):
+        raise Exception("{0} is read-only".format(type(self).__name__))
+
+    def write_stream(self, fmt, size, chunks):
+        """Write an object of size bytes given as an iterable of chunks.
+        Return its sha."""
+        data = b''.join(chunks)
+        sha = hashlib.sha1(object_header(fmt, size) + data).hexdigest()
+        if not self.contains(sha):
+            self.write(sha, fmt, data)
+        return sha
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Group the writes made in a with block, for backends where
+        writing many objects at once is cheaper than one by one."""
+        yield
+
+    def refresh(self):
+        """Forget what we cached about the backend's contents, someone
+        else may have changed them."""
+        pass
+
+    def close(self):
+        pass
+
+class GitLooseDatabase(GitObjectDatabase):
+    """Loose objects: one deflated file per object, in objects/xx/yyyy..."""
+
+    def __init__(self, path):
+        self.path = path
+        # Sorted listings of fanout directories, with their mtime, for
+        # find_prefix.
+        self.dirs = dict()
+
+    def object_path(self, sha):
+        return os.path.join(self.path, sha[0:2], sha[2:])
+
+    def contains(self, sha):
+        return os.path.isfile(self.object_path(sha))
+
+    def read(self, sha):
+        path = self.object_path(sha)
+        if not os.path.isfile(path):
+            return None
+
+        with open (path, "rb") as f:
+            raw = zlib.decompress(f.read())
+
+        # Read object type
+        x = raw.find(b' ')
+        fmt = raw[0:x]
+
+        # Read and validate object size
+        y = raw.find(b'\x00', x)
+        size = int(raw[x:y].decode("ascii"))
+        if size != len(raw)-y-1:
+            raise Exception("Malformed object {0}: bad length".format(sha))
+
+        return fmt, raw[y+1:]
+
+    def info(self, sha):
+        """Read only the first inflated bytes of the object."""
+        path = self.object_path(sha)
+        if not os.path.isfile(path):
+            return None
+
+        with open(path, "rb") as f:
+            # The header is at most "commit 18446744073709551615\0", 32 bytes.
+            head = GitPack.inflate_prefix(iter(lambda: f.read(256), b''), 32)
+
+        x = head.find(b' ')
+        y = head.find(b'\x00', x)
+        if x < 0 or y < 0:
+            raise Exception("Malformed object {0}: bad header".format(sha))
+
+        return head[0:x], int(head[x+1:y].decode("ascii"))
+
+    def stream(self, sha):
+        """Inflate the object incrementally, so memory use is bounded
+        whatever its size."""
+        path = self.object_path(sha)
+        if not os.path.isfile(path):
+            return None
+
+        f = open(path, "rb")
+        chunks = GitPack.inflate_iter(iter(lambda: f.read(GitCommands.STREAM_CHUNK), b''))
+
+        # Inflate just enough to read the header
+        head = b''
+        while b'\x00' not in head:
+            try:
+                head += next(chunks)
+            except StopIteration:
+                f.close()
+                raise Exception("Malformed object {0}: no header".format(sha))
+
+        x = head.find(b' ')
+        y = head.find(b'\x00', x)
+        fmt = head[0:x]
+        size = int(head[x:y].decode("ascii"))
+
+        def body():
+            with f:
+                count = len(head) - y - 1
+                if count:
+                    yield head[y+1:]
+                for chunk in chunks:
+                    count += len(chunk)
+                    yield chunk
+            if count != size:
+                raise Exception("Malformed object {0}: bad length".format(sha))
+
+        return fmt, size, body()
+
+    def listing(self, fanout):
+        """Return the sorted names (the last 38 hex characters) of the
+        loose objects in fanout.  The listing is cached until the
+        directory's mtime changes."""
+        path = os.path.join(self.path, fanout)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            self.dirs.pop(fanout, None)
+            return []
+
+        cached = self.dirs.get(fanout)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        names = sorted(f for f in os.listdir(path) if len(f) == 38)
+        self.dirs[fanout] = (mtime, names)
+        return names
+
+    def find_prefix(self, prefix):
+        import bisect
+        names = self.listing(prefix[0:2])
+        rem = prefix[2:]
+        ret = set()
+        i = bisect.bisect_left(names, rem)
+        while i < len(names) and names[i].startswith(rem):
+            ret.add(prefix[0:2] + names[i])
+            i += 1
+        return ret
+
+    def tempfile(self):
+        """Create a temporary file in the object directory.  Return
+        (fd, path), like tempfile.mkstemp."""
+        import tempfile
+        os.makedirs(self.path, exist_ok=True)
+        return tempfile.mkstemp(prefix="tmp_obj_", dir=self.path)
+
+    def tempfile_commit(self, tmp_path, sha):
+        """Move a temporary file created by tempfile() into place as
+        object sha.  Readers never see a partially written object."""
+        path = self.object_path(sha)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        if os.path.exists(path):
+            # Objects are immutable, the one already there is just as good.
+            os.unlink(tmp_path)
+            return
+
+        # Loose objects are read-only, like git makes them.
+        os.chmod(tmp_path, 0o444)
+        os.replace(tmp_path, path)
+
+    def write(self, sha, fmt, data):
+        fd, tmp_path = self.tempfile()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                compressor = zlib.compressobj()
+                f.write(compressor.compress(object_header(fmt, len(data))))
+                f.write(compressor.compress(data))
+                f.write(compressor.flush())
+        except:
+            os.unlink(tmp_path)
+            raise
+        self.tempfile_commit(tmp_path, sha)
+
+    def write_stream(self, fmt, size, chunks):
+        """Hash and deflate chunk by chunk into a temporary file."""
+        header = object_header(fmt, size)
+        h = hashlib.sha1(header)
+
+        fd, tmp_path = self.tempfile()
+        out = os.fdopen(fd, "wb")
+        try:
+            compressor = zlib.compressobj()
+            out.write(compressor.compress(header))
+            for chunk in chunks:
+                h.update(chunk)
+                out.write(compressor.compress(chunk))
+            out.write(compressor.flush())
+            out.close()
+        except:
+            out.close()
+            os.unlink(tmp_path)
+            raise
+
+        sha = h.hexdigest()
+        self.tempfile_commit(tmp_path, sha)
+        return sha
+
+    def refresh(self):
+        self.dirs = dict()
+
+class GitPackDatabase(GitObjectDatabase):
+    """The packs of an objects/pack directory.  Packs are opened on first
+    use; delta bases go in cache, and REF_DELTA bases are looked up with
+    base_reader and base_info, which may look beyond these packs."""
+
+    def __init__(self, path, cache, base_reader, base_info):
+        self.path = path
+        self.cache = cache
+        self.base_reader = base_reader
+        self.base_info = base_info
+        self.packs = None
+
+    def pack_list(self, refresh=False):
+        if self.packs is None or refresh:
+            packs = list()
+            if os.path.isdir(self.path):
+                for f in sorted(os.listdir(self.path)):
+                    if f.endswith(".pack") and os.path.exists(os.path.join(self.path, f[:-5] + ".idx")):
+                        packs.append(GitPack.GitPack(os.path.join(self.path, f)))
+            self.packs = packs
+        return self.packs
+
+    def contains(self, sha):
+        binsha = bytes.fromhex(sha)
+        return any(binsha in pack for pack in self.pack_list())
+
+    def read(self, sha):
+        binsha = bytes.fromhex(sha)
+        for pack in self.pack_list():
+            ret = pack.read(binsha, self.base_reader, self.cache)
+            if ret is not None:
+                return ret
+        return None
+
+    def info(self, sha):
+        """Read only the entry header, and those of the delta chain."""
+        binsha = bytes.fromhex(sha)
+        for pack in self.pack_list():
+            ret = pack.info(binsha, self.base_info)
+            if ret is not None:
+                return ret
+        return None
+
+    def stream(self, sha):
+        """Objects stored whole are inflated incrementally.  Deltified
+        ones need their base in memory anyway and are read whole."""
+        binsha = bytes.fromhex(sha)
+        for pack in self.pack_list():
+            if binsha in pack:
+                ret = pack.stream(binsha)
+                if ret is None:
+                    fmt, data = pack.read(binsha, self.base_reader, self.cache)
+                    ret = fmt, len(data), iter([data])
+                return ret
+        return None
+
+    def find_prefix(self, prefix):
+        ret = set()
+        for pack in self.pack_list():
+            ret.update(pack.index.find_prefix(prefix))
+        return ret
+
+    def refresh(self):
+        self.pack_list(refresh=True)
+
+class GitMemoryDatabase(GitObjectDatabase):
+    """Objects in a dict, gone when the process exits.  For tests and
+    throwaway repositories; other processes, like the workers of fsck or
+    grep, don't see them."""
+
+    def __init__(self):
+        self.objects = dict()
+
+    def contains(self, sha):
+        return sha in self.objects
+
+    def read(self, sha):
+        return self.objects.get(sha)
+
+    def find_prefix(self, prefix):
+        return { sha for sha in self.objects if sha.startswith(prefix) }
+
+    def write(self, sha, fmt, data):
+        self.objects[sha] = (fmt, bytes(data))
+
+class GitSqliteDatabase(GitObjectDatabase):
+    """Objects in a single SQLite file, deflated as loose objects are.
+
+The database is in WAL mode, so readers, in this process or others,
+don't wait for a writer.  Outside of batch() every write is its own
+transaction; inside, writes are committed SQLITE_BATCH at a time, which
+is what makes bulk ingestion fast.  Objects are read whole, even when
+streamed."""
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self.batching = 0
+        self.pending = 0
+        # The connection is shared by the threads of checkout and status
+        self.lock = threading.RLock()
+
+    @property
+    def db(self):
+        """The connection, opened (and the file created) on first use."""
+        if self._db is None:
+            import sqlite3
+            # No implicit transactions, we BEGIN and COMMIT ourselves
+            db = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            # With WAL, only a checkpoint needs to fsync
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS objects (sha TEXT PRIMARY KEY, type TEXT NOT NULL, size INTEGER NOT NULL, data BLOB NOT NULL)")
+            self._db = db
+        return self._db
+
+    def query(self, sql, *args):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def contains(self, sha):
+        return bool(self.query("SELECT 1 FROM objects WHERE sha = ?", sha))
+
+    def read(self, sha):
+        rows = self.query("SELECT type, size, data FROM objects WHERE sha = ?", sha)
+        if not rows:
+            return None
+        fmt, size, data = rows[0]
+        data = zlib.decompress(data)
+        if size != len(data):
+            raise Exception("Malformed object {0}: bad length".format(sha))
+        return fmt.encode("ascii"), data
+
+    def info(self, sha):
+        rows = self.query("SELECT type, size FROM objects WHERE sha = ?", sha)
+        return (rows[0][0].encode("ascii"), rows[0][1]) if rows else None
+
+    def find_prefix(self, prefix):
+        # Hex digits all sort before "g"
+        return { row[0] for row in self.query("SELECT sha FROM objects WHERE sha >= ? AND sha < ?", prefix, prefix + "g") }
+
+    def write(self, sha, fmt, data):
+        row = (sha, fmt.decode("ascii"), len(data), zlib.compress(data))
+        with self.lock:
+            if not self.batching:
+                self.db.execute("INSERT OR IGNORE INTO objects VALUES (?, ?, ?, ?)", row)
+                return
+
+            if not self.db.in_transaction:
+                self.db.execute("BEGIN")
+            self.db.execute("INSERT OR IGNORE INTO objects VALUES (?, ?, ?, ?)", row)
+            self.pending += 1
+            if self.pending >= SQLITE_BATCH:
+                self.flush()
+
+    @contextlib.contextmanager
+    def batch(self):
+        with self.lock:
+            self.batching += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.batching -= 1
+                if not self.batching:
+                    self.flush()
+
+    def flush(self):
+        """Commit the writes of the current batch."""
+        with self.lock:
+            if self._db is not None and self._db.in_transaction:
+                self._db.execute("COMMIT")
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            if self._db is not None:
+                self.flush()
+                self._db.close()
+                self._db = None
+
+class GitChainDatabase(GitObjectDatabase):
+    """Look objects up in each of backends in turn, like git does with
+    alternates.  Writes go to primary, which should be one of them."""
+
+    def __init__(self, primary, backends):
+        self.primary = primary
+        self.backends = backends
+
+    def contains(self, sha):
+        return any(b.contains(sha) for b in self.backends)
+
+    def read(self, sha):
+        for b in self.backends:
+            ret = b.read(sha)
+            if ret is not None:
+                return ret
+        return None
+
+    def info(self, sha):
+        for b in self.backends:
+            ret = b.info(sha)
+            if ret is not None:
+                return ret
+        return None
+
+    def stream(self, sha):
+        for b in self.backends:
+            ret = b.stream(sha)
+            if ret is not None:
+                return ret
+        return None
+
+    def find_prefix(self, prefix):
+        ret = set()
+        for b in self.backends:
+            ret.update(b.find_prefix(prefix))
+        return ret
+
+    def write(self, sha, fmt, data):
+        self.primary.write(sha, fmt, data)
+
+    def write_stream(self, fmt, size, chunks):
+        return self.primary.write_stream(fmt, size, chunks)
+
+    def batch(self):
+        return self.primary.batch()
+
+    def refresh(self):
+        for b in self.backends:
+            b.refresh()
+
+    def close(self):
+        for b in self.backends:
+            b.close()
+
+def alternates(path, depth=0):
+    """Return the object directories listed in path/info/alternates, and
+    in theirs, in lookup order.  Relative paths are relative to path."""
+    ret = list()
+    if depth >= ALTERNATES_DEPTH:
+        return ret
+    try:
+        with open(os.path.join(path, "info", "alternates"), "r") as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return ret
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        alt = os.path.normpath(os.path.join(path, line))
+        if os.path.isdir(alt):
+            ret.append(alt)
+            ret.extend(alternates(alt, depth + 1))
+    return ret
+
+# Backends for wyag.objectStore.  Whatever the store, packs and loose
+# objects are still read (gc and fetch make packs), but new objects go to
+# the store.
+OBJECT_STORES = ( "loose", "sqlite", "memory" )
+
+def odb_open(repo, store=None):
+    """Return the object database of repo: its packs, then its object
+    store (wyag.objectStore, or store if given), then its loose objects
+    if that's not the store, then the packs and loose objects of its
+    alternates.  Packs use repo.raw_cache, and read REF_DELTA bases from
+    the whole database."""
+    base_reader = lambda base: GitCommands.object_read_raw(repo, base)
+    base_info = lambda base: GitCommands.object_info(repo, base)
+
+    store = store or repo.conf.get("wyag", "objectstore", fallback="loose")
+    path = repo.repo_path("objects")
+    packs = GitPackDatabase(os.path.join(path, "pack"), repo.raw_cache, base_reader, base_info)
+    loose = GitLooseDatabase(path)
+    if store == "loose":
+        primary = loose
+        backends = [ packs, loose ]
+    elif store == "sqlite":
+        primary = GitSqliteDatabase(os.path.join(path, "objects.sqlite"))
+        backends = [ packs, primary, loose ]
+    elif store == "memory":
+        primary = GitMemoryDatabase()
+        backends = [ packs, primary, loose ]
+    else:
+        raise Exception("Unknown object store {0}, expected one of {1}".format(store, ", ".join(OBJECT_STORES)))
+
+    for alt in alternates(path):
+        backends.append(GitPackDatabase(os.path.join(alt, "pack"), repo.raw_cache, base_reader, base_info))
+        backends.append(GitLooseDatabase(alt))
+
+    odb = GitChainDatabase(primary, backends)
+    # The repository's own packs, the ones gc and bitmaps deal with
+    odb.packs = packs
+    return odb
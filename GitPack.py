@@ -0,0 +1,412 @@
+import os
+import array
+import mmap
+import struct
+import zlib
+
+# Pack object types, as stored in the 3-bit type field of each entry header.
+OBJ_COMMIT    = 1
+OBJ_TREE      = 2
+OBJ_BLOB      = 3
+OBJ_TAG       = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+TYPE_NAMES = { OBJ_COMMIT: b'commit', OBJ_TREE: b'tree', OBJ_BLOB: b'blob', OBJ_TAG: b'tag' }
+
+# How much compressed data we hand to zlib at a time when inflating from the
+# mmapped pack.  zlib copies whatever it doesn't consume, so we don't want to
+# give it "the rest of the pack".
+INFLATE_CHUNK = 64 * 1024
+
+def map_file(path):
+    """mmap path read-only.  The file descriptor can be closed right away,
+    the mapping stays valid."""
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def inflate(buf, pos, size):
+    """Inflate the zlib stream starting at buf[pos], which must expand to
+    exactly size bytes."""
+    d = zlib.decompressobj()
+    view = memoryview(buf)
+    out = list()
+    while not d.eof:
+        chunk = view[pos:pos+INFLATE_CHUNK]
+        if not chunk:
+            raise Exception("Truncated zlib stream at offset {0}".format(pos))
+        out.append(d.decompress(chunk))
+        pos += len(chunk)
+    data = b''.join(out)
+    if len(data) != size:
+        raise Exception("Bad inflated size at offset {0}".format(pos))
+    return data
+
+def inflate_iter(chunks):
+    """Inflate a zlib stream given as an iterable of compressed chunks.
+    Yield the inflated data in pieces of at most INFLATE_CHUNK bytes, so
+    that memory use doesn't depend on the compression ratio."""
+    d = zlib.decompressobj()
+    for chunk in chunks:
+        while chunk:
+            out = d.decompress(chunk, INFLATE_CHUNK)
+            if out:
+                yield out
+            chunk = d.unconsumed_tail
+        if d.eof:
+            return
+    raise Exception("Truncated zlib stream")
+
+def inflate_prefix(chunks, size):
+    """Inflate the first size bytes of a zlib stream given as an iterable of
+    compressed chunks (fewer if the stream is shorter).  A dynamic Huffman
+    block starts with its code tables, so there's no telling how much input
+    that takes."""
+    d = zlib.decompressobj()
+    out = b''
+    for chunk in chunks:
+        out += d.decompress(chunk, size - len(out))
+        if len(out) >= size or d.eof:
+            break
+    return out
+
+def delta_header_size(delta, pos):
+    """Read one of the two little-endian varints at the start of a delta."""
+    size = 0
+    shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        size |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return pos, size
+
+def delta_apply(base, delta):
+    """Apply a git delta to base and return the result."""
+    pos, base_size = delta_header_size(delta, 0)
+    if base_size != len(base):
+        raise Exception("Delta base size mismatch")
+    pos, result_size = delta_header_size(delta, pos)
+
+    base = memoryview(base)
+    out = list()
+    end = len(delta)
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # Copy from base.  The low 4 bits say which offset bytes follow,
+            # the next 3 which size bytes follow.
+            offset = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            size = 0
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            out.append(base[offset:offset+size])
+        elif op:
+            # Insert the next op bytes literally
+            out.append(delta[pos:pos+op])
+            pos += op
+        else:
+            raise Exception("Invalid delta opcode 0")
+
+    ret = b''.join(out)
+    if len(ret) != result_size:
+        raise Exception("Delta result size mismatch")
+    return ret
+
+class GitPackIndex(object):
+    """A version 2 pack index (.idx file), memory-mapped.
+
+Lookups go through the 256-entry fanout table to narrow the range of
+candidate names, then binary search the sorted SHA-1 table."""
+
+    def __init__(self, path):
+        self.path = path
+        self.map = map_file(path)
+
+        magic, version = struct.unpack_from(">4sL", self.map, 0)
+        if magic != b'\xfftOc' or version != 2:
+            raise Exception("Unsupported pack index {0}".format(path))
+
+        self.fanout = struct.unpack_from(">256L", self.map, 8)
+        self.count = self.fanout[255]
+
+        # Table offsets, see gitformat-pack(5)
+        self.sha_table = 8 + 256 * 4
+        self.crc_table = self.sha_table + 20 * self.count
+        self.offset_table = self.crc_table + 4 * self.count
+        self.large_offset_table = self.offset_table + 4 * self.count
+
+    def sha(self, i):
+        """Return the binary SHA-1 of the i-th object in index order."""
+        start = self.sha_table + 20 * i
+        return self.map[start:start+20]
+
+    def offset(self, i):
+        """Return the pack offset of the i-th object in index order."""
+        off = struct.unpack_from(">L", self.map, self.offset_table + 4 * i)[0]
+        if off & 0x80000000:
+            # MSB set: the rest is an index into the 64-bit offset table
+            off = struct.unpack_from(">Q", self.map, self.large_offset_table + 8 * (off & 0x7fffffff))[0]
+        return off
+
+    def bisect(self, binsha):
+        """Return the position of the first name >= binsha."""
+        first = binsha[0]
+        lo = self.fanout[first-1] if first else 0
+        hi = self.fanout[first]
+        m = self.map
+        base = self.sha_table
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = base + 20 * mid
+            if m[start:start+20] < binsha:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, binsha):
+        """Return the index position of binsha, or None."""
+        i = self.bisect(binsha)
+        if i < self.count and self.sha(i) == binsha:
+            return i
+        return None
+
+    def find_prefix(self, prefix):
+        """Return the hex names starting with prefix (hex, at least two
+        characters), in order."""
+        ret = list()
+        i = self.bisect(bytes.fromhex(prefix.ljust(40, "0")))
+        n = self.count
+        while i < n:
+            sha = self.sha(i).hex()
+            if not sha.startswith(prefix):
+                break
+            ret.append(sha)
+            i += 1
+        return ret
+
+class GitPack(object):
+    """A packfile and its index."""
+
+    # The pack's GitBitmap, None if it has none; False until we looked.
+    bitmap = False
+
+    def __init__(self, path):
+        """path is the path to the .pack file; the .idx is found next to it."""
+        self.path = path
+        self.index = GitPackIndex(path[:-5] + ".idx")
+        self.map = map_file(path)
+
+        magic, version, count = struct.unpack_from(">4sLL", self.map, 0)
+        if magic != b'PACK' or version not in (2, 3):
+            raise Exception("Unsupported packfile {0}".format(path))
+        if count != self.index.count:
+            raise Exception("Pack and index disagree on object count: {0}".format(path))
+
+        self._order = None
+        self._positions = None
+
+    def __contains__(self, binsha):
+        return self.index.find(binsha) is not None
+
+    def order(self):
+        """Return an array of index positions in pack order, ie sorted by
+        offset.  A bit in a reachability bitmap stands for the object at
+        that place in pack order.  Read from the .rev file if there is one,
+        otherwise computed from the offsets."""
+        if self._order is None:
+            rev = self.path[:-5] + ".rev"
+            n = self.index.count
+            if os.path.exists(rev):
+                m = map_file(rev)
+                magic, version, hash_id = struct.unpack_from(">4sLL", m, 0)
+                if magic != b'RIDX' or version != 1 or hash_id != 1:
+                    raise Exception("Unsupported reverse index {0}".format(rev))
+                order = array.array("L", struct.unpack_from(">{0}L".format(n), m, 12))
+            else:
+                offsets = [ self.index.offset(i) for i in range(n) ]
+                order = array.array("L", sorted(range(n), key=offsets.__getitem__))
+            self._order = order
+        return self._order
+
+    def positions(self):
+        """The inverse of order(): pack order position of each index
+        position."""
+        if self._positions is None:
+            order = self.order()
+            positions = array.array("L", bytes(order.itemsize * len(order)))
+            for pos, i in enumerate(order):
+                positions[i] = pos
+            self._positions = positions
+        return self._positions
+
+    def position(self, binsha):
+        """Pack order position of binsha, or None."""
+        i = self.index.find(binsha)
+        return None if i is None else self.positions()[i]
+
+    def sha_at(self, pos):
+        """Binary sha of the object at pack order position pos."""
+        return self.index.sha(self.order()[pos])
+
+    def entry_header(self, offset):
+        """Parse the entry header at offset.  Return (type, size, pos), pos
+        being where the delta base reference or the zlib data starts."""
+        m = self.map
+        c = m[offset]
+        pos = offset + 1
+        typ = (c >> 4) & 7
+        size = c & 0x0f
+        shift = 4
+        while c & 0x80:
+            c = m[pos]
+            pos += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        return typ, size, pos
+
+    def ofs_delta_base(self, offset, pos):
+        """Decode the negative base offset of an OFS_DELTA entry."""
+        m = self.map
+        c = m[pos]
+        pos += 1
+        rel = c & 0x7f
+        while c & 0x80:
+            c = m[pos]
+            pos += 1
+            rel = ((rel + 1) << 7) | (c & 0x7f)
+        return offset - rel, pos
+
+    def stream(self, binsha):
+        """If binsha is stored whole (not as a delta) in this pack, return
+        (fmt, size, chunks) where chunks is an iterator over its inflated
+        data.  Return None otherwise."""
+        i = self.index.find(binsha)
+        if i is None:
+            return None
+
+        typ, size, pos = self.entry_header(self.index.offset(i))
+        if typ not in TYPE_NAMES:
+            return None
+
+        view = memoryview(self.map)
+        compressed = (view[p:p+INFLATE_CHUNK] for p in range(pos, len(view), INFLATE_CHUNK))
+        return TYPE_NAMES[typ], size, inflate_iter(compressed)
+
+    def info(self, binsha, base_info):
+        """Return (fmt, size) of object binsha without inflating it, or None
+        if it isn't in this pack.  base_info(sha) is called for REF_DELTA
+        bases outside of this pack and must return their (fmt, size)."""
+        i = self.index.find(binsha)
+        if i is None:
+            return None
+
+        offset = self.index.offset(i)
+        size = None
+        while True:
+            typ, entry_size, pos = self.entry_header(offset)
+            if typ in TYPE_NAMES:
+                return TYPE_NAMES[typ], entry_size if size is None else size
+
+            if typ == OBJ_OFS_DELTA:
+                base, pos = self.ofs_delta_base(offset, pos)
+            elif typ == OBJ_REF_DELTA:
+                base_sha = self.map[pos:pos+20]
+                pos += 20
+            else:
+                raise Exception("Unknown pack object type {0} at offset {1} in {2}".format(typ, offset, self.path))
+
+            if size is None:
+                # The object's size is the second varint of its delta,
+                # the type is the one of the base at the end of the chain.
+                size = self.delta_result_size(pos)
+
+            if typ == OBJ_OFS_DELTA:
+                offset = base
+            else:
+                i = self.index.find(base_sha)
+                if i is None:
+                    return base_info(base_sha.hex())[0], size
+                offset = self.index.offset(i)
+
+    def delta_result_size(self, pos):
+        """Read the result size of the delta whose zlib data starts at pos,
+        inflating only its first few bytes."""
+        m = self.map
+        head = inflate_prefix((m[p:p+64] for p in range(pos, len(m), 64)), 20)
+        pos, _ = delta_header_size(head, 0)
+        return delta_header_size(head, pos)[1]
+
+    def read(self, binsha, base_reader, cache=None):
+        """Read the object binsha.  Return (fmt, data), or None if it isn't
+        in this pack.
+
+base_reader(sha) is called with a hex sha to fetch REF_DELTA bases that
+live outside of this pack.  If cache (a GitObjectCache) is given, delta
+bases are looked up in and added to it."""
+        i = self.index.find(binsha)
+        if i is None:
+            return None
+        return self.read_at(self.index.offset(i), base_reader, cache)
+
+    def read_at(self, offset, base_reader, cache=None):
+        """Read the object stored at offset, resolving delta chains."""
+        # Walk down the delta chain iteratively, remembering every delta we
+        # go through, then apply them in reverse order once we hit a base.
+        deltas = list()
+        while True:
+            if cache is not None and deltas:
+                hit = cache.get((self.path, offset))
+                if hit is not None:
+                    fmt, data = hit
+                    break
+
+            typ, size, pos = self.entry_header(offset)
+            if typ == OBJ_OFS_DELTA:
+                base, pos = self.ofs_delta_base(offset, pos)
+                deltas.append((offset, inflate(self.map, pos, size)))
+                offset = base
+            elif typ == OBJ_REF_DELTA:
+                base_sha = self.map[pos:pos+20]
+                deltas.append((offset, inflate(self.map, pos + 20, size)))
+                i = self.index.find(base_sha)
+                if i is not None:
+                    offset = self.index.offset(i)
+                else:
+                    fmt, data = base_reader(base_sha.hex())
+                    break
+            elif typ in TYPE_NAMES:
+                fmt, data = TYPE_NAMES[typ], inflate(self.map, pos, size)
+                if cache is not None and deltas:
+                    cache.put((self.path, offset), (fmt, data), len(data))
+                break
+            else:
+                raise Exception("Unknown pack object type {0} at offset {1} in {2}".format(typ, offset, self.path))
+
+        for n, (offset, delta) in enumerate(reversed(deltas)):
+            data = delta_apply(data, delta)
+            # Intermediate results are bases for the next delta up the
+            # chain; the final object gets cached by the caller.
+            if cache is not None and n < len(deltas) - 1:
+                cache.put((self.path, offset), (fmt, data), len(data))
+
+        return fmt, data
+
+def pack_list(repo, refresh=False):
+    """Return the list of repo's own packs (not those of its alternates),
+    opening them on first use."""
+    return repo.odb.packs.pack_list(refresh)
+
+def pack_object_count(repo):
+    return sum(pack.index.count for pack in pack_list(repo))
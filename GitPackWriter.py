@@ -0,0 +1,338 @@
+import os
+import struct
+import hashlib
+import zlib
+import GitPack
+
+TYPE_NUMBERS = { fmt: typ for typ, fmt in GitPack.TYPE_NAMES.items() }
+
+# Deltas are found by looking up 16-byte blocks of the target in an index
+# of the base's aligned 16-byte blocks.  Git looks every target offset up;
+# in Python that's too slow, so we only try every 7th.  Since 7 and 16 are
+# coprime, any common run of at least 16 + 7 * 16 bytes is still found, and
+# matches are extended backward, so only short ones are missed.
+DELTA_BLOCK = 16
+DELTA_STEP = 7
+
+# Largest copy and insert a single delta instruction can hold.
+DELTA_MAX_COPY = 0x10000
+DELTA_MAX_INSERT = 0x7f
+
+# Objects smaller than this aren't worth deltifying.
+DELTA_MIN_SIZE = 50
+
+DEFAULT_WINDOW = 10
+DEFAULT_DEPTH = 50
+
+def pack_name_hash(path):
+    """Same as git's pack_name_hash(): a sortable number made from the last
+    sixteen non-whitespace characters of path, so that files with the same
+    name (or extension) sort together."""
+    h = 0
+    if path:
+        for c in path:
+            if c in b' \t\n\r':
+                continue
+            h = ((h >> 2) + (c << 24)) & 0xFFFFFFFF
+    return h
+
+def varint(n):
+    """The little-endian base 128 varint used in delta headers."""
+    out = bytearray()
+    while True:
+        c = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(c | 0x80)
+        else:
+            out.append(c)
+            return bytes(out)
+
+def delta_index(base):
+    """Index base for delta_create: a dict of 16-byte block -> offset."""
+    return { base[i:i+DELTA_BLOCK]: i for i in range(0, len(base) - DELTA_BLOCK + 1, DELTA_BLOCK) }
+
+def delta_copy(out, offset, size):
+    """Append instructions copying size bytes of the base at offset."""
+    while size:
+        n = min(size, DELTA_MAX_COPY)
+        op = 0x80
+        args = bytearray()
+        for i in range(4):
+            b = (offset >> (8 * i)) & 0xff
+            if b:
+                op |= 1 << i
+                args.append(b)
+        for i in range(3):
+            b = (n >> (8 * i)) & 0xff
+            if b:
+                op |= 0x10 << i
+                args.append(b)
+        out.append(op)
+        out += args
+        offset += n
+        size -= n
+
+def delta_insert(out, data):
+    """Append instructions inserting data literally."""
+    for i in range(0, len(data), DELTA_MAX_INSERT):
+        chunk = data[i:i+DELTA_MAX_INSERT]
+        out.append(len(chunk))
+        out += chunk
+
+def delta_create(base, target, index=None, max_size=None):
+    """Return a delta turning base into target, in the format
+    GitPack.delta_apply reads.  index is delta_index(base), if the caller
+    already has it.  Return None if the delta would be larger than
+    max_size."""
+    if index is None:
+        index = delta_index(base)
+
+    out = bytearray(varint(len(base)) + varint(len(target)))
+    tlen = len(target)
+    blen = len(base)
+    lit = 0
+    i = 0
+    end = tlen - DELTA_BLOCK + 1
+    while i < end:
+        b = index.get(target[i:i+DELTA_BLOCK])
+        if b is None:
+            i += DELTA_STEP
+            if max_size is not None and len(out) + i - lit > max_size:
+                return None
+            continue
+
+        # Extend the match forward, a chunk at a time then byte by byte...
+        n = DELTA_BLOCK
+        while i + n + 256 <= tlen and b + n + 256 <= blen and target[i+n:i+n+256] == base[b+n:b+n+256]:
+            n += 256
+        while i + n < tlen and b + n < blen and target[i+n] == base[b+n]:
+            n += 1
+        # ...and backward, into what we were about to insert literally.
+        while i > lit and b > 0 and target[i-1] == base[b-1]:
+            i -= 1
+            b -= 1
+            n += 1
+
+        if i > lit:
+            delta_insert(out, target[lit:i])
+        delta_copy(out, b, n)
+        i += n
+        lit = i
+
+        if max_size is not None and len(out) > max_size:
+            return None
+
+    if lit < tlen:
+        delta_insert(out, target[lit:])
+
+    if max_size is not None and len(out) > max_size:
+        return None
+    return bytes(out)
+
+def entry_header(typ, size):
+    """Encode a pack entry header: type and (inflated) size."""
+    c = (typ << 4) | (size & 0x0f)
+    size >>= 4
+    out = bytearray()
+    while size:
+        out.append(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    out.append(c)
+    return bytes(out)
+
+def ofs_delta_offset(rel):
+    """Encode the distance back to an OFS_DELTA base, the reverse of
+    GitPack.ofs_delta_base."""
+    out = bytearray([ rel & 0x7f ])
+    rel >>= 7
+    while rel:
+        rel -= 1
+        out.append(0x80 | (rel & 0x7f))
+        rel >>= 7
+    out.reverse()
+    return bytes(out)
+
+class GitPackEntry(object):
+    __slots__ = ("sha", "fmt", "size", "name_hash", "order",
+                 "base", "delta", "depth", "offset", "crc")
+
+    def __init__(self, sha, fmt, size, path, order):
+        self.sha = sha
+        self.fmt = fmt
+        self.size = size
+        self.name_hash = path if type(path) == int else pack_name_hash(path)
+        self.order = order
+        self.base = None
+        self.delta = None
+        self.depth = 0
+        self.offset = None
+        self.crc = None
+
+class GitPackWriter(object):
+    """Build a packfile and its version 2 index from a list of objects.
+
+Objects are added with their type, size and the path they were found at.
+find_deltas() then sorts them by type, path hash and size and, sliding a
+window over that order, tries each object as a delta against the ones
+just before it.  write() stores the objects in the order they were
+added, each delta base before its deltas (as OFS_DELTAs)."""
+
+    def __init__(self, read, window=DEFAULT_WINDOW, depth=DEFAULT_DEPTH):
+        """read(sha) must return (fmt, data) for every object added."""
+        self.read = read
+        self.window = window
+        self.depth = depth
+        self.entries = list()
+        self.shas = dict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, sha):
+        return sha in self.shas
+
+    def add(self, sha, fmt, size, path=None):
+        """Add object sha.  path is where it was found, or its name hash if
+        that's all we know (bitmaps keep them)."""
+        if sha in self.shas:
+            return
+        e = GitPackEntry(sha, fmt, size, path, len(self.entries))
+        self.entries.append(e)
+        self.shas[sha] = e
+
+    def find_deltas(self):
+        """Pick a delta base for every object that has a good one."""
+        if self.window <= 0 or self.depth <= 0:
+            return
+
+        # Same order as git: by type, path hash and size, all descending,
+        # so that likely bases come right before their targets.
+        order = sorted(self.entries, key=lambda e: (-TYPE_NUMBERS[e.fmt], -e.name_hash, -e.size, e.order))
+
+        # The window holds (entry, data, index) for the last few objects of
+        # the current type; indexes are built when first needed.
+        window = list()
+        for e in order:
+            if window and window[-1][0].fmt != e.fmt:
+                window = list()
+            if e.size < DELTA_MIN_SIZE:
+                continue
+
+            data = self.read(e.sha)[1]
+            best = None
+            for n in range(len(window) - 1, -1, -1):
+                base, base_data, index = window[n]
+                if base.depth >= self.depth:
+                    continue
+                # Like git, don't bother when sizes are too different.
+                max_size = len(best) if best else e.size // 2 - 20
+                if e.size < base.size // 32 or base.size - e.size > max_size:
+                    continue
+                if index is None:
+                    index = delta_index(base_data)
+                    window[n] = (base, base_data, index)
+                delta = delta_create(base_data, data, index, max_size)
+                if delta is not None and (best is None or len(delta) < len(best)):
+                    best = delta
+                    e.base = base
+            if best is not None:
+                e.delta = best
+                e.depth = e.base.depth + 1
+
+            window.append((e, data, None))
+            if len(window) > self.window:
+                window.pop(0)
+
+    def write(self, path_base):
+        """Write path_base-<checksum>.pack and .idx, through temporary
+        files.  Return the checksum (hex), which names the pack."""
+        directory = os.path.dirname(path_base) or "."
+        tmp_pack = os.path.join(directory, "tmp_pack_{0}".format(os.getpid()))
+        tmp_idx = os.path.join(directory, "tmp_idx_{0}".format(os.getpid()))
+
+        try:
+            with open(tmp_pack, "wb") as f:
+                checksum = self.write_pack(f)
+            with open(tmp_idx, "wb") as f:
+                self.write_index(f, checksum)
+
+            name = checksum.hex()
+            for tmp, ext in ((tmp_pack, ".pack"), (tmp_idx, ".idx")):
+                os.chmod(tmp, 0o444)
+                os.replace(tmp, "{0}-{1}{2}".format(path_base, name, ext))
+        except:
+            for tmp in (tmp_pack, tmp_idx):
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+            raise
+
+        return name
+
+    def write_pack(self, f):
+        h = hashlib.sha1()
+        offset = 0
+
+        def put(data):
+            nonlocal offset
+            f.write(data)
+            h.update(data)
+            offset += len(data)
+
+        put(struct.pack(">4sLL", b'PACK', 2, len(self.entries)))
+
+        for e in self.entries:
+            # Bases go first: an OFS_DELTA can only point backward.
+            chain = list()
+            while e is not None and e.offset is None:
+                chain.append(e)
+                e = e.base
+            for e in reversed(chain):
+                e.offset = offset
+                if e.delta is not None:
+                    entry = (entry_header(GitPack.OBJ_OFS_DELTA, len(e.delta))
+                             + ofs_delta_offset(offset - e.base.offset)
+                             + zlib.compress(e.delta))
+                    e.delta = None
+                else:
+                    fmt, data = self.read(e.sha)
+                    entry = entry_header(TYPE_NUMBERS[fmt], len(data)) + zlib.compress(data)
+                e.crc = zlib.crc32(entry)
+                put(entry)
+
+        checksum = h.digest()
+        f.write(checksum)
+        return checksum
+
+    def write_index(self, f, checksum):
+        """Write the version 2 index, see gitformat-pack(5)."""
+        entries = sorted(self.entries, key=lambda e: e.sha)
+        binshas = [ bytes.fromhex(e.sha) for e in entries ]
+
+        fanout = [0] * 256
+        for binsha in binshas:
+            fanout[binsha[0]] += 1
+        for i in range(1, 256):
+            fanout[i] += fanout[i-1]
+
+        offsets = list()
+        large = list()
+        for e in entries:
+            if e.offset < 0x80000000:
+                offsets.append(e.offset)
+            else:
+                offsets.append(0x80000000 | len(large))
+                large.append(e.offset)
+
+        n = len(entries)
+        out = [ b'\xfftOc', struct.pack(">L", 2),
+                struct.pack(">256L", *fanout),
+                b''.join(binshas),
+                struct.pack(">{0}L".format(n), *(e.crc for e in entries)),
+                struct.pack(">{0}L".format(n), *offsets),
+                struct.pack(">{0}Q".format(len(large)), *large),
+                checksum ]
+        data = b''.join(out)
+        f.write(data)
+        f.write(hashlib.sha1(data).digest())
@@ -0,0 +1,266 @@
+import os
+import stat
+
+# Git gives up on symbolic refs nested deeper than this
+SYMREF_MAXDEPTH = 5
+
+PACKED_REFS_HEADER = "# pack-refs with: peeled fully-peeled sorted \n"
+
+# Where a short name like "master" or "v1.0" is looked up, in order.  See
+# gitrevisions(7).
+DWIM_RULES = ( "{0}", "refs/{0}", "refs/tags/{0}", "refs/heads/{0}",
+               "refs/remotes/{0}", "refs/remotes/{0}/HEAD" )
+
+def file_stamp(st):
+    """What we compare to tell whether a file changed since we read it."""
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def packed_refs_parse(data):
+    """Parse the contents of a packed-refs file.  Return a dict of ref name
+    -> sha and a dict of ref name -> peeled sha, for the refs pointing to
+    tags."""
+    refs = dict()
+    peeled = dict()
+    last = None
+    for line in data.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("^"):
+            # Peeled value of the ref on the previous line
+            if last is None:
+                raise Exception("Malformed packed-refs: peeled line without a ref")
+            peeled[last] = line[1:]
+            continue
+        sha, _, name = line.partition(" ")
+        if len(sha) != 40 or not name:
+            raise Exception("Malformed packed-refs line: {0}".format(line))
+        refs[name] = sha
+        last = name
+    return refs, peeled
+
+def packed_refs_serialize(refs, peeled):
+    """The reverse of packed_refs_parse.  Refs are written sorted."""
+    out = [ PACKED_REFS_HEADER ]
+    for name in sorted(refs):
+        out.append("{0} {1}\n".format(refs[name], name))
+        if name in peeled:
+            out.append("^{0}\n".format(peeled[name]))
+    return "".join(out)
+
+def ref_name_valid(name):
+    """Whether name may be looked up as a ref.  Outside refs/ only names
+    like HEAD or ORIG_HEAD are refs: we don't want "config" to be one, nor
+    to wander out of the gitdir."""
+    if name.startswith("refs/"):
+        parts = name.split("/")
+        return all(p and p != "." and p != ".." and not p.endswith(".lock") for p in parts)
+    return bool(name) and all(c.isupper() or c == "_" for c in name)
+
+class GitRefStore(object):
+    """The refs of a repository: packed-refs overlaid with loose refs.
+
+packed-refs is parsed once and loose ref files read once, then both are
+only re-read when their stat data changes.  Looking a name up costs a
+dict lookup and a stat."""
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.packed_stamp = None
+        self.packed = dict()
+        self.packed_peeled = dict()
+        # Tag sha -> peeled sha, from packed_peeled
+        self.peeled_shas = dict()
+        # Loose ref name -> (stamp, contents)
+        self.loose = dict()
+        # Loose ref names under refs/, and the mtime of every directory we
+        # found them in.  Git updates refs by renaming a lock file into
+        # place, so a new, removed or replaced ref changes its directory's
+        # mtime.
+        self.listing = None
+        self.listing_dirs = None
+
+    def packed_refs(self):
+        """Return (refs, peeled) from packed-refs, re-reading it if it
+        changed."""
+        path = self.repo.repo_path("packed-refs")
+        try:
+            stamp = file_stamp(os.stat(path))
+        except FileNotFoundError:
+            stamp = None
+
+        if stamp != self.packed_stamp:
+            if stamp is None:
+                self.packed, self.packed_peeled = dict(), dict()
+            else:
+                with open(path, "r") as f:
+                    self.packed, self.packed_peeled = packed_refs_parse(f.read())
+            self.peeled_shas = { self.packed[name]: sha for name, sha in self.packed_peeled.items() }
+            self.packed_stamp = stamp
+
+        return self.packed, self.packed_peeled
+
+    def read_loose(self, name):
+        """Return the contents of the loose ref name, or None."""
+        path = self.repo.gitdir + "/" + name
+        try:
+            st = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            self.loose.pop(name, None)
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+
+        stamp = file_stamp(st)
+        cached = self.loose.get(name)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        with open(path, "r") as f:
+            value = f.read().strip()
+        self.loose[name] = (stamp, value)
+        return value
+
+    def read(self, name):
+        """Return the raw value of ref name: a sha, "ref: <target>" for a
+        symbolic ref, or None if there's no such ref."""
+        if not ref_name_valid(name):
+            return None
+        value = self.read_loose(name)
+        if value is None:
+            value = self.packed_refs()[0].get(name)
+        return value
+
+    def resolve(self, name):
+        """Follow symbolic refs from name down to a sha.  Return None if
+        name, or a ref it points to, doesn't exist."""
+        for _ in range(SYMREF_MAXDEPTH + 1):
+            value = self.read(name)
+            if value is None:
+                return None
+            if not value.startswith("ref: "):
+                return value
+            name = value[5:]
+        raise Exception("Symbolic ref {0} nested too deeply".format(name))
+
+    def dwim(self, name):
+        """Return the full name of the ref a short name refers to (eg
+        master -> refs/heads/master), or None."""
+        # This runs for every short hash too, so packed-refs is only
+        # checked for changes once.
+        packed = self.packed_refs()[0]
+        for rule in DWIM_RULES:
+            full = rule.format(name)
+            if ref_name_valid(full) and (full in packed or self.read_loose(full) is not None):
+                return full
+        return None
+
+    def peeled(self, sha):
+        """If sha is a tag that packed-refs records the peeled value of,
+        return what it peels to.  Tags are immutable, so this holds whatever
+        ref the tag came from."""
+        self.packed_refs()
+        return self.peeled_shas.get(sha)
+
+    def loose_names(self):
+        """Return the sorted names of the loose refs under refs/."""
+        if self.listing is not None:
+            try:
+                if all(os.stat(d).st_mtime_ns == m for d, m in self.listing_dirs.items()):
+                    return self.listing
+            except FileNotFoundError:
+                pass
+
+        names = list()
+        dirs = dict()
+        stack = [ "refs" ]
+        while stack:
+            rel = stack.pop()
+            path = self.repo.repo_path(rel)
+            try:
+                dirs[path] = os.stat(path).st_mtime_ns
+                it = os.scandir(path)
+            except FileNotFoundError:
+                continue
+            with it:
+                for entry in it:
+                    name = rel + "/" + entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(name)
+                    elif not entry.name.endswith(".lock"):
+                        names.append(name)
+
+        names.sort()
+        self.listing = names
+        self.listing_dirs = dirs
+        return names
+
+    def list(self):
+        """Return every ref under refs/ as a sorted list of (name, sha),
+        symbolic refs resolved.  Loose refs win over packed ones."""
+        packed = self.packed_refs()[0]
+        names = set(packed)
+        names.update(self.loose_names())
+
+        ret = list()
+        for name in sorted(names):
+            sha = self.resolve(name)
+            if sha is not None:
+                ret.append((name, sha))
+        return ret
+
+    def write_packed(self, refs, peeled):
+        """Replace packed-refs with refs and peeled (as returned by
+        packed_refs_parse), atomically through packed-refs.lock."""
+        path = self.repo.repo_path("packed-refs")
+        lock = path + ".lock"
+
+        fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(packed_refs_serialize(refs, peeled))
+            os.replace(lock, path)
+        except:
+            os.unlink(lock)
+            raise
+
+    def write_loose(self, name, value):
+        """Point loose ref name at value, a sha or "ref: <target>",
+        atomically through <name>.lock."""
+        if not ref_name_valid(name):
+            raise Exception("Invalid ref name {0}".format(name))
+        path = self.repo.gitdir + "/" + name
+        lock = path + ".lock"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(value + "\n")
+            os.replace(lock, path)
+        except:
+            os.unlink(lock)
+            raise
+        self.loose.pop(name, None)
+
+    def delete_loose(self, name, expected):
+        """Remove loose ref name if it still holds expected, then its parent
+        directories that became empty, down to refs/<category>."""
+        if self.read_loose(name) != expected:
+            return False
+        os.unlink(self.repo.repo_path(name))
+        self.loose.pop(name, None)
+
+        parts = name.split("/")[:-1]
+        while len(parts) > 2:
+            try:
+                os.rmdir(self.repo.repo_path(*parts))
+            except OSError:
+                break
+            parts.pop()
+        return True
+
+def ref_store(repo):
+    """Return repo's ref store, creating it on first use."""
+    if repo.refs is None:
+        repo.refs = GitRefStore(repo)
+    return repo.refs
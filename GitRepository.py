@@ -1,13 +1,22 @@
 import os
-import configparser
-import GitCommands
 
 class GitRepository(object):
     """A git repository"""
 
     worktree = None
     gitdir = None
-    conf = None
+    _conf = None
+    refs = None
+    object_store = None
+    _odb = None
+    commit_graph = None
+    _object_cache = None
+    _raw_cache = None
+
+    # Default byte budgets for the object caches, overridable with
+    # wyag.objectCacheLimit and wyag.rawCacheLimit in .git/config.
+    default_object_cache_limit = 32 * 1024 * 1024
+    default_raw_cache_limit = 96 * 1024 * 1024
 
     # the * in *path means a variable length argument list
     def repo_path(self, *path):
@@ -41,7 +50,8 @@ class GitRepository(object):
 
     @staticmethod
     def repo_default_config():
-        ret = configparser.ConfigParser()    
+        import configparser
+        ret = configparser.ConfigParser()
 
         ret.add_section("core")
         ret.set("core", "repositoryformatversion", "0")
@@ -50,6 +60,19 @@ class GitRepository(object):
 
         return ret
 
+    def conf_size(self, section, option, default):
+        """Read a size from the configuration, understanding git's k/m/g
+        suffixes."""
+        value = self.conf.get(section, option, fallback=None)
+        if value is None:
+            return default
+
+        value = value.strip().lower()
+        units = { "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3 }
+        if value and value[-1] in units:
+            return int(value[:-1]) * units[value[-1]]
+        return int(value)
+
     @staticmethod
     def get_git_dir(path):
         if (path.endswith(".git")):
@@ -62,7 +85,25 @@ class GitRepository(object):
             with open(self.repo_file(fileName), "w") as f:
                 f.write(initialContent)
 
-    def __init__(self, path):
+    def __init__(self, path, create=False, object_store=None):
+        """Open the repository at path.  Opening only checks that the
+        gitdir exists: the configuration and caches are set up on first
+        use, and nothing is written.  With create, missing directories and
+        files are created first, as for a new repository.  object_store
+        overrides wyag.objectStore, see GitObjectDatabase.odb_open."""
+
+        if create:
+            self.create(path)
+
+        self.object_store = object_store
+
+        self.worktree = path
+        self.gitdir = self.get_git_dir(self.worktree)
+
+        if not os.path.isdir(self.gitdir):
+            raise Exception("Not a Git repository %s" % path)
+
+    def create(self, path):
         # First, we make sure the path either doesn't exist or is an empty dir.
 
         if os.path.exists(path):
@@ -76,9 +117,6 @@ class GitRepository(object):
         self.worktree = path
         self.gitdir = self.get_git_dir(self.worktree)
 
-        if not os.path.isdir(self.gitdir):
-            raise Exception("Not a Git repository %s" % path)
-
         assert(self.repo_dir("branches", mkdir=True))
         assert(self.repo_dir("objects", mkdir=True))
         assert(self.repo_dir("refs", "tags", mkdir=True))
@@ -96,15 +134,48 @@ class GitRepository(object):
                 config = self.repo_default_config()
                 config.write(f)
 
-        # Read configuration file in .git/config
-        self.conf = configparser.ConfigParser()
-        cf = self.repo_file("config")
+    @property
+    def conf(self):
+        """The configuration in .git/config, read on first access."""
+        if self._conf is None:
+            import configparser
 
-        if cf and os.path.exists(cf):
-            self.conf.read([cf])
-        else:
-            raise Exception("Configuration file missing")
+            # Read configuration file in .git/config
+            conf = configparser.ConfigParser()
+            cf = self.repo_path("config")
 
-        vers = int(self.conf.get("core", "repositoryformatversion"))
-        if vers != 0:
-            raise Exception("Unsupported repositoryformatversion %s" % vers)
\ No newline at end of file
+            if os.path.exists(cf):
+                conf.read([cf])
+            else:
+                raise Exception("Configuration file missing")
+
+            vers = int(conf.get("core", "repositoryformatversion"))
+            if vers != 0:
+                raise Exception("Unsupported repositoryformatversion %s" % vers)
+
+            self._conf = conf
+        return self._conf
+
+    @property
+    def object_cache(self):
+        """Cache of parsed objects, see GitCommands.object_read."""
+        if self._object_cache is None:
+            import GitObjectCache
+            self._object_cache = GitObjectCache.GitObjectCache(self.conf_size("wyag", "objectcachelimit", self.default_object_cache_limit))
+        return self._object_cache
+
+    @property
+    def raw_cache(self):
+        """Cache of raw object data and pack delta bases."""
+        if self._raw_cache is None:
+            import GitObjectCache
+            self._raw_cache = GitObjectCache.GitObjectCache(self.conf_size("wyag", "rawcachelimit", self.default_raw_cache_limit))
+        return self._raw_cache
+
+    @property
+    def odb(self):
+        """The object database, opened on first use."""
+        if self._odb is None:
+            import GitObjectDatabase
+            self._odb = GitObjectDatabase.odb_open(self, self.object_store)
+        return self._odb
@@ -0,0 +1,183 @@
+import os
+import stat
+import concurrent.futures
+import GitCommands
+import GitIndex
+
+# The index stores stat data truncated to 32 bits
+MASK32 = 0xFFFFFFFF
+
+GITLINK_MODE = 0o160000
+
+def worktree_scan(root, jobs=None):
+    """lstat every file under root (bytes), skipping .git directories.
+    Directories are listed in parallel by a pool of jobs threads.  Return
+    a dict of relative path (bytes, / separated) -> os.stat_result."""
+
+    def scan(rel):
+        files = list()
+        subdirs = list()
+        with os.scandir(os.path.join(root, rel) if rel else root) as it:
+            for entry in it:
+                if entry.name == b'.git':
+                    continue
+                path = rel + b'/' + entry.name if rel else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(path)
+                else:
+                    files.append((path, entry.stat(follow_symlinks=False)))
+        return files, subdirs
+
+    ret = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        pending = { pool.submit(scan, b'') }
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                files, subdirs = f.result()
+                ret.update(files)
+                for d in subdirs:
+                    pending.add(pool.submit(scan, d))
+
+    return ret
+
+def mode_from_stat(st):
+    """The mode git would record for a file with this stat data."""
+    if stat.S_ISLNK(st.st_mode):
+        return 0o120000
+    if st.st_mode & 0o100:
+        return 0o100755
+    return 0o100644
+
+def stat_matches(e, st, filemode=True):
+    """Whether the stat data cached in index entry e still describes the
+    file.  Same fields as git's ie_match_stat(), minus dev."""
+    if e.mtime != (int(st.st_mtime) & MASK32, st.st_mtime_ns % 1000000000):
+        return False
+    if e.ctime != (int(st.st_ctime) & MASK32, st.st_ctime_ns % 1000000000):
+        return False
+    if e.ino != st.st_ino & MASK32 or e.size != st.st_size & MASK32:
+        return False
+    if e.uid != st.st_uid or e.gid != st.st_gid:
+        return False
+    return modes_match(e.mode, mode_from_stat(st), filemode)
+
+def modes_match(index_mode, file_mode, filemode=True):
+    if stat.S_IFMT(index_mode) != stat.S_IFMT(file_mode):
+        return False
+    return index_mode == file_mode or not filemode
+
+def is_racy(e, index_mtime_ns):
+    """An entry is racily clean if the file may have been modified in the
+    same timestamp tick the index was written in: the cached stat data
+    would still match, so we have to look at the contents."""
+    mtime_ns = e.mtime[0] * 1000000000 + e.mtime[1]
+    return mtime_ns >= index_mtime_ns
+
+def file_hash(path, st):
+    """Hash the file at path as a blob, the way git would store it."""
+    if stat.S_ISLNK(st.st_mode):
+        target = os.readlink(path)
+        return GitCommands.object_hash_bytes(target, b'blob')
+    with open(path, "rb") as fd:
+        return GitCommands.object_hash_stream(fd, b'blob', os.fstat(fd.fileno()).st_size)
+
+def entry_refresh(e, st):
+    """Store st in index entry e."""
+    e.ctime = (int(st.st_ctime) & MASK32, st.st_ctime_ns % 1000000000)
+    e.mtime = (int(st.st_mtime) & MASK32, st.st_mtime_ns % 1000000000)
+    e.dev = st.st_dev & MASK32
+    e.ino = st.st_ino & MASK32
+    e.uid = st.st_uid
+    e.gid = st.st_gid
+    e.size = st.st_size & MASK32
+
+def head_tree(repo):
+    """Return {path: (mode, sha)} for HEAD's tree, empty if HEAD is unborn."""
+    if GitCommands.ref_resolve(repo, "HEAD") is None:
+        return dict()
+    sha = GitCommands.object_find(repo, "HEAD", fmt=b'tree')
+    return { path: (mode, sha) for path, mode, sha in GitCommands.tree_walk(repo, sha) }
+
+def status(repo, jobs=None, refresh=True):
+    """Compare HEAD, the index and the worktree.  Return a sorted list of
+    (XY, path) in the format of git status --porcelain, untracked files
+    ("??") last.
+
+    Files whose cached stat data matches are assumed clean, only the others
+    (and racily clean ones) are rehashed.  Those that turn out unchanged
+    get their stat data refreshed in the index if refresh is set, so the
+    next run doesn't hash them again."""
+
+    index_path = repo.repo_path("index")
+    index = GitIndex.index_read(repo)
+    index_mtime_ns = os.stat(index_path).st_mtime_ns if os.path.exists(index_path) else 0
+    filemode = repo.conf.getboolean("core", "filemode", fallback=True)
+
+    head = head_tree(repo)
+    files = worktree_scan(os.fsencode(repo.worktree), jobs)
+
+    staged = dict()
+    unstaged = dict()
+    tracked = set()
+    to_hash = list()
+
+    for e in index.entries:
+        path = e.name
+        tracked.add(path)
+
+        if e.flag_stage:
+            staged[path] = 'U'
+            unstaged[path] = 'U'
+            continue
+
+        # Index against HEAD
+        if e.flag_intent_to_add:
+            unstaged[path] = 'A'
+            continue
+        if path not in head:
+            staged[path] = 'A'
+        elif head[path] != (e.mode, e.obj):
+            staged[path] = 'M'
+
+        # Worktree against index
+        if e.mode == GITLINK_MODE:
+            continue
+        st = files.get(path)
+        if st is None:
+            unstaged[path] = 'D'
+        elif not modes_match(e.mode, mode_from_stat(st), filemode):
+            unstaged[path] = 'M'
+        elif not stat_matches(e, st, filemode) or is_racy(e, index_mtime_ns):
+            to_hash.append((e, st))
+
+    # Only the files whose stat data changed get hashed, in parallel.
+    worktree = os.fsencode(repo.worktree)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        shas = pool.map(lambda x: file_hash(os.path.join(worktree, x[0].name), x[1]), to_hash)
+
+        refreshed = False
+        for (e, st), sha in zip(to_hash, shas):
+            if sha != e.obj:
+                unstaged[e.name] = 'M'
+            else:
+                # Racily clean entries need the index rewritten too: once
+                # it's newer than the file, they aren't racy anymore.
+                entry_refresh(e, st)
+                refreshed = True
+
+    for path in head:
+        if path not in tracked:
+            staged[path] = 'D'
+
+    if refresh and refreshed:
+        try:
+            GitIndex.index_write(repo, index)
+        except FileExistsError:
+            # Someone else holds index.lock; we'll refresh next time.
+            pass
+
+    ret = [ (staged.get(path, ' ') + unstaged.get(path, ' '), path)
+            for path in sorted(set(staged) | set(unstaged)) ]
+    ret += [ ('??', path) for path in sorted(files) if path not in tracked ]
+    return ret
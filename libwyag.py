@@ -1,12 +1,16 @@
 import sys
 import argparse
 import collections
-import configparser
-import hashlib
+import itertools
 import os
-import zlib
+import stat
 from GitCommands import *
-import GitRepository
+
+# Tree entry mode of submodules
+GITLINK_MODE = 0o160000
+
+# Default output format of cat-file --batch and --batch-check
+BATCH_FORMAT = "%(objectname) %(objecttype) %(objectsize)"
 
 argparser = argparse.ArgumentParser(description="The stupid content tracker")
 
@@ -15,123 +19,495 @@ argsubparsers.required = True
 
 argsp = argsubparsers.add_parser("init", help="Initialize a new, empty repository.")
 argsp.add_argument("path", metavar="directory", nargs="?", default=".", help="Where to create the repository.")
+argsp.add_argument("--object-store", choices=["loose", "sqlite"], default=None, help="Where new objects go, saved as wyag.objectStore (default: loose).")
+
+argsp = argsubparsers.add_parser("archive", help="Create a tar archive of a tree, straight from the object store.")
+argsp.add_argument("--format", choices=["tar", "tar.gz", "tgz"], default=None, help="Archive format (default: from the output file name, else tar).")
+argsp.add_argument("--prefix", default="", help="Prepend prefix to every path (end it with / for a directory).")
+argsp.add_argument("-o", "--output", default=None, help="Write the archive to this file instead of stdout.")
+argsp.add_argument("tree", help="The commit or tree to archive.")
 
 argsp = argsubparsers.add_parser("cat-file", help="Provide content of repository objects")
-argsp.add_argument("type", metavar="type", choices=["blob", "commit", "tag", "tree"], help="Specify the type")
-argsp.add_argument("object", metavar="object", help="The object to display")
+argsp.add_argument("-t", action="store_const", const="type", dest="info", help="Show the object's type instead of its content")
+argsp.add_argument("-s", action="store_const", const="size", dest="info", help="Show the object's size instead of its content")
+argsp.add_argument("--batch", metavar="format", nargs="?", const=BATCH_FORMAT, default=None, help="Print information and contents of each object named on stdin")
+argsp.add_argument("--batch-check", metavar="format", dest="batch_check", nargs="?", const=BATCH_FORMAT, default=None, help="Print information about each object named on stdin")
+argsp.add_argument("--buffer", action="store_true", help="Don't flush the output after each object in batch mode")
+argsp.add_argument("type", metavar="type", nargs="?", help="Specify the type (blob, commit, tag or tree)")
+argsp.add_argument("object", metavar="object", nargs="?", help="The object to display")
+
+argsp = argsubparsers.add_parser("commit-graph", help="Write the commit-graph file.")
+argsp.add_argument("action", choices=["write"], help="What to do.")
+argsp.add_argument("--reachable", action="store_true", help="Include every commit reachable from refs (the only mode supported).")
+argsp.add_argument("--changed-paths", action="store_true", default=None, dest="changed_paths", help="Compute changed-path Bloom filters, for log -- <path>.")
+argsp.add_argument("--no-changed-paths", action="store_false", dest="changed_paths", help="Don't write Bloom filters, even if the current commit-graph has them.")
+
+argsp = argsubparsers.add_parser("grep", help="Print lines matching a pattern in a revision, without checking it out.")
+argsp.add_argument("-i", "--ignore-case", action="store_true", dest="ignore_case", help="Ignore case differences.")
+argsp.add_argument("-F", "--fixed-strings", action="store_true", dest="fixed", help="The pattern is a fixed string, not a (Python) regular expression.")
+argsp.add_argument("-n", "--line-number", action="store_true", dest="line_number", help="Prefix lines with their number.")
+argsp.add_argument("-l", "--files-with-matches", action="store_true", dest="files", help="Only print the names of files with matches.")
+argsp.add_argument("-c", "--count", action="store_true", help="Print the number of matching lines of each file.")
+argsp.add_argument("-j", metavar="jobs", dest="jobs", type=int, default=None, help="Number of processes searching (default: one per CPU).")
+argsp.add_argument("pattern", help="The pattern to look for.")
+argsp.add_argument("rev", nargs="?", default="HEAD", help="The commit or tree to search (default: HEAD).")
 
 argsp = argsubparsers.add_parser("hash-object", help="Compute object ID and optionally creates a blob from a file")
 argsp.add_argument("-t", metavar="type", dest="type", choices=["blob", "commit", "tag", "tree"], default="blob", help="Specify the type")
 argsp.add_argument("-w", dest="write", action="store_true", help="Actually write the object into the database")
-argsp.add_argument("path", help="Read object from <file>")
+argsp.add_argument("--stdin-paths", dest="stdin_paths", action="store_true", help="Read file names from stdin, one per line")
+argsp.add_argument("-j", metavar="jobs", dest="jobs", type=int, default=None, help="Number of processes hashing files (default: one per CPU).")
+argsp.add_argument("path", nargs="*", help="Read object from <file>")
+
+argsp = argsubparsers.add_parser("diff-tree", help="Compare the content and mode of two trees.")
+argsp.add_argument("-r", action="store_true", dest="recursive", help="Recurse into sub-trees.")
+argsp.add_argument("tree1", help="The tree (or commit) to compare from.")
+argsp.add_argument("tree2", help="The tree (or commit) to compare to.")
+
+argsp = argsubparsers.add_parser("fsck", help="Verify the integrity and connectivity of the objects.")
+argsp.add_argument("-j", metavar="jobs", dest="jobs", type=int, default=None, help="Number of processes checking objects (default: one per CPU).")
+argsp.add_argument("--no-dangling", action="store_false", dest="dangling", help="Don't print dangling objects.")
+argsp.add_argument("--progress", action="store_true", default=None, help="Show progress (the default when stderr is a terminal).")
+argsp.add_argument("--no-progress", action="store_false", dest="progress", help="Don't show progress.")
+
+argsp = argsubparsers.add_parser("gc", help="Pack refs and objects, and delete the loose objects that got packed.")
+argsp.add_argument("--window", metavar="n", type=int, default=None, help="Number of objects each object is tried as a delta against (default: 10).")
+argsp.add_argument("--depth", metavar="n", type=int, default=None, help="Maximum delta chain length (default: 50).")
 
 argsp = argsubparsers.add_parser("log", help="Display history of a given commit.")
-argsp.add_argument("commit", default="HEAD", nargs="?", help="Commit to start at.")
+argsp.add_argument("--oneline", action="store_true", help="Show one commit per line instead of a graphviz graph.")
+argsp.add_argument("-n", "--max-count", metavar="number", dest="max_count", type=int, default=None, help="Limit the number of commits to output.")
+argsp.add_argument("--since", metavar="date", default=None, help="Show commits more recent than a date (unix timestamp or ISO 8601).")
+argsp.add_argument("--topo-order", action="store_const", const="topo", dest="sort", help="Show no parents before all of their children are shown, keeping lines of history together.")
+argsp.add_argument("--date-order", action="store_const", const="date", dest="sort", help="Show no parents before all of their children are shown, otherwise by commit date.")
+argsp.add_argument("commit", default=["HEAD"], nargs="*", help="Commits to start at, then -- and the paths to limit history to.")
 
 argsp = argsubparsers.add_parser("ls-tree", help="Pretty-print a tree object.")
+argsp.add_argument("-r", action="store_true", dest="recursive", help="Recurse into sub-trees.")
+argsp.add_argument("-t", action="store_true", dest="show_trees", help="Show trees when recursing.")
+argsp.add_argument("-l", "--long", action="store_true", dest="long", help="Show object sizes.")
 argsp.add_argument("object", help="The object to show.")
 
 argsp = argsubparsers.add_parser("checkout", help="Checkout a commit inside of a directory.")
+argsp.add_argument("-j", metavar="jobs", dest="jobs", type=int, default=None, help="Number of threads writing files (default: one per CPU).")
 argsp.add_argument("commit", help="The commit or tree to checkout.")
-argsp.add_argument("path", help="The EMPTY directory to checkout on.")
+argsp.add_argument("path", nargs="?", help="The EMPTY directory to checkout on.  Without it, the repository's worktree is updated in place.")
 
 argsp = argsubparsers.add_parser("show-ref", help="List references.")
+argsp.add_argument("-d", "--dereference", action="store_true", dest="dereference", help="Also show what tags peel to, as <ref>^{}.")
+
+argsp = argsubparsers.add_parser("pack-objects", help="Write a pack of the objects named on stdin.")
+argsp.add_argument("--window", metavar="n", type=int, default=None, help="Number of objects each object is tried as a delta against (default: 10).")
+argsp.add_argument("--depth", metavar="n", type=int, default=None, help="Maximum delta chain length (default: 50).")
+argsp.add_argument("base_name", metavar="base-name", help="Write base-name-<checksum>.pack and .idx.")
+
+argsp = argsubparsers.add_parser("pack-refs", help="Pack refs into packed-refs.")
+argsp.add_argument("--all", action="store_true", dest="all", help="Pack all refs, not only tags and already packed ones.")
+argsp.add_argument("--no-prune", action="store_false", dest="prune", help="Keep the loose refs that were packed.")
+
+argsp = argsubparsers.add_parser("status", help="Show the working tree status (in git status --porcelain format).")
+argsp.add_argument("-j", metavar="jobs", dest="jobs", type=int, default=None, help="Number of threads scanning and hashing files (default: one per CPU).")
 
 argsp = argsubparsers.add_parser("tag", help="List and create tags.")
 argsp.add_argument("-a", action="store_true", dest="create_tag_object", help="Whether to create a tag object.")
 argsp.add_argument("name", nargs="?", help="The new tag's name.")
 argsp.add_argument("object", default="HEAD", nargs="?", help="The object the new tag will point to.")
 
+argsp = argsubparsers.add_parser("ls-files", help="Show information about files in the index.")
+argsp.add_argument("-s", "--stage", action="store_true", dest="stage", help="Show mode, object name and stage number.")
+
+argsp = argsubparsers.add_parser("update-index", help="Rewrite the index file.")
+argsp.add_argument("--index-version", metavar="version", dest="index_version", type=int, choices=[2, 3, 4], required=True, help="Write the index in this format.")
+
+argsp = argsubparsers.add_parser("merge-base", help="Find the best common ancestors of two commits.")
+argsp.add_argument("-a", "--all", action="store_true", dest="all", help="Output all merge bases instead of one.")
+argsp.add_argument("--is-ancestor", action="store_true", dest="is_ancestor", help="Exit with status 0 if the first commit is an ancestor of the second, 1 otherwise.")
+argsp.add_argument("commit1", help="First commit.")
+argsp.add_argument("commit2", help="Second commit.")
+
+argsp = argsubparsers.add_parser("rev-list", help="List the commits (or objects) reachable from some commits but not others.")
+argsp.add_argument("--objects", action="store_true", help="List trees, blobs and tags too.")
+argsp.add_argument("--count", action="store_true", help="Only print how many there are.")
+argsp.add_argument("--all", action="store_true", help="Start from HEAD and every ref.")
+argsp.add_argument("--no-use-bitmap-index", action="store_false", dest="use_bitmap", help="Walk the objects even if there is a bitmap.")
+argsp.add_argument("revs", nargs="*", help="Commits to start from, ^commit to exclude what a commit reaches.")
+
 argsp = argsubparsers.add_parser("rev-parse", help="Parse revision (or other objects) identifiers.")
 argsp.add_argument("--wyag-type", metavar="type", dest="type", choices=["blob", "commit", "tag", "tree"], default=None, help="Specify the expected type.")
-argsp.add_argument("name", help="The name to parse.")
+argsp.add_argument("--short", metavar="length", nargs="?", const="", default=None, help="Print the shortest unique abbreviation of the object name, at least length characters long.")
+argsp.add_argument("name", nargs="?", help="The name to parse.")
 
 def main(argv=sys.argv[1:]):
+    # argparse can't tell log's commits from the paths after "--"
+    paths = None
+    if argv[:1] == ["log"] and "--" in argv:
+        i = argv.index("--")
+        argv, paths = argv[:i], argv[i+1:]
+
     args = argparser.parse_args(argv)
+    args.paths = paths
 
     if   args.command == "add"          : cmd_add(args)
+    elif args.command == "archive"      : cmd_archive(args)
     elif args.command == "cat-file"     : cmd_cat_file(args)
     elif args.command == "checkout"     : cmd_checkout(args)
     elif args.command == "commit"       : cmd_commit(args)
+    elif args.command == "commit-graph" : cmd_commit_graph(args)
+    elif args.command == "diff-tree"    : cmd_diff_tree(args)
+    elif args.command == "fsck"         : cmd_fsck(args)
+    elif args.command == "gc"           : cmd_gc(args)
+    elif args.command == "grep"         : cmd_grep(args)
     elif args.command == "hash-object"  : cmd_hash_object(args)
     elif args.command == "init"         : cmd_init(args)
     elif args.command == "log"          : cmd_log(args)
+    elif args.command == "ls-files"     : cmd_ls_files(args)
     elif args.command == "ls-tree"      : cmd_ls_tree(args)
     elif args.command == "merge"        : cmd_merge(args)
+    elif args.command == "merge-base"   : cmd_merge_base(args)
+    elif args.command == "pack-objects" : cmd_pack_objects(args)
+    elif args.command == "pack-refs"    : cmd_pack_refs(args)
     elif args.command == "rebase"       : cmd_rebase(args)
+    elif args.command == "rev-list"     : cmd_rev_list(args)
     elif args.command == "rev-parse"    : cmd_rev_parse(args)
     elif args.command == "rm"           : cmd_rm(args)
     elif args.command == "show-ref"     : cmd_show_ref(args)
+    elif args.command == "status"       : cmd_status(args)
     elif args.command == "tag"          : cmd_tag(args)
+    elif args.command == "update-index" : cmd_update_index(args)
 
 def cmd_init(args):
-    repo_create(args.path)
+    repo = repo_create(args.path)
+    if args.object_store:
+        conf = repo.conf
+        if not conf.has_section("wyag"):
+            conf.add_section("wyag")
+        conf.set("wyag", "objectstore", args.object_store)
+        with open(repo.repo_path("config"), "w") as f:
+            conf.write(f)
+
+def cmd_archive(args):
+    import time
+    import GitArchive
+    repo = repo_find()
+    tree = object_find(repo, args.tree, fmt=b'tree')
+
+    # Like git, entries get the commit's date and the archive its sha;
+    # a bare tree gets the current time.
+    commit = object_find(repo, args.tree, fmt=b'commit')
+    if commit:
+        mtime = commit_info(repo, commit)[0]
+    else:
+        mtime = int(time.time())
+
+    fmt = args.format
+    if fmt is None:
+        fmt = "tar.gz" if args.output and args.output.endswith((".tar.gz", ".tgz")) else "tar"
+
+    f = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        GitArchive.archive_tar(repo, tree, f, compress=fmt != "tar", prefix=args.prefix.encode("utf8"),
+                               mtime=mtime, comment=commit)
+    finally:
+        if args.output:
+            f.close()
 
 def cmd_cat_file(args):
     repo = repo_find()
+
+    if args.batch or args.batch_check:
+        if args.type or args.info:
+            argparser.error("cat-file --batch and --batch-check don't take other arguments")
+        cat_file_batch(repo, sys.stdin.buffer, sys.stdout.buffer,
+                       args.batch or args.batch_check, contents=bool(args.batch), flush=not args.buffer)
+        return
+
+    if args.info:
+        # With a single positional argument, argparse calls it the type.
+        if args.object:
+            argparser.error("cat-file -t and -s don't take a type")
+        fmt, size = object_info(repo, object_find(repo, args.type))
+        print(fmt.decode("ascii") if args.info == "type" else size)
+        return
+
+    if not args.object:
+        argparser.error("cat-file needs a type and an object, or one of -t, -s, --batch and --batch-check")
+    if args.type not in ("blob", "commit", "tag", "tree"):
+        argparser.error("invalid type {0}".format(args.type))
     cat_file(repo, args.object, fmt=args.type.encode())
 
+def cat_file_batch(repo, inp, out, format, contents=True, flush=True):
+    """Read object names from inp, one per line, and write a line
+    describing each to out, followed by its contents if contents is set.
+    Output is byte-compatible with git cat-file --batch/--batch-check.
+
+    This is meant for tools that need many objects: the repository, its
+    caches and resolved refs stay warm across requests."""
+
+    # Like git, only split the object name from the rest of the line if
+    # the format uses it.
+    split = "%(rest)" in format
+
+    for line in inp:
+        line = line.rstrip(b'\n').decode("utf8")
+        if split:
+            name, _, rest = line.lstrip().partition(" ")
+        else:
+            name, rest = line, ""
+
+        try:
+            candidates = object_resolve(repo, name)
+        except Exception:
+            candidates = None
+
+        if candidates and len(candidates) > 1:
+            out.write("{0} ambiguous\n".format(name).encode("utf8"))
+        elif not candidates:
+            out.write("{0} missing\n".format(name).encode("utf8"))
+        else:
+            sha = candidates[0]
+            try:
+                fmt, size = object_info(repo, sha)
+            except Exception:
+                out.write("{0} missing\n".format(name).encode("utf8"))
+            else:
+                out.write(format.replace("%(objectname)", sha)
+                          .replace("%(objecttype)", fmt.decode("ascii"))
+                          .replace("%(objectsize)", str(size))
+                          .replace("%(rest)", rest).encode("utf8") + b'\n')
+                if contents:
+                    for chunk in object_stream(repo, sha)[2]:
+                        out.write(chunk)
+                    out.write(b'\n')
+
+        if flush:
+            out.flush()
+
 def cat_file(repo, obj, fmt=None):
+    if fmt == b'blob':
+        # Blobs can be huge, stream them straight to stdout.
+        ofmt, size, chunks = object_stream(repo, object_find(repo, obj))
+        if ofmt == b'blob':
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            return
+
     obj = object_read(repo, object_find(repo, obj, fmt=fmt))
     sys.stdout.buffer.write(obj.serialize())
 
+def cmd_grep(args):
+    import re
+    import GitGrep
+    repo = repo_find()
+    tree = object_find(repo, args.rev, fmt=b'tree')
+
+    pattern = args.pattern.encode("utf8")
+    if args.fixed:
+        pattern = re.escape(pattern)
+    flags = re.IGNORECASE if args.ignore_case else 0
+
+    # Binary blobs are skipped, as with git grep -I
+    found = False
+    prefix = args.rev.encode("utf8") + b':'
+    out = sys.stdout.buffer
+    for path, matches in GitGrep.grep(repo, tree, pattern, flags, jobs=args.jobs):
+        found = True
+        name = prefix + path
+        if args.files:
+            out.write(name + b'\n')
+        elif args.count:
+            out.write(name + b':' + str(len(matches)).encode("ascii") + b'\n')
+        else:
+            for lineno, line in matches:
+                if args.line_number:
+                    out.write(name + b':' + str(lineno).encode("ascii") + b':' + line + b'\n')
+                else:
+                    out.write(name + b':' + line + b'\n')
+        out.flush()
+
+    if not found:
+        sys.exit(1)
+
 def cmd_hash_object(args):
-    if args.write:
-        repo = GitRepository.GitRepository(".")
-    else:
-        repo = None
+    paths = args.path
+    if args.stdin_paths:
+        paths = paths + [ line.rstrip("\n") for line in sys.stdin ]
+    if not paths:
+        argparser.error("hash-object needs a path, or --stdin-paths")
+
+    fmt = args.type.encode()
+    gitdir = repo_find().gitdir if args.write else None
+    jobs = args.jobs or os.cpu_count()
+
+    if len(paths) == 1 or jobs == 1:
+        import contextlib
+        with (repo_find().odb.batch() if gitdir else contextlib.nullcontext()):
+            for path in paths:
+                print(hash_object_worker(path, fmt, gitdir))
+        return
 
-    with open(args.path, "rb") as fd:
-        sha = object_hash(fd, args.type.encode(), repo)
-        print(sha)
+    # Hashing and deflating are CPU-bound, so we use processes.  map()
+    # returns results in input order.
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        for sha in pool.map(hash_object_worker, paths, itertools.repeat(fmt), itertools.repeat(gitdir),
+                            chunksize=max(1, min(64, len(paths) // (4 * jobs)))):
+            print(sha)
+
+# Repository opened by hash_object_worker, once per process.
+hash_object_repo = None
+
+def hash_object_worker(path, fmt, gitdir):
+    """Hash the file at path, writing it to the repository at gitdir if
+    gitdir isn't None.  Return its sha."""
+    global hash_object_repo
+    repo = None
+    if gitdir:
+        if hash_object_repo is None or hash_object_repo.gitdir != gitdir:
+            hash_object_repo = repo_find(gitdir)
+        repo = hash_object_repo
+
+    with open(path, "rb") as fd:
+        return object_hash(fd, fmt, repo)
 
 def cmd_log(args):
     repo = repo_find()
 
-    print("digraph wyaglog{")
-    log_graphviz(repo, object_find(repo, args.commit), set())
-    print("}")
+    # Paths are relative to the current directory, like git's
+    paths = None
+    if args.paths:
+        paths = list()
+        for path in args.paths:
+            path = os.path.relpath(os.path.abspath(path), repo.worktree)
+            if path.startswith(".."):
+                raise Exception("{0} is outside the repository".format(path))
+            paths.append(b'' if path == "." else path.encode("utf8"))
+
+    walk = rev_walk(repo,
+                    [ object_find(repo, c, fmt=b'commit') for c in args.commit ],
+                    max_count=args.max_count,
+                    since=parse_date(args.since) if args.since else None,
+                    sort=args.sort,
+                    paths=paths)
+
+    if args.oneline:
+        log_oneline(repo, walk)
+    else:
+        print("digraph wyaglog{")
+        log_graphviz(walk)
+        print("}")
+
+def parse_date(date):
+    """Parse a date given on the command line into a unix timestamp."""
+    if date.isdigit():
+        return int(date)
+    import datetime
+    d = datetime.datetime.fromisoformat(date)
+    if d.tzinfo is None:
+        d = d.astimezone()
+    return int(d.timestamp())
+
+def log_graphviz(walk):
+    for sha, parents in walk:
+        for p in parents:
+            print("c_{0} -> c_{1};".format(sha, p))
+
+def log_oneline(repo, walk):
+    for sha, parents in walk:
+        message = object_read(repo, sha).kvlm[b''].decode("utf8", "replace")
+        print("{0} {1}".format(sha[:7], message.split("\n", 1)[0]))
+
+def cmd_commit_graph(args):
+    repo = repo_find()
+    commit_graph_write(repo, changed_paths=args.changed_paths)
 
-def log_graphviz(repo, sha, seen):
-    if sha in seen:
-        return
-    seen.add(sha)
+def cmd_diff_tree(args):
+    repo = repo_find()
+    a = object_find(repo, args.tree1, fmt=b'tree')
+    b = object_find(repo, args.tree2, fmt=b'tree')
+    null = "0" * 40
+    for path, old_mode, new_mode, old_sha, new_sha, status in tree_diff(repo, a, b, recursive=args.recursive):
+        print(":{0:06o} {1:06o} {2} {3} {4}\t{5}".format(old_mode, new_mode, old_sha or null, new_sha or null,
+                                                        status, path.decode("utf8")))
+
+def cmd_merge_base(args):
+    repo = repo_find()
+    a = object_find(repo, args.commit1, fmt=b'commit')
+    b = object_find(repo, args.commit2, fmt=b'commit')
 
-    commit = object_read(repo, sha)
-    assert(commit.fmt == b'commit')
+    if args.is_ancestor:
+        sys.exit(0 if is_ancestor(repo, a, b) else 1)
 
-    if not b'parent' in commit.kvlm.keys():
-        # initial commit
-        return
+    bases = merge_bases(repo, a, b)
+    if not bases:
+        sys.exit(1)
+    for sha in (bases if args.all else bases[:1]):
+        print(sha)
 
-    parents = commit.kvlm[b'parent']
-    if type(parents) != list:
-        parents = [parents]
+def cmd_ls_tree(args):
+    repo = repo_find()
+    obj = object_read(repo, object_find(repo, args.object, fmt=b'tree'))
+
+    # A stack of (path prefix, entry iterator), so that we can go down
+    # into sub-trees in place without recursion.
+    stack = [ (b'', iter(obj)) ]
+    while stack:
+        prefix, entries = stack[-1]
+        item = next(entries, None)
+        if item is None:
+            stack.pop()
+            continue
+
+        mode = int(item.mode, 8)
+        # Git's ls-tree displays the type of the object points to.  The
+        # mode tells us that, no need to read it.
+        if stat.S_ISDIR(mode):
+            fmt = "tree"
+        elif mode == GITLINK_MODE:
+            fmt = "commit"
+        else:
+            fmt = "blob"
 
-    for p in parents:
-        p = p.decode("ascii")
-        print("c_{0} -> c_{1};".format(sha, p))
-        log_graphviz(repo, p, seen)
+        path = prefix + item.path
+        if fmt == "tree" and args.recursive:
+            stack.append((path + b'/', iter(object_read(repo, item.sha))))
+            if not args.show_trees:
+                continue
 
-def cmd_ls_tree(args):
+        if args.long:
+            size = object_info(repo, item.sha)[1] if fmt == "blob" else "-"
+            print("{0:06o} {1} {2} {3:>7}\t{4}".format(mode, fmt, item.sha, size, path.decode("utf8")))
+        else:
+            print("{0:06o} {1} {2}\t{3}".format(mode, fmt, item.sha, path.decode("utf8")))
+
+def cmd_ls_files(args):
+    import GitIndex
+    repo = repo_find()
+    index = GitIndex.index_read(repo)
+
+    for e in index.entries:
+        if args.stage:
+            print("{0:06o} {1} {2}\t{3}".format(e.mode, e.obj, e.flag_stage, e.name.decode("utf8")))
+        else:
+            print(e.name.decode("utf8"))
+
+def cmd_update_index(args):
+    import GitIndex
     repo = repo_find()
-    obj = object_read(repo,object_find(repo, args.object, fmt=b'tree'))
-    
-    for item in obj.items:
-        print("{0} {1} {2}\t{3}".format(
-            "0" * (6 - len(item.mode)) + item.mode.decode("ascii"),
-            # Git's ls-tree displays the type of the object points to. We can do that too
-            object_read(repo, item.sha).fmt.decode("ascii"),
-            item.sha,
-            item.path.decode("ascii")))
+    index = GitIndex.index_read(repo)
+    index.version = args.index_version
+    GitIndex.index_write(repo, index)
 
 def cmd_checkout(args):
     repo = repo_find()
+    if args.path is None or (os.path.isdir(args.path) and os.path.samefile(args.path, repo.worktree)):
+        worktree_checkout(repo, args.commit, jobs=args.jobs)
+        return
+
     obj = object_read(repo, object_find(repo, args.commit))
 
     # If the object is a commit, we grab its tree
     if obj.fmt == b'commit':
-        obj = object_read(repo, obj.kvlm[b'tree'].decode("ascii"))
+        obj = object_read(repo, obj.header(b'tree')[0].decode("ascii"))
 
     # Verify that path is an empty directory
     if os.path.exists(args.path):
@@ -142,34 +518,280 @@ def cmd_checkout(args):
     else:
         os.makedirs(args.path)
 
-    tree_checkout(repo, obj, os.path.realpath(args.path).encode())
-
-def tree_checkout(repo, tree, path):
-    for item in tree.items:
-        obj = object_read(repo, item.sha)
-        dest = os.path.join(path, item.path)
+    tree_checkout(repo, obj, os.path.realpath(args.path).encode(), jobs=args.jobs)
+
+def tree_flatten(repo, tree, path):
+    """Walk tree, which is to be checked out at path.  Return a list of
+    directories to create, parents first, and a list of (path, sha, mode)
+    for every file."""
+    dirs = list()
+    files = list()
+
+    # Explicit stack rather than recursion, trees can be deep.
+    stack = [ (tree, path) ]
+    while stack:
+        tree, path = stack.pop()
+        for item in tree:
+            dest = os.path.join(path, item.path)
+            mode = int(item.mode, 8)
+
+            if stat.S_ISDIR(mode):
+                dirs.append(dest)
+                stack.append((object_read(repo, item.sha), dest))
+            elif mode == GITLINK_MODE:
+                # Submodule: git leaves an empty directory behind
+                dirs.append(dest)
+            else:
+                files.append((dest, item.sha, mode))
+
+    return dirs, files
+
+def tree_checkout(repo, tree, path, jobs=None):
+    """Write tree's contents under path, which must exist.  Directories are
+    all created up front, then files are inflated and written by a pool of
+    jobs threads (zlib and file I/O release the GIL)."""
+    import concurrent.futures
+    dirs, files = tree_flatten(repo, tree, path)
+
+    for d in dirs:
+        os.mkdir(d)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        # list() so that exceptions raised in workers propagate
+        list(pool.map(lambda f: blob_checkout(repo, *f), files))
+
+def blob_checkout(repo, dest, sha, mode):
+    """Write blob sha at dest, honoring mode (symlink, executable or
+    regular file)."""
+    fmt, size, chunks = object_stream(repo, sha)
+    if fmt != b'blob':
+        raise Exception("Expected blob at {0}, found {1}".format(dest.decode(), fmt.decode("ascii")))
+
+    if stat.S_ISLNK(mode):
+        os.symlink(b''.join(chunks), dest)
+        return
 
-        if obj.fmt == b'tree':
-            os.mkdir(dest)
-            tree_checkout(repo, obj, dest)
-        elif obj.fmt == b'blob':
-            with open(dest, 'wb') as f:
-                f.write(obj.blobdata)
+    # Like git, we let the umask decide the actual permissions.
+    perms = 0o777 if mode & 0o100 else 0o666
+    fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, perms)
+    with os.fdopen(fd, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+def worktree_checkout(repo, name, jobs=None):
+    """Switch repo's worktree, index and HEAD from HEAD's commit to commit
+    name.  Only the paths that differ between the two trees are touched,
+    so the work depends on the size of the change.  Like git, we refuse
+    to overwrite local changes (staged or not) and untracked files; in
+    that case nothing is changed at all."""
+    import concurrent.futures
+    import GitIndex
+    import GitStatus
+    import GitIndexEntry
+    import GitRefStore
+
+    commit = object_find(repo, name, fmt=b'commit')
+    if not commit:
+        raise Exception("Not a commit {0}".format(name))
+    old = object_find(repo, "HEAD", fmt=b'tree') if ref_resolve(repo, "HEAD") else None
+    changes = list(tree_diff(repo, old, commit_tree(repo, commit)))
+
+    worktree = os.fsencode(repo.worktree)
+    index = GitIndex.index_read(repo)
+    index_path = repo.repo_path("index")
+    index_mtime_ns = os.stat(index_path).st_mtime_ns if os.path.exists(index_path) else 0
+    filemode = repo.conf.getboolean("core", "filemode", fallback=True)
+    entries = { e.name: e for e in index.entries if not e.flag_stage }
+    unmerged = { e.name for e in index.entries if e.flag_stage }
+    deleted = { path for path, _, _, _, new_sha, _ in changes if new_sha is None }
+
+    def file_is(path, mode, sha):
+        """Whether the file at path holds blob sha with mode (or is gone)."""
+        try:
+            st = os.lstat(os.path.join(worktree, path))
+        except FileNotFoundError:
+            return True
+        if stat.S_ISDIR(st.st_mode) or not GitStatus.modes_match(mode, GitStatus.mode_from_stat(st), filemode):
+            return False
+        e = entries.get(path)
+        if (e is not None and e.obj == sha and GitStatus.stat_matches(e, st, filemode)
+                and not GitStatus.is_racy(e, index_mtime_ns)):
+            return True
+        return GitStatus.file_hash(os.path.join(worktree, path), st) == sha
+
+    local = list()
+    untracked = list()
+    for path, old_mode, new_mode, old_sha, new_sha, _ in changes:
+        full = os.path.join(worktree, path)
+        e = entries.get(path)
+        if path in unmerged:
+            local.append(path)
+        elif old_sha is not None:
+            # What's in the index and the worktree must be the old version
+            if e is None or (e.mode, e.obj) != (old_mode, old_sha):
+                local.append(path)
+            elif old_mode != GITLINK_MODE and not file_is(path, old_mode, old_sha):
+                local.append(path)
+        elif e is not None:
+            local.append(path)
+        elif new_mode == GITLINK_MODE:
+            pass
+        elif os.path.isdir(full) and not os.path.islink(full):
+            # Fine if it only holds files we're about to delete
+            for dirpath, _, files in os.walk(full):
+                rel = os.path.relpath(dirpath, worktree)
+                if any(os.path.join(rel, f) not in deleted for f in files):
+                    untracked.append(path)
+                    break
+        elif os.path.lexists(full) and not file_is(path, new_mode, new_sha):
+            untracked.append(path)
+
+        if new_sha is not None:
+            # A file where we need a directory
+            parts = path.split(b'/')[:-1]
+            for n in range(1, len(parts) + 1):
+                parent = b'/'.join(parts[:n])
+                full = os.path.join(worktree, parent)
+                if os.path.lexists(full) and not os.path.isdir(full) and parent not in deleted:
+                    untracked.append(parent)
+                    break
+
+    if local or untracked:
+        message = list()
+        if local:
+            message.append("Your local changes to the following files would be overwritten by checkout:")
+            message.extend("\t" + path.decode("utf8") for path in local)
+        if untracked:
+            message.append("The following untracked working tree files would be overwritten by checkout:")
+            message.extend("\t" + path.decode("utf8") for path in untracked)
+        raise Exception("\n".join(message))
+
+    # Deletions first, they may make room for what comes next.
+    writes = list()
+    for path, old_mode, new_mode, old_sha, new_sha, _ in changes:
+        full = os.path.join(worktree, path)
+        if old_sha is not None:
+            try:
+                if old_mode == GITLINK_MODE:
+                    os.rmdir(full)
+                else:
+                    os.unlink(full)
+            except OSError:
+                pass
+            if new_sha is None:
+                # And the directories that became empty
+                parent = os.path.dirname(full)
+                while len(parent) > len(worktree):
+                    try:
+                        os.rmdir(parent)
+                    except OSError:
+                        break
+                    parent = os.path.dirname(parent)
+        if new_sha is not None:
+            writes.append((path, full, new_sha, new_mode))
+
+    for path, full, sha, mode in writes:
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        if mode == GITLINK_MODE:
+            os.makedirs(full, exist_ok=True)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        list(pool.map(lambda w: blob_checkout(repo, w[1], w[2], w[3]),
+                      [ w for w in writes if w[3] != GITLINK_MODE ]))
+
+    touched = { change[0] for change in changes }
+    new_entries = [ e for e in index.entries if e.name not in touched ]
+    for path, full, sha, mode in writes:
+        e = GitIndexEntry.GitIndexEntry(mode_type=mode >> 12, mode_perms=mode & 0o777, obj=sha, name=path)
+        if mode != GITLINK_MODE:
+            GitStatus.entry_refresh(e, os.lstat(full))
+        new_entries.append(e)
+
+    index.entries = sorted(new_entries, key=lambda e: (e.name, e.flag_stage))
+    # Extensions (cache-tree and the like) describe the old entries
+    index.extensions = list()
+    GitIndex.index_write(repo, index)
+
+    # A branch gets checked out, anything else detaches HEAD.  Checking
+    # out HEAD itself leaves it as it is.
+    refs = GitRefStore.ref_store(repo)
+    full = refs.dwim(name)
+    if full == "HEAD":
+        return
+    elif full is not None and full.startswith("refs/heads/"):
+        refs.write_loose("HEAD", "ref: " + full)
+    else:
+        refs.write_loose("HEAD", commit)
 
 def cmd_show_ref(args):
     repo = repo_find()
     refs = ref_list(repo)
-    show_ref(repo, refs, prefix="refs")
+    show_ref(repo, refs, prefix="refs", dereference=args.dereference)
 
-def show_ref(repo, refs, with_hash=True, prefix=""):
+def show_ref(repo, refs, with_hash=True, prefix="", dereference=False):
     for k, v in refs.items():
         if type(v) == str:
-            print("{0}{1}{2}".format(
-                v + " " if with_hash else "",
-                prefix + "/" if prefix else "",
-                k))
+            name = "{0}{1}".format(prefix + "/" if prefix else "", k)
+            print("{0}{1}".format(v + " " if with_hash else "", name))
+            if dereference:
+                peeled = ref_peel(repo, v)
+                if peeled:
+                    print("{0} {1}^{{}}".format(peeled, name))
         else:
-            show_ref(repo, v, with_hash=with_hash, prefix="{0}{1}{2}".format(prefix, "/" if prefix else "", k))
+            show_ref(repo, v, with_hash=with_hash, prefix="{0}{1}{2}".format(prefix, "/" if prefix else "", k),
+                     dereference=dereference)
+
+def cmd_fsck(args):
+    import GitFsck
+    repo = repo_find()
+
+    show_progress = sys.stderr.isatty() if args.progress is None else args.progress
+    def progress(done, total):
+        if show_progress:
+            percent = 100 * done // total if total else 100
+            sys.stderr.write("Checking objects: {0}% ({1}/{2})\r".format(percent, done, total))
+
+    errors, missing, dangling = GitFsck.fsck(repo, jobs=args.jobs, progress=progress)
+    if show_progress:
+        sys.stderr.write("\nChecking connectivity, done.\n")
+
+    for sha, message in errors:
+        sys.stderr.write("error: {0}{1}\n".format(sha + ": " if sha else "", message))
+    for fmt, sha in missing:
+        print("missing {0} {1}".format(fmt.decode("ascii"), sha))
+    if args.dangling:
+        for fmt, sha in dangling:
+            print("dangling {0} {1}".format(fmt.decode("ascii"), sha))
+
+    if errors or missing:
+        sys.exit(1)
+
+def cmd_gc(args):
+    repo = repo_find()
+    repo_gc(repo, window=args.window, depth=args.depth)
+
+def cmd_pack_objects(args):
+    repo = repo_find()
+
+    # Same input as git pack-objects: one object per line, optionally
+    # followed by the path it was found at (as git rev-list --objects
+    # prints them).
+    def objects():
+        for line in sys.stdin.buffer:
+            sha, _, path = line.rstrip(b'\n').partition(b' ')
+            if sha:
+                yield object_find(repo, sha.decode("ascii")), path or None
+
+    print(objects_pack(repo, objects(), args.base_name, window=args.window, depth=args.depth))
+
+def cmd_pack_refs(args):
+    repo = repo_find()
+    refs_pack(repo, all=args.all, prune=args.prune)
+
+def cmd_status(args):
+    import GitStatus
+    repo = repo_find()
+    for xy, path in GitStatus.status(repo, jobs=args.jobs):
+        print("{0} {1}".format(xy, path.decode("utf8")))
 
 def cmd_tag(args):
     repo = repo_find()
@@ -178,11 +800,50 @@ def cmd_tag(args):
         tag_create(args.name, args.object, type="object" if args.create_tag_object else "ref")
     else:
         refs = ref_list(repo)
-        show_ref(repo, refs["tags"], with_hash=False)
+        show_ref(repo, refs.get("tags", {}), with_hash=False)
+
+def cmd_rev_list(args):
+    import GitBitmap
+    repo = repo_find()
+    include = ref_tips(repo) if args.all else list()
+    exclude = list()
+    for rev in args.revs:
+        if rev.startswith("^"):
+            exclude.append(object_find(repo, rev[1:]))
+        else:
+            include.append(object_find(repo, rev))
+
+    bitmap, bits, extra = objects_reachable(repo, include, exclude, use_bitmap=args.use_bitmap)
+    if not args.objects:
+        if bits is not None:
+            bits &= bitmap.types[b'commit']
+        extra = { sha: fmt for sha, fmt in extra.items() if fmt == b'commit' }
+
+    if args.count:
+        print(len(extra) + (GitBitmap.bits_count(bits) if bits is not None else 0))
+        return
+
+    # Unlike git, no particular order
+    if bits is not None:
+        for pos in GitBitmap.bits_positions(bits):
+            print(bitmap.pack.sha_at(pos).hex())
+    for sha in extra:
+        print(sha)
 
 def cmd_rev_parse(args):
-    if args.type:
-        fmt = args.type.encode()
+    fmt = args.type.encode() if args.type else None
+
+    # argparse takes "--short HEAD" as --short=HEAD
+    name, short = args.name, args.short
+    if short and not short.isdigit():
+        if name:
+            argparser.error("--short takes a number")
+        name, short = short, ""
+    if not name:
+        argparser.error("rev-parse needs a name")
 
     repo = repo_find()
-    print(object_find(repo, args.name, ars.type, follow=True))
\ No newline at end of file
+    sha = object_find(repo, name, fmt, follow=True)
+    if short is not None and sha:
+        sha = object_abbrev(repo, sha, int(short) if short else None)
+    print(sha)
\ No newline at end of file
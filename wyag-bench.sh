@@ -0,0 +1,72 @@
+#!/usr/bin/env bash
+# Time a few commands, wyag against git and against wyag as of revision
+# `base` (default HEAD~), in a scratch repository.
+#
+#   ./wyag-bench.sh [runs] [objects] [base]
+#
+# Each command is run `runs` times (default 20) and the mean wall time is
+# printed in milliseconds.  Most wyag commands are dominated by interpreter
+# startup, so this mostly measures that.
+#
+# Then `objects` small blobs (default 100000) are written in one batch to
+# a new repository with each object store, and the total time is printed.
+set -e
+
+wyag=$(realpath ./wyag)
+wyagdir=$(dirname $wyag)
+runs=${1:-20}
+objects=${2:-100000}
+base=${3:-HEAD~}
+
+benchdir=/tmp/wyag-bench
+rm -rf $benchdir
+mkdir -p $benchdir/base
+git -C $wyagdir archive $(git -C $wyagdir rev-parse --verify $base) | tar -x -C $benchdir/base
+basewyag=$benchdir/base/wyag
+cd $benchdir
+
+git init -q repo
+cd repo
+mkdir -p a/b/c
+for i in $(seq 50); do echo $i > a/b/c/file$i; done
+git add .
+git -c user.name=bench -c user.email=bench@example.com commit -q -m bench
+
+# Run from deep in the worktree, so repository discovery has to walk up.
+cd a/b/c
+
+function bench() {
+    local start=$(date +%s%N)
+    for i in $(seq $runs); do
+        "$@" > /dev/null
+    done
+    local end=$(date +%s%N)
+    printf "%6d ms  %s\n" $(( (end - start) / runs / 1000000 )) "$*"
+}
+
+bench python3 -c pass
+for cmd in "rev-parse HEAD" "cat-file -t HEAD" "ls-tree HEAD"; do
+    bench git $cmd
+    bench python3 $wyag $cmd
+    bench python3 $basewyag $cmd
+done
+
+function ingest() {
+    python3 -c "
+import sys, time
+sys.path.insert(0, '$wyagdir')
+import GitCommands, GitObject
+repo = GitCommands.repo_create('$benchdir/ingest-$1', object_store='$1')
+start = time.perf_counter()
+with repo.odb.batch():
+    for i in range($objects):
+        GitCommands.object_write(GitObject.GitBlob(repo, b'object %d\\n' % i))
+repo.odb.close()
+print('%6d ms  write $objects objects, $1 store' % ((time.perf_counter() - start) * 1000))
+"
+    du -sh $benchdir/ingest-$1/.git/objects | cut -f1 | sed 's/^/          size: /'
+}
+
+ingest loose
+ingest sqlite
+ingest memory
@@ -7,6 +7,7 @@ function step() {
 }
 
 wyag=$(realpath ./wyag)
+wyagdir=$(dirname $(realpath ./wyag))
 
 testdir=/tmp/wyag-tests
 if [[ -e $testdir ]]; then
@@ -139,6 +140,854 @@ cmp file1 file2
 step "rev-parse (wyag redirection tester)"
 #@TODO
 
+step "cat-file from packfiles (with deltas)"
+git init -q packed
+cd packed
+for i in 1 2 3 4 5 6 7 8; do
+    seq 1 $((i * 500)) > numbers
+    git add numbers
+    git commit -q --no-gpg-sign -m "Numbers $i"
+done
+git gc -q --aggressive
+test -z "$(git count-objects | grep -v '^0 objects')"
+for obj in $(git rev-list --objects --all | cut -d' ' -f1); do
+    type=$(git cat-file -t $obj)
+    $wyag cat-file $type $obj > ../file1
+    git cat-file $type $obj > ../file2
+    cmp ../file1 ../file2
+done
+cd ..
+
+step "hash-object -w and cat-file on a large blob (streamed)"
+cd left
+head -c 5000000 /dev/urandom > ../large
+$wyag hash-object -w ../large > ../file1
+git hash-object ../large > ../file2
+cmp ../file1 ../file2
+git cat-file blob $(cat ../file2) | cmp - ../large
+$wyag cat-file blob $(cat ../file2) | cmp - ../large
+cd ..
+
+step "checkout -j with executable files, symlinks and nested directories"
+git init -q modes
+cd modes
+mkdir -p bin deep/er/and/deeper
+printf '#!/bin/sh\necho hi\n' > bin/run
+chmod +x bin/run
+ln -s bin/run link
+for i in $(seq 1 50); do echo $i > deep/er/and/deeper/f$i; done
+git add .
+git commit -q --no-gpg-sign -m "Modes"
+$wyag checkout -j 4 HEAD ../temp1
+cd ..
+diff -r --no-dereference modes temp1 -x .git
+test -x temp1/bin/run
+test "$(readlink temp1/link)" = "bin/run"
+rm -rf temp1
+
+step "ls-files and update-index on index versions 2, 3 and 4"
+cd modes
+touch added-with-intent
+git add -N added-with-intent
+for v in 2 3 4; do
+    git update-index --index-version $v
+    cp .git/index ../index$v
+    $wyag ls-files --stage > ../file1
+    git ls-files --stage > ../file2
+    cmp ../file1 ../file2
+done
+for v in 2 3 4; do
+    for w in 2 3 4; do
+        cp ../index$v .git/index
+        $wyag update-index --index-version $w
+        $wyag update-index --index-version $v
+        cmp .git/index ../index$v
+    done
+done
+git fsck --no-progress
+cd ..
+
+step status
+cd modes
+$wyag status > ../file1
+git status --porcelain --untracked-files=all > ../file2
+cmp ../file1 ../file2
+echo more >> bin/run
+chmod -x bin/run
+rm deep/er/and/deeper/f1
+echo new > untracked
+mkdir -p ud/x
+echo a > ud/x/y
+echo s > staged
+git add staged
+echo change > deep/er/and/deeper/f2
+git add deep/er/and/deeper/f2
+echo again >> deep/er/and/deeper/f2
+git rm -q --cached deep/er/and/deeper/f3
+touch deep/er/and/deeper/f4
+$wyag status -j 3 > ../file1
+git status --porcelain --untracked-files=all > ../file2
+cmp ../file1 ../file2
+# Second run goes through the refreshed stat data
+$wyag status > ../file1
+cmp ../file1 ../file2
+# An index older than the files makes every entry racy; status rehashes
+# them once and rewrites the index, so the next run doesn't have to
+touch -d @1000000000 .git/index
+$wyag status > ../file1
+cmp ../file1 ../file2
+test $(stat -c %Y .git/index) -gt 1000000000
+git reset -q --hard
+git clean -fdq
+cd ..
+
+step "log --oneline, --topo-order, --date-order, -n and --since on a merge-heavy history"
+git init -q history
+cd history
+date=1300000000
+function commit_at() {
+    date=$((date + 100))
+    echo "$1" >> file-$2
+    git add file-$2
+    GIT_AUTHOR_DATE="$date +0000" GIT_COMMITTER_DATE="$date +0000" \
+                   git commit -q --no-gpg-sign -m "$1"
+}
+commit_at root main
+git checkout -q -b side
+for i in 1 2 3; do commit_at "side $i" side; done
+git checkout -q master
+for i in 1 2; do commit_at "main $i" main; done
+date=$((date + 100))
+GIT_AUTHOR_DATE="$date +0000" GIT_COMMITTER_DATE="$date +0000" \
+               git merge -q --no-gpg-sign --no-edit side
+commit_at "after merge" main
+for args in "" "--topo-order" "--date-order" "-n 3" "--since=1300000450" "--topo-order -n 4"; do
+    $wyag log --oneline $args > ../file1
+    git log --format="%h %s" $args > ../file2
+    cmp ../file1 ../file2
+done
+$wyag log | grep -c -- '->' > ../file1
+git rev-list --parents HEAD | awk '{ n += NF - 1 } END { print n }' > ../file2
+cmp ../file1 ../file2
+cd ..
+
+step "log on a history deeper than the recursion limit"
+git init -q deep-history
+cd deep-history
+for i in $(seq 1 3000); do
+    echo "commit refs/heads/master"
+    echo "committer T <t@t> $((1300000000 + i)) +0000"
+    echo "data <<EOF"
+    echo "Commit $i"
+    echo "EOF"
+done | git fast-import --quiet
+$wyag log --oneline > ../file1
+git log --format="%h %s" > ../file2
+cmp ../file1 ../file2
+cd ..
+
+step "commit-graph write (with an octopus merge), log and merge-base through it"
+cd history
+git checkout -q -b o1 HEAD~2
+commit_at "octo 1" o1
+git checkout -q -b o2 master~1
+commit_at "octo 2" o2
+git checkout -q -b o3 master
+commit_at "octo 3" o3
+git checkout -q master
+date=$((date + 100))
+GIT_AUTHOR_DATE="$date +0000" GIT_COMMITTER_DATE="$date +0000" \
+               git merge -q --no-gpg-sign --no-edit o1 o2 o3 > /dev/null
+$wyag commit-graph write --reachable
+git commit-graph verify
+cp .git/objects/info/commit-graph ../file1
+git -c commitGraph.generationVersion=1 commit-graph write --reachable --no-changed-paths
+cmp .git/objects/info/commit-graph ../file1
+for args in "" "--topo-order" "--date-order"; do
+    $wyag log --oneline $args > ../file1
+    git log --format="%h %s" $args > ../file2
+    cmp ../file1 ../file2
+done
+for pair in "o1 o2" "o2 side" "master side" "o3 o1"; do
+    set -- $(git rev-parse $pair)
+    $wyag merge-base --all $1 $2 > ../file1
+    git merge-base --all $1 $2 | sort > ../file2
+    sort ../file1 | cmp - ../file2
+    if git merge-base --is-ancestor $1 $2; then $wyag merge-base --is-ancestor $1 $2; else ! $wyag merge-base --is-ancestor $1 $2; fi
+    if git merge-base --is-ancestor $2 $1; then $wyag merge-base --is-ancestor $2 $1; else ! $wyag merge-base --is-ancestor $2 $1; fi
+done
+rm .git/objects/info/commit-graph
+cd ..
+
+step "kvlm round trip on commits with thousands of parents and signatures"
+cd deep-history
+parents=$(git rev-list HEAD | head -n 2000 | sed 's/^/-p /')
+many=$(echo "Many parents" | git commit-tree $(git rev-parse HEAD^{tree}) $parents)
+signed=$( (echo "tree $(git rev-parse HEAD^{tree})"
+           echo "parent $many"
+           echo "author T <t@t> 1300000000 +0000"
+           echo "committer T <t@t> 1300000000 +0000"
+           echo "gpgsig -----BEGIN PGP SIGNATURE-----"
+           echo " "
+           for i in $(seq 1 200); do echo " iQEzBAABCAAdFiEE$i"; done
+           echo " -----END PGP SIGNATURE-----"
+           echo
+           echo "Signed"
+           echo
+           echo "with a body") | git hash-object -t commit -w --stdin)
+for obj in $many $signed; do
+    $wyag cat-file commit $obj > ../file1
+    git cat-file commit $obj > ../file2
+    cmp ../file1 ../file2
+done
+python3 -c "
+import sys
+sys.path.insert(0, '$wyagdir')
+import GitCommands
+repo = GitCommands.repo_find()
+for sha in sys.argv[1:]:
+    c = GitCommands.object_read(repo, sha)
+    raw = c.raw
+    assert c.kvlm_serialize(c.kvlm_parse(raw)) == raw
+    c.kvlm = c.kvlm
+    assert c.serialize() == raw
+    assert c.header(b'parent') == c.kvlm_header(raw, b'parent')
+" $many $signed
+cd ..
+
+step "<rev>:<path> lookups in trees with tricky sort order"
+git init -q lookup
+cd lookup
+mkdir -p foo/bar foo-dir
+for f in foo.txt foo-bar foo0 a.b foo/x foo/bar/y foo-dir/z; do echo $f > $f; done
+git add .
+git commit -q --no-gpg-sign -m "Lookup"
+for path in foo.txt foo-bar foo0 a.b foo foo/ foo/x foo/bar foo/bar/y foo-dir/z ""; do
+    $wyag rev-parse "HEAD:$path" > ../file1
+    git rev-parse "HEAD:$path" > ../file2
+    cmp ../file1 ../file2
+done
+$wyag cat-file blob HEAD:foo/bar/y > ../file1
+git cat-file blob HEAD:foo/bar/y > ../file2
+cmp ../file1 ../file2
+! $wyag rev-parse HEAD:nope 2> /dev/null
+! $wyag rev-parse HEAD:foo.txt/x 2> /dev/null
+cd ..
+
+step "ls-tree -r/-t/-l and cat-file -t/-s, on loose and packed objects"
+for repo in lookup modes packed; do
+    cd $repo
+    for args in "" "-r" "-r -t" "-l" "-r -l"; do
+        $wyag ls-tree $args $(git rev-parse HEAD) > ../file1
+        git ls-tree $args HEAD > ../file2
+        cmp ../file1 ../file2
+    done
+    for obj in $(git rev-list --objects --all | cut -d' ' -f1); do
+        $wyag cat-file -t $obj > ../file1
+        $wyag cat-file -s $obj >> ../file1
+        git cat-file -t $obj > ../file2
+        git cat-file -s $obj >> ../file2
+        cmp ../file1 ../file2
+    done
+    cd ..
+done
+
+step "cat-file --batch and --batch-check"
+cd packed
+(git rev-list --objects --all | cut -d' ' -f1
+ echo 0000000000000000000000000000000000000000
+ echo "$(git rev-parse HEAD):numbers") > ../names
+for mode in --batch --batch-check "--batch-check=%(objecttype) %(objectname)" "--batch=%(objectsize) %(rest)"; do
+    $wyag cat-file "$mode" < ../names > ../file1
+    git cat-file "$mode" < ../names > ../file2
+    cmp ../file1 ../file2
+    $wyag cat-file "$mode" --buffer < ../names | cmp - ../file2
+done
+cd ..
+
+step "hash-object with several paths, --stdin-paths and -j"
+git init -q bulk
+cd left
+find . -path ./.git -prune -o -type f -print | sort > ../paths
+cp ../large large-file
+echo large-file >> ../paths
+$wyag hash-object $(cat ../paths) > ../file1
+git hash-object --stdin-paths < ../paths > ../file2
+cmp ../file1 ../file2
+$wyag hash-object -j 3 --stdin-paths < ../paths > ../file1
+cmp ../file1 ../file2
+cd ../bulk
+sed 's|^|../left/|' ../paths | $wyag hash-object -w -j 3 --stdin-paths > ../file1
+cmp ../file1 ../file2
+for sha in $(cat ../file2); do
+    git cat-file -e $sha
+done
+test -z "$(find .git/objects -name 'tmp_obj_*')"
+# Everything exists already: nothing gets rewritten
+find .git/objects -type f -newer ../file1 > ../file3
+sed 's|^|../left/|' ../paths | $wyag hash-object -w --stdin-paths | cmp - ../file2
+find .git/objects -type f -newer ../file1 | cmp - ../file3
+rm ../left/large-file
+cd ..
+
+step "Read-only commands don't write to the repository"
+git init -q readonly
+cd readonly
+echo text > file
+git add file
+git commit -q -m readonly
+rm -rf .git/branches .git/description
+mkdir -p a/b
+cd a/b
+test $($wyag rev-parse HEAD) = $(git rev-parse HEAD)
+test $($wyag rev-parse --wyag-type tree HEAD) = $(git rev-parse HEAD^{tree})
+test ! -e ../../.git/branches
+test ! -e ../../.git/description
+cd ../../..
+
+step "packed-refs, show-ref -d and pack-refs"
+git init -q refs
+cd refs
+echo a > a
+git add a
+git commit -q -m one
+echo b > b
+git add b
+git commit -q -m two
+git branch side HEAD~1
+git branch feature/x/y
+git branch a-b
+for i in $(seq 30); do
+    git tag light$i HEAD~$((i % 2))
+done
+git tag -a -m annotated ann1
+git -c advice.nestedTag=false tag -a -m nested ann2 ann1
+git tag -a -m tree treetag HEAD^{tree}
+git update-ref refs/remotes/origin/main HEAD~1
+git symbolic-ref refs/remotes/origin/HEAD refs/remotes/origin/main
+cp -r . ../refs-loose
+git pack-refs --all
+# Loose refs override packed ones
+git tag late
+git update-ref refs/heads/side HEAD
+$wyag show-ref | cmp - <(git show-ref)
+$wyag show-ref -d | cmp - <(git show-ref -d)
+for name in HEAD master side feature/x/y a-b light3 ann2 origin/main origin late refs/tags/ann1; do
+    test $($wyag rev-parse $name) = $(git rev-parse $name)
+    test $($wyag rev-parse --wyag-type commit $name) = $(git rev-parse $name^{commit})
+done
+test $($wyag rev-parse --wyag-type tree treetag) = $(git rev-parse treetag^{tree})
+cd ..
+cp -r refs-loose refs-git
+cd refs-git
+git show-ref -d > ../file2
+git pack-refs
+cd ../refs-loose
+$wyag pack-refs
+cmp .git/packed-refs ../refs-git/.git/packed-refs
+test ! -e .git/refs/tags/light1
+$wyag pack-refs --all
+(cd ../refs-git && git pack-refs --all)
+cmp .git/packed-refs ../refs-git/.git/packed-refs
+test -z "$(find .git/refs -type f ! -name HEAD)"
+test ! -e .git/refs/heads/feature
+git show-ref -d | cmp - ../file2
+git fsck --no-dangling 2> /dev/null
+cd ..
+
+step "Short hashes across loose and packed objects, rev-parse --short"
+git init -q abbrev
+cd abbrev
+seq 1 1500 | sed 's/^/packed /' | while read line; do echo $line > f; git hash-object -w f; done > ../file1
+git repack -adq
+seq 1 1500 | sed 's/^/loose /' | while read line; do echo $line > f; git hash-object -w f; done >> ../file1
+# Four characters collide a few times among 3000 objects, five rarely do
+(cut -c1-4 ../file1; cut -c1-5 ../file1; cut -c1-40 ../file1; echo 0000; echo ffff) > ../file3
+$wyag cat-file --batch-check < ../file3 > ../file1
+git cat-file --batch-check < ../file3 > ../file2 2> /dev/null
+cmp ../file1 ../file2
+grep -q ambiguous ../file1
+test $($wyag rev-parse --short HEAD 2> /dev/null || echo none) = none
+git add f
+git commit -q -m abbrev
+test $($wyag rev-parse --short HEAD) = $(git rev-parse --short HEAD)
+test $($wyag rev-parse --short=10 HEAD) = $(git rev-parse --short=10 HEAD)
+git cat-file --batch-check='%(objectname)' --batch-all-objects > ../file3
+for sha in $(cat ../file3); do git rev-parse --short=4 $sha; done > ../file2
+python3 -c "
+import sys
+sys.path.insert(0, '$wyagdir')
+import GitCommands
+repo = GitCommands.repo_find()
+for sha in sys.argv[1:]:
+    print(GitCommands.object_abbrev(repo, sha, 4))
+" $(cat ../file3) > ../file1
+cmp ../file1 ../file2
+cd ..
+
+step "pack-objects and gc write packs git can read"
+git init -q gc
+cd gc
+mkdir dir
+for i in 1 2 3 4 5 6; do
+    seq 1 $((i * 300)) > numbers
+    seq $i 2000 | sed "s/^/line /" > dir/lines
+    cp numbers dir/numbers.copy
+    git add .
+    git commit -q -m "Version $i"
+done
+git tag -a -m "annotated" v1 HEAD~2
+git tag -a -m "tree" tree-tag HEAD^{tree}
+git branch old HEAD~4
+# Only reachable from the reflog, from the index, or from nothing
+git commit -q --amend -m "Amended"
+echo staged > staged
+git add staged
+echo unreachable | git hash-object -w --stdin > ../file3
+git cat-file --batch-all-objects --batch-check > ../objects-before
+git rev-list --objects --all | $wyag pack-objects ../out > ../file1
+test -s ../out-$(cat ../file1).pack
+git index-pack -o ../out.idx ../out-$(cat ../file1).pack > /dev/null
+cmp ../out.idx ../out-$(cat ../file1).idx
+git verify-pack -v ../out-$(cat ../file1).idx | grep -q "chain length = 1"
+$wyag gc
+test $(ls .git/objects/pack/*.pack | wc -l) = 1
+test "$(find .git/objects -type f ! -path '*/pack/*' ! -path '*/info/*')" = ".git/objects/$(cut -c1-2 ../file3)/$(cut -c3- ../file3)"
+git verify-pack -v .git/objects/pack/*.idx | grep -q "chain length = 1"
+git fsck --full --no-dangling 2> /dev/null
+git cat-file --batch-all-objects --batch-check | cmp - ../objects-before
+test -f .git/packed-refs
+for obj in $(git cat-file --batch-all-objects --batch-check='%(objectname)'); do
+    type=$(git cat-file -t $obj)
+    $wyag cat-file $type $obj | cmp - <(git cat-file $type $obj)
+done
+# Repacking a packed repository keeps everything too
+$wyag gc --window 3 --depth 2
+test $(ls .git/objects/pack/*.pack | wc -l) = 1
+git cat-file --batch-all-objects --batch-check | cmp - ../objects-before
+git fsck --full --no-dangling 2> /dev/null
+cd ..
+
+step "Reachability bitmaps: gc writes them, rev-list counts with them"
+git init -q bitmap
+cd bitmap
+for i in $(seq 1 120); do
+    mkdir -p dir$((i % 4))
+    echo "$i" > dir$((i % 4))/file$((i % 7))
+    echo "$i" >> history
+    git add .
+    git commit -q -m "Commit $i"
+done
+git tag -a -m "annotated" v1 HEAD~20
+git branch side HEAD~50
+git checkout -q side
+echo side > side.txt
+git add side.txt
+git commit -q -m "Side"
+git checkout -q master
+git merge -q --no-edit side
+$wyag gc
+test -f .git/objects/pack/pack-*.bitmap
+git rev-list --test-bitmap master 2>&1 | grep -q "^OK!"
+git rev-list --test-bitmap side 2>&1 | grep -q "^OK!"
+# Not everything is in the bitmap's pack
+echo later >> history
+git commit -q -a -m "After gc"
+for revs in "--all" "--objects --all" "master ^v1" "--objects master ^side" "--objects side ^v1"; do
+    count=$(git rev-list --use-bitmap-index --count $revs)
+    test $($wyag rev-list --count $revs) = $count
+    test $($wyag rev-list --count --no-use-bitmap-index $revs) = $count
+done
+$wyag rev-list --objects --all | sort | cmp - <(git rev-list --objects --all | cut -c1-40 | sort)
+$wyag rev-list master ^side | sort | cmp - <(git rev-list master ^side | sort)
+# And git's bitmaps work for us
+git repack -adbq
+test $($wyag rev-list --objects --all --count) = $(git rev-list --objects --all --count)
+$wyag gc
+git rev-list --test-bitmap master 2>&1 | grep -q "^OK!"
+git fsck --full --no-dangling 2> /dev/null
+cd ..
+
+step "diff-tree compares trees and skips identical subtrees"
+git init -q diff
+cd diff
+mkdir -p a/b/c big foo
+for i in $(seq 1 50); do echo $i > big/file$i; done
+for f in a/b/c/deep a/b/mid a/top top foo/x foo.txt gone script; do echo $f > $f; done
+ln -s top link
+mkdir -p olddir/sub
+echo old > olddir/sub/file
+git add .
+git commit -q -m "Before"
+echo changed > a/b/c/deep
+echo new > a/b/c/new
+git rm -q -r olddir foo.txt gone
+echo file > olddir
+chmod +x script
+rm link
+echo "not a link" > link
+rm -r foo
+echo "now a file" > foo
+git add -A
+git commit -q -m "After"
+before=$(git rev-parse HEAD~)
+for r in "" "-r"; do
+    $wyag diff-tree $r $before HEAD | cmp - <(git diff-tree $r HEAD~ HEAD)
+    $wyag diff-tree $r HEAD $before | cmp - <(git diff-tree $r HEAD HEAD~)
+    $wyag diff-tree $r $before:a HEAD:a | cmp - <(git diff-tree $r HEAD~:a HEAD:a)
+done
+test -z "$($wyag diff-tree -r HEAD HEAD)"
+# Only the trees along the changed path get read
+echo again > a/b/c/deep
+git commit -q -a -m "Deep change"
+python3 -c "
+import sys
+sys.path.insert(0, '$wyagdir')
+import GitCommands
+repo = GitCommands.repo_find()
+a = GitCommands.object_find(repo, sys.argv[1], fmt=b'tree')
+b = GitCommands.object_find(repo, 'HEAD', fmt=b'tree')
+read = list()
+object_read = GitCommands.object_read
+GitCommands.object_read = lambda repo, sha: read.append(sha) or object_read(repo, sha)
+assert [ c[0] for c in GitCommands.tree_diff(repo, a, b) ] == [ b'a/b/c/deep' ]
+assert len(read) == 8, read
+" $(git rev-parse HEAD~)
+cd ..
+
+step "checkout updates an existing worktree in place"
+git init -q switch
+cd switch
+mkdir -p a/b foo unchanged
+for i in $(seq 1 20); do echo $i > unchanged/file$i; done
+echo 1 > a/b/x
+echo 1 > foo/y
+echo s > script
+ln -s unchanged link
+git add .
+git commit -q -m "One"
+git branch one
+echo 2 > a/b/x
+echo new > a/new
+git rm -q -r foo
+echo "now a file" > foo
+chmod +x script
+rm link
+echo "not a link" > link
+git add -A
+git commit -q -m "Two"
+git branch two
+stat -c "%i %Y" unchanged/* > ../file1
+$wyag checkout one
+test "$(git symbolic-ref HEAD)" = refs/heads/one
+test -z "$(git status --porcelain)"
+test -d foo -a ! -e a/new -a -L link
+$wyag checkout two
+test "$(git symbolic-ref HEAD)" = refs/heads/two
+test -z "$(git status --porcelain)"
+test -f foo -a ! -e a/b/../../foo/y -a -x script
+git diff --quiet HEAD
+# Untouched files are left alone
+stat -c "%i %Y" unchanged/* | cmp - ../file1
+# Detached HEAD
+$wyag checkout $(git rev-parse one)
+test "$(git rev-parse HEAD)" = "$(git rev-parse one)"
+! git symbolic-ref -q HEAD
+test -z "$(git status --porcelain)"
+# Local changes and untracked files are never overwritten
+echo local > a/b/x
+! $wyag checkout two 2> /dev/null
+test "$(cat a/b/x)" = local
+test "$(git rev-parse HEAD)" = "$(git rev-parse one)"
+git checkout -q a/b/x
+echo staged > a/b/x
+git add a/b/x
+git checkout -q a/b/x
+! $wyag checkout two 2> /dev/null
+git reset -q --hard
+echo untracked > a/new
+! $wyag checkout two 2> /dev/null
+test "$(cat a/new)" = untracked
+rm a/new
+$wyag checkout two
+test -z "$(git status --porcelain)"
+# Checking out HEAD doesn't detach it
+$wyag checkout HEAD
+test "$(git symbolic-ref HEAD)" = refs/heads/two
+cd ..
+
+step "log -- <path> through changed-path Bloom filters"
+git init -q bloom
+cd bloom
+date=1400000000
+function commit_at() {
+    date=$((date + 100))
+    GIT_AUTHOR_DATE="$date +0000" GIT_COMMITTER_DATE="$date +0000" \
+                   git commit -q --no-gpg-sign -m "$1"
+}
+mkdir -p src/deep/er docs "ünïcødé"
+echo 1 > src/deep/er/file.py
+echo 1 > docs/readme
+echo 1 > "ünïcødé/fïlé"
+git add .
+commit_at "Root"
+for i in $(seq 1 12); do
+    echo $i >> src/deep/er/file.py
+    [ $((i % 3)) = 0 ] && echo $i >> "ünïcødé/fïlé"
+    [ $((i % 4)) = 0 ] && echo $i >> docs/readme
+    git add .
+    commit_at "Change $i"
+done
+git checkout -q -b side HEAD~5
+echo side > docs/side
+git add .
+commit_at "Side docs"
+git checkout -q master
+GIT_AUTHOR_DATE="$date +0000" GIT_COMMITTER_DATE="$date +0000" \
+               git merge -q --no-gpg-sign --no-edit side
+mkdir many
+for i in $(seq 1 600); do echo $i > many/$i; done
+git add .
+commit_at "Too many changes for a filter"
+git mv src/deep/er/file.py src/moved.py
+commit_at "Move"
+function check_log() {
+    for path in src src/deep src/deep/er/file.py src/moved.py docs docs/readme "ünïcødé" "ünïcødé/fïlé" many many/42 nothing "src docs"; do
+        $wyag log --oneline -- $path | cmp - <(git log --format="%h %s" -- $path)
+    done
+    cd src
+    $wyag log --oneline -- deep | cmp - <(git log --format="%h %s" -- deep)
+    cd ..
+}
+check_log
+$wyag commit-graph write --reachable --changed-paths
+cp .git/objects/info/commit-graph ../file1
+git -c commitGraph.generationVersion=1 commit-graph write --reachable --changed-paths
+cmp .git/objects/info/commit-graph ../file1
+check_log
+# Filters are kept, and only the new commits' are computed
+echo again >> docs/readme
+git add .
+commit_at "After the graph"
+python3 -c "
+import sys
+sys.path.insert(0, '$wyagdir')
+import GitCommands
+repo = GitCommands.repo_find()
+computed = list()
+commit_bloom = GitCommands.commit_bloom
+GitCommands.commit_bloom = lambda *args: computed.append(args) or commit_bloom(*args)
+GitCommands.commit_graph_write(repo)
+assert len(computed) == 1, computed
+"
+git commit-graph verify
+check_log
+$wyag commit-graph write --reachable
+cp .git/objects/info/commit-graph ../file1
+git -c commitGraph.generationVersion=1 commit-graph write --reachable --changed-paths
+cmp .git/objects/info/commit-graph ../file1
+cd ..
+
+step "fsck finds corrupt, missing and dangling objects"
+git init -q fsck
+cd fsck
+mkdir dir
+for i in 1 2 3; do
+    echo $i > dir/file
+    echo $i > top$i
+    git add .
+    git commit -q -m "Commit $i"
+done
+git tag -a -m "A tag" v1 HEAD~
+$wyag gc
+echo loose > loose
+git add loose
+git commit -q -m "Loose"
+$wyag fsck -j 2 > ../file1
+test ! -s ../file1
+# Dangling objects: an unreferenced blob, a commit and its tree
+echo dangling | git hash-object -w --stdin > /dev/null
+git commit-tree -m "Dangling" $(echo "100644 blob $(echo other | git hash-object -w --stdin)	f" | git mktree) > /dev/null
+$wyag fsck | sort > ../file1
+git fsck 2> /dev/null | sort > ../file2
+cmp ../file1 ../file2
+test $(wc -l < ../file1) = 2
+test -z "$($wyag fsck --no-dangling)"
+# A missing blob
+blob=$(git rev-parse HEAD:loose)
+chmod u+w .git/objects/${blob:0:2}/${blob:2}
+mv .git/objects/${blob:0:2}/${blob:2} ../file3
+! $wyag fsck --no-dangling > ../file1
+test "$(cat ../file1)" = "missing blob $blob"
+# A loose object with the wrong content
+cp ../file3 .git/objects/${blob:0:2}/${blob:2}
+printf "blob 6\0other\n" | python3 -c "import sys, zlib; sys.stdout.buffer.write(zlib.compress(sys.stdin.buffer.read()))" > .git/objects/${blob:0:2}/${blob:2}
+! $wyag fsck > /dev/null 2> ../file2
+grep -q "error: $blob: hash mismatch" ../file2
+cp ../file3 .git/objects/${blob:0:2}/${blob:2}
+$wyag fsck --no-dangling
+# A corrupt pack
+cp .git/objects/pack/*.pack ../file3
+chmod u+w .git/objects/pack/*.pack
+printf 'X' | dd of=$(ls .git/objects/pack/*.pack) bs=1 seek=200 conv=notrunc 2> /dev/null
+! $wyag fsck > /dev/null 2> ../file2
+grep -q "bad checksum" ../file2
+cp ../file3 $(ls .git/objects/pack/*.pack)
+$wyag fsck --no-dangling --progress 2> ../file2
+grep -q "Checking objects: 100%" ../file2
+cd ..
+
+step "grep searches a revision without checking it out"
+git init -q grep
+cd grep
+mkdir -p src/a src/b "dïr"
+for d in src/a src/b "dïr" .; do
+    printf "first line\nneedle here\nNeedle there\nlast needle" > "$d/same.txt"
+done
+seq 1 3000 > numbers
+printf "binary\0needle\n" > binary.bin
+echo "needle in a link" > target
+ln -s target link
+printf "foo\nbar\n" > split
+git add .
+git commit -q -m "Grep"
+git rm -q numbers
+git commit -q -m "No numbers"
+for args in "needle" "-n needle" "-i -n NEEDLE" "-l needle" "-c needle" "-F -n ." "-n ^Needle" "-n needle$" "-n 99"; do
+    $wyag grep -j 2 $args | cmp - <(git -c core.quotePath=false grep -I $args HEAD)
+done
+old=$(git rev-parse HEAD~)
+$wyag grep -n 99 $old | cmp - <(git grep -I -n 99 $old)
+$wyag grep -n needle HEAD:src | cmp - <(git grep -I -n needle HEAD:src)
+! $wyag grep nothing-matches
+# Lines are matched one at a time
+test -z "$($wyag grep 'foo\sbar')"
+test -z "$($wyag grep 'o[^x]b')"
+$wyag grep -n '^bar$' | cmp - <(git grep -n '^bar$' HEAD)
+cd ..
+
+step "archive streams tar and tar.gz from the object store"
+cd diff
+$wyag archive HEAD > ../file1
+git archive HEAD > ../file2
+tar --numeric-owner -tvf ../file1 | cmp - <(tar --numeric-owner -tvf ../file2)
+test "$(git get-tar-commit-id < ../file1)" = "$(git rev-parse HEAD)"
+$wyag archive --prefix=release/ --format=tgz HEAD | tar --numeric-owner -tvzf - > ../file1
+git archive --prefix=release/ --format=tgz HEAD | tar --numeric-owner -tvzf - > ../file2
+cmp ../file1 ../file2
+# A bare tree gets the current time
+$wyag archive -o ../archive.tar.gz HEAD:a
+tar -tzf ../archive.tar.gz | cmp - <(git archive HEAD:a | tar -tf -)
+rm -rf ../extract1 ../extract2
+mkdir ../extract1 ../extract2
+$wyag archive HEAD | tar -xf - -C ../extract1
+git archive HEAD | tar -xf - -C ../extract2
+diff -r ../extract1 ../extract2
+cd ..
+# Blobs are streamed, not read whole
+git init -q archive-large
+cd archive-large
+head -c 40000000 /dev/urandom > large
+git add large
+git commit -q -m "Large"
+python3 -c "
+import sys, resource
+sys.path.insert(0, '$wyagdir')
+import GitCommands, GitArchive
+repo = GitCommands.repo_find()
+with open('../file1', 'wb') as f:
+    GitArchive.archive_tar(repo, GitCommands.object_find(repo, 'HEAD', fmt=b'tree'), f)
+assert resource.getrusage(resource.RUSAGE_SELF).ru_maxrss < 35000
+"
+tar -xOf ../file1 large | cmp - large
+cd ..
+
+step "Object stores: SQLite, in memory, and alternates"
+git init -q odb
+cd odb
+mkdir dir
+for i in $(seq 20); do echo "file $i" > dir/file$i; done
+echo "needle" > needle.txt
+git add .
+git commit -q -m "First"
+echo "more" >> needle.txt
+git add .
+git commit -q -m "Second"
+git cat-file commit HEAD > ../file2
+git ls-tree -r HEAD >> ../file2
+git log --format="%h %s" >> ../file2
+# Move every loose object into a SQLite store
+python3 -c "
+import os, sys
+sys.path.insert(0, '$wyagdir')
+import GitCommands, GitObjectDatabase
+repo = GitCommands.repo_find()
+loose = GitObjectDatabase.GitLooseDatabase(repo.repo_path('objects'))
+store = GitObjectDatabase.GitSqliteDatabase(repo.repo_path('objects', 'objects.sqlite'))
+with store.batch():
+    for fanout in os.listdir(loose.path):
+        if len(fanout) == 2:
+            for name in loose.listing(fanout):
+                store.write(fanout + name, *loose.read(fanout + name))
+                os.unlink(loose.object_path(fanout + name))
+store.close()
+"
+git config wyag.objectStore sqlite
+test -z "$(find .git/objects -path '*/[0-9a-f][0-9a-f]/*' -type f)"
+$wyag cat-file commit HEAD > ../file1
+$wyag ls-tree -r HEAD >> ../file1
+$wyag log --oneline >> ../file1
+cmp ../file1 ../file2
+test "$($wyag rev-parse $(git rev-parse --short HEAD))" = "$(git rev-parse HEAD)"
+test "$($wyag grep needle)" = "HEAD:needle.txt:needle"
+$wyag fsck --no-progress
+rm -rf ../temp1
+$wyag checkout -j 4 HEAD ../temp1
+diff -r -x .git . ../temp1
+# New objects go to the store, from several processes at once
+seq 1 100 | xargs -I{} sh -c 'echo "new {}" > new{}'
+$wyag hash-object -w -j 4 new* > ../file1
+git hash-object new* | cmp - ../file1
+test -z "$(find .git/objects -path '*/[0-9a-f][0-9a-f]/*' -type f)"
+for sha in $(cat ../file1); do echo $sha; done | $wyag cat-file --batch-check > ../file2
+test $(grep -c " blob " ../file2) = 100
+rm new*
+cd ..
+# Another repository borrows objects, packed and loose, through alternates
+git init -q odb-lender
+cd odb-lender
+echo "packed" > packed
+git add packed
+git commit -q -m "Packed"
+git gc -q
+echo "loose" > loose
+git add loose
+git commit -q -m "Loose"
+cd ..
+git init -q odb-alt
+cd odb-alt
+echo "../../../odb-lender/.git/objects" > .git/objects/info/alternates
+git update-ref refs/heads/master $(cd ../odb-lender && git rev-parse HEAD)
+echo "own" > own
+sha=$($wyag hash-object -w own)
+test -f .git/objects/${sha:0:2}/${sha:2}
+$wyag log --oneline | cmp - <(git log --format="%h %s")
+$wyag ls-tree -r HEAD | cmp - <(git ls-tree -r HEAD)
+$wyag cat-file blob $sha | cmp - own
+$wyag fsck --no-progress --no-dangling
+cd ..
+# An in-memory store writes nothing to disk
+python3 -c "
+import os, sys
+sys.path.insert(0, '$wyagdir')
+import GitCommands, GitObject
+repo = GitCommands.repo_create('odb-memory', object_store='memory')
+sha = GitCommands.object_write(GitObject.GitBlob(repo, b'in memory\n'))
+assert GitCommands.object_read(repo, sha).serialize() == b'in memory\n'
+assert GitCommands.object_prefix_find(repo, sha[:4]) == [ sha ]
+assert not [ f for _, _, files in os.walk('odb-memory/.git/objects') for f in files ]
+"
+
 step THIS WAS A TRIUMPH
 step "I'M MAKING A NOTE HERE"
 step "HUGE SUCCESS"
\ No newline at end of file